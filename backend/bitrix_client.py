@@ -0,0 +1,109 @@
+"""Клиент API личного кабинета Bitrix (SSO, бонусы)."""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, Optional
+
+import httpx
+from redis.exceptions import RedisError
+
+from circuit_breaker import get_breaker
+from config import settings
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+VERIFY_CACHE_PREFIX = "bitrix:verify:"
+
+
+class BitrixTokenRejected(Exception):
+    """Bitrix не подтвердил токен SSO."""
+
+
+class BitrixClient:
+    """
+    Общий клиент Bitrix с пулом keep-alive соединений.
+
+    Создаётся один раз в `main.lifespan`, как клиент 1С. Запросы идут через
+    circuit breaker "bitrix".
+
+    Проверка токена SSO (`verify_token`): одновременные проверки одного
+    токена в процессе (всплеск редиректов с портала, повторы фронтенда)
+    ждут один запрос к Bitrix; подтверждённый профиль хранится в Redis
+    BITRIX_VERIFY_CACHE_TTL секунд, так что повтор, попавший в другой
+    воркер, тоже не доходит до Bitrix. Ключи — SHA-256 токена, сам токен
+    не хранится. Отказы не кешируются.
+    """
+
+    def __init__(self):
+        self._http = httpx.AsyncClient(
+            base_url=settings.bitrix_domain.rstrip("/") + "/",
+            timeout=settings.BITRIX_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.BITRIX_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.BITRIX_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=settings.BITRIX_KEEPALIVE_EXPIRY,
+            ),
+        )
+        self._in_flight: dict[str, asyncio.Future] = {}  # хеш токена -> проверка
+
+    async def post(self, path: str, payload: dict[str, Any]) -> dict[str, Any]:
+        """POST к API личного кабинета (путь относительно bitrix_domain). Возвращает JSON ответа."""
+        async with get_breaker("bitrix"):
+            resp = await self._http.post(path.lstrip("/"), json=payload)
+            resp.raise_for_status()
+        return resp.json()
+
+    async def _verify_upstream(self, token: str, key: str) -> dict[str, Any]:
+        result = await self.post("/local/api/verify_token.php", {"token": token})
+        if not result.get("success"):
+            raise BitrixTokenRejected(result.get("error", "Invalid token"))
+        user = result["user"]
+        try:
+            await get_redis().set(key, json.dumps(user), ex=settings.BITRIX_VERIFY_CACHE_TTL)
+        except RedisError as e:
+            logger.warning(f"Не удалось сохранить проверку токена Bitrix в кеш: {e}")
+        return user
+
+    async def verify_token(self, token: str) -> dict[str, Any]:
+        """Профиль пользователя по токену SSO; BitrixTokenRejected — токен не подтверждён"""
+        key = VERIFY_CACHE_PREFIX + hashlib.sha256(token.encode()).hexdigest()
+        try:
+            cached = await get_redis().get(key)
+        except RedisError as e:
+            logger.warning(f"Redis недоступен, токен Bitrix проверяется без кеша: {e}")
+            cached = None
+        if cached is not None:
+            return json.loads(cached)
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._verify_upstream(token, key))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+
+_client: Optional[BitrixClient] = None
+
+
+def get_bitrix_client() -> BitrixClient:
+    """Возвращает общий клиент Bitrix (создаётся при первом обращении)."""
+    global _client
+    if _client is None:
+        _client = BitrixClient()
+    return _client
+
+
+async def close_bitrix_client() -> None:
+    """Закрывает пул соединений к Bitrix (вызывается при остановке приложения)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,146 @@
+"""
+Кеш каталогов 1С (врачи, услуги) по схеме stale-while-revalidate.
+
+  - свежая запись (моложе CATALOG_FRESH_TTL) отдаётся сразу;
+  - устаревшая запись тоже отдаётся сразу, а обновление из 1С идёт в фоне;
+  - только при холодном промахе отдаётся статический список (и запускается обновление).
+
+Значения хранятся в Redis уже сериализованными в JSON, поэтому эндпоинт
+отдаёт готовые байты без повторной сериализации. Если Redis недоступен,
+используется последний снимок в памяти процесса.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import secrets
+import time
+from typing import Awaitable, Callable
+
+from redis.exceptions import RedisError
+
+from config import settings
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Блокировка обновления, чтобы воркеры не ходили в 1С одновременно
+REFRESH_LOCK_TTL = 60
+
+# Снятие блокировки, только если она всё ещё наша: обновление дольше
+# REFRESH_LOCK_TTL не должно снять блокировку, которую уже взял другой воркер
+_RELEASE_LOCK_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def _dumps(data: list[dict]) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class CatalogCache:
+    """Кеш одного каталога, загружаемого функцией `loader`."""
+
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[], Awaitable[list[dict] | None]],
+        fallback: list[dict],
+    ):
+        self.name = name
+        self.key = f"catalog:{name}"
+        self._loader = loader
+        self._fallback_body = _dumps(fallback)
+        self._local: tuple[bytes, float] | None = None  # (body, fetched_at)
+        self._refresh_task: asyncio.Task | None = None
+
+        # Счётчики (в рамках процесса)
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    async def _read(self) -> tuple[bytes | None, float | None]:
+        try:
+            body, fetched_at = await get_redis().hmget(self.key, "body", "fetched_at")
+        except RedisError as e:
+            logger.warning(f"Redis недоступен, каталог {self.name} берётся из памяти: {e}")
+            return self._local if self._local else (None, None)
+        if body is None:
+            return None, None
+        return body, float(fetched_at)
+
+    async def get(self) -> bytes:
+        """JSON-байты каталога. Никогда не ждёт ответа 1С."""
+        body, fetched_at = await self._read()
+        if body is None:
+            self.misses += 1
+            self.schedule_refresh()
+            return self._fallback_body
+
+        if time.time() - fetched_at > settings.CATALOG_FRESH_TTL:
+            self.stale_hits += 1
+            self.schedule_refresh()
+        else:
+            self.hits += 1
+        return body
+
+    def schedule_refresh(self) -> None:
+        """Запускает фоновое обновление, если оно ещё не идёт в этом процессе."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+
+    async def refresh(self) -> bool:
+        """Загружает каталог из 1С и сохраняет его в Redis."""
+        redis = get_redis()
+        lock_key, lock_token = f"{self.key}:lock", secrets.token_hex(16)
+        try:
+            if not await redis.set(lock_key, lock_token, nx=True, ex=REFRESH_LOCK_TTL):
+                return False  # обновляет другой воркер
+        except RedisError:
+            pass
+
+        try:
+            data = await self._loader()
+            if not data:
+                self.refresh_errors += 1
+                return False
+
+            body = _dumps(data)
+            fetched_at = time.time()
+            self._local = (body, fetched_at)
+            self.refreshes += 1
+            try:
+                async with redis.pipeline(transaction=True) as pipe:
+                    pipe.hset(self.key, mapping={"body": body, "fetched_at": fetched_at})
+                    pipe.expire(self.key, settings.CATALOG_MAX_STALE)
+                    await pipe.execute()
+            except RedisError as e:
+                logger.warning(f"Не удалось сохранить каталог {self.name} в Redis: {e}")
+            logger.info(f"Каталог {self.name} обновлён из 1С ({len(data)} записей)")
+            return True
+        except Exception as e:
+            self.refresh_errors += 1
+            logger.warning(f"Ошибка обновления каталога {self.name}: {e}")
+            return False
+        finally:
+            try:
+                await redis.register_script(_RELEASE_LOCK_LUA)(keys=[lock_key], args=[lock_token])
+            except RedisError:
+                pass
+
+    async def stats(self) -> dict:
+        _, fetched_at = await self._read()
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "refresh_age_seconds": round(time.time() - fetched_at, 1) if fetched_at else None,
+        }
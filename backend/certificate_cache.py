@@ -0,0 +1,67 @@
+"""
+Кеш публичной проверки сертификатов (POST /api/certificates/verify).
+
+В Redis хранится снимок сертификата (CertificateResponse в JSON) на
+CERT_VERIFY_CACHE_TTL секунд, а для неизвестных кодов — отметка «не найден»
+на CERT_VERIFY_NEGATIVE_TTL. Итоговый статус (истёк / использован)
+вычисляется из снимка в момент запроса, поэтому снимок не устаревает
+с наступлением valid_until.
+
+Эндпоинты, меняющие сертификат (погашение, передача, вебхуки 1С, сборщик
+статусов), сбрасывают запись через `invalidate`. Если Redis недоступен,
+проверка идёт в БД, а сброс откладывается до истечения TTL.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+from config import settings
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "cert:verify:"
+_NOT_FOUND = b"-"
+_INVALIDATE_CHUNK = 1000  # ключей в одной команде DEL
+
+
+def _key(code: str) -> str:
+    return f"{KEY_PREFIX}{code}"
+
+
+async def get(code: str) -> tuple[bool, Optional[dict]]:
+    """(найдено в кеше, снимок); снимок None — сертификата нет"""
+    try:
+        raw = await get_redis().get(_key(code))
+    except RedisError as e:
+        logger.warning(f"Redis недоступен, проверка сертификата идёт в БД: {e}")
+        return False, None
+    if raw is None:
+        return False, None
+    if raw == _NOT_FOUND:
+        return True, None
+    return True, json.loads(raw)
+
+
+async def put(code: str, snapshot: Optional[dict]) -> None:
+    if snapshot is None:
+        value, ttl = _NOT_FOUND, settings.CERT_VERIFY_NEGATIVE_TTL
+    else:
+        value, ttl = json.dumps(snapshot, ensure_ascii=False), settings.CERT_VERIFY_CACHE_TTL
+    try:
+        await get_redis().set(_key(code), value, ex=ttl)
+    except RedisError as e:
+        logger.warning(f"Не удалось сохранить сертификат {code} в кеш: {e}")
+
+
+async def invalidate(*codes: str) -> None:
+    """Сброс кеша проверки для кодов; вызывается после коммита изменений"""
+    try:
+        for start in range(0, len(codes), _INVALIDATE_CHUNK):
+            await get_redis().delete(*[_key(code) for code in codes[start:start + _INVALIDATE_CHUNK]])
+    except RedisError as e:
+        logger.warning(f"Не удалось сбросить кеш сертификатов ({len(codes)} шт.): {e}")
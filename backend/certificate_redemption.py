@@ -0,0 +1,225 @@
+"""
+Погашение сертификатов.
+
+Остаток уменьшается одним условным UPDATE ... RETURNING, без чтения
+сертификата в Python:
+  - на кассе (`redeem`) в WHERE входят статус, срок действия и
+    `current_amount >= :amount`, поэтому два кассира (или касса и 1С) не
+    могут списать один сертификат дважды: второй UPDATE ждёт блокировку
+    строки, перечитывает её и не находит достаточного остатка;
+  - погашение, уже проведённое в 1С (`record_external_async`), — факт,
+    его нельзя отклонить: остаток уменьшается на `amount_used` с
+    обрезкой до нуля, параллельные погашения на кассе не теряются.
+
+Строка погашения добавляется в ту же сессию; функции не коммитят. Номер
+документа 1С уникален (migrations/006), поэтому повтор одного документа
+падает с IntegrityError — вызывающий откатывает сессию (вместе с UPDATE
+остатка), находит уже проведённое погашение через `find_by_document` и
+сверяет его с запросом (`check_replay`): тот же сертификат и сумма —
+повтор, ответ идемпотентный; иначе номер документа занят другим
+погашением (DocumentConflictError, 409).
+
+Блокируется только строка погашаемого сертификата: погашения разных
+сертификатов идут параллельно.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import Integer, bindparam, case, func, literal, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import Certificate, CertificateRedemption, CertificateStatus
+
+
+class RedemptionError(Exception):
+    """Сертификат не может быть погашен."""
+
+
+class CertificateNotFoundError(RedemptionError):
+    def __init__(self, code: str):
+        super().__init__("Сертификат не найден")
+        self.code = code
+
+
+class CertificateNotActiveError(RedemptionError):
+    def __init__(self, status: CertificateStatus):
+        super().__init__(f"Сертификат не может быть использован. Статус: {status}")
+        self.status = status
+
+
+class CertificateExpiredError(RedemptionError):
+    def __init__(self):
+        super().__init__("Срок действия сертификата истек")
+
+
+class CertificateReissuedError(RedemptionError):
+    def __init__(self):
+        super().__init__("QR-код устарел: сертификат перевыпущен")
+
+
+class DocumentConflictError(RedemptionError):
+    def __init__(self, onec_document_id: str):
+        super().__init__(f"Документ 1С {onec_document_id} уже использован для другого погашения")
+        self.onec_document_id = onec_document_id
+
+
+class InsufficientCertificateFundsError(RedemptionError):
+    def __init__(self, available: float):
+        super().__init__(f"Недостаточно средств на сертификате. Доступно: {available}")
+        self.available = available
+
+
+@dataclass
+class RedemptionResult:
+    redemption: CertificateRedemption
+    certificate_id: int
+    remaining_amount: float
+    status: CertificateStatus
+
+
+def _decrement_values(new_amount):
+    """SET-часть UPDATE: остаток и переход в USED при нулевом остатке"""
+    depleted = new_amount <= 0
+    return {
+        "current_amount": new_amount,
+        "status": case((depleted, literal(CertificateStatus.USED, Certificate.status.type)), else_=Certificate.status),
+        "used_at": case((depleted, func.coalesce(Certificate.used_at, func.now())), else_=Certificate.used_at),
+    }
+
+
+# Операторы собираются один раз, в execute передаются только код и сумма —
+# на горячем пути кассы не тратится CPU на построение выражений
+_REDEEM_STMT = (
+    update(Certificate)
+    .where(
+        Certificate.code == bindparam("b_code"),
+        Certificate.status == CertificateStatus.ACTIVE,
+        Certificate.valid_until >= func.now(),
+        Certificate.current_amount >= bindparam("b_amount"),
+        # Версия выпуска из подписанного QR; без QR (ввод кода вручную) не проверяется
+        Certificate.issue_version == func.coalesce(bindparam("b_version", type_=Integer), Certificate.issue_version),
+    )
+    .values(_decrement_values(Certificate.current_amount - bindparam("b_amount")))
+    .returning(Certificate.id, Certificate.current_amount, Certificate.status)
+    .execution_options(synchronize_session=False)
+)
+
+_EXTERNAL_STMT = (
+    update(Certificate)
+    .where(Certificate.code == bindparam("b_code"))
+    .values(_decrement_values(func.greatest(Certificate.current_amount - bindparam("b_amount"), 0)))
+    .returning(Certificate.id, Certificate.current_amount, Certificate.status)
+    .execution_options(synchronize_session=False)
+)
+
+_STATE_STMT = (
+    select(Certificate.status, Certificate.valid_until, Certificate.current_amount, Certificate.issue_version)
+    .where(Certificate.code == bindparam("b_code"))
+)
+
+
+def _rejection(code: str, issue_version: Optional[int], certificate) -> RedemptionError:
+    """Причина, по которой условный UPDATE не нашёл строку"""
+    if certificate is None:
+        return CertificateNotFoundError(code)
+    if issue_version is not None and issue_version != certificate.issue_version:
+        return CertificateReissuedError()
+    if certificate.status != CertificateStatus.ACTIVE:
+        return CertificateNotActiveError(certificate.status)
+    valid_until = certificate.valid_until
+    if valid_until.tzinfo is None:
+        valid_until = valid_until.replace(tzinfo=timezone.utc)
+    if datetime.now(timezone.utc) > valid_until:
+        return CertificateExpiredError()
+    return InsufficientCertificateFundsError(certificate.current_amount)
+
+
+def find_by_document_stmt(onec_document_id: str):
+    """Погашение по документу 1С и код его сертификата: (CertificateRedemption, code)"""
+    return (
+        select(CertificateRedemption, Certificate.code)
+        .join(Certificate, Certificate.id == CertificateRedemption.certificate_id)
+        .where(CertificateRedemption.onec_document_id == onec_document_id)
+    )
+
+
+def find_by_document(db: Session, onec_document_id: str):
+    return db.execute(find_by_document_stmt(onec_document_id)).first()
+
+
+def check_replay(found, code: str, amount: float) -> CertificateRedemption:
+    """
+    Погашение из `find_by_document` — повтор запроса (тот же сертификат и
+    сумма)? Иначе DocumentConflictError: касса не должна получить «успех»
+    за списание, которого не было.
+    """
+    redemption, redeemed_code = found
+    if redeemed_code != code or abs(redemption.amount_used - amount) > 0.005:
+        raise DocumentConflictError(redemption.onec_document_id)
+    return redemption
+
+
+def redeem(
+    db: Session,
+    *,
+    code: str,
+    amount: float,
+    redeemed_by_id: Optional[int],
+    issue_version: Optional[int] = None,
+    onec_document_id: Optional[str] = None,
+    notes: Optional[str] = None,
+) -> RedemptionResult:
+    """
+    Погашение на кассе. `issue_version` — из подписанного QR-кода: погашение
+    по QR перевыпущенного сертификата отклоняется. Ошибки — наследники
+    RedemptionError; без commit.
+    """
+    if amount <= 0:
+        raise RedemptionError("Сумма должна быть больше нуля")
+
+    params = {"b_code": code, "b_amount": amount, "b_version": issue_version}
+    row = db.execute(_REDEEM_STMT, params).first()
+    if row is None:
+        raise _rejection(code, issue_version, db.execute(_STATE_STMT, {"b_code": code}).first())
+
+    redemption = CertificateRedemption(
+        certificate_id=row.id,
+        amount_used=amount,
+        remaining_amount=row.current_amount,
+        onec_document_id=onec_document_id,
+        redeemed_by_id=redeemed_by_id,
+        notes=notes,
+    )
+    db.add(redemption)
+    db.flush()
+    return RedemptionResult(redemption, row.id, row.current_amount, row.status)
+
+
+async def record_external_async(
+    db: AsyncSession,
+    *,
+    code: str,
+    amount_used: float,
+    onec_document_id: str,
+    notes: Optional[str] = None,
+) -> Optional[RedemptionResult]:
+    """Учёт погашения, проведённого в 1С. None — сертификата нет; без commit."""
+    row = (await db.execute(_EXTERNAL_STMT, {"b_code": code, "b_amount": amount_used})).first()
+    if row is None:
+        return None
+
+    redemption = CertificateRedemption(
+        certificate_id=row.id,
+        amount_used=amount_used,
+        remaining_amount=row.current_amount,
+        onec_document_id=onec_document_id,
+        redeemed_by_id=None,
+        notes=notes,
+    )
+    db.add(redemption)
+    await db.flush()
+    return RedemptionResult(redemption, row.id, row.current_amount, row.status)
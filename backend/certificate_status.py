@@ -0,0 +1,107 @@
+"""
+Статусы сертификатов по сроку действия и остатку.
+
+Проверка сертификата только читает: итоговый статус вычисляется на лету
+(`effective_status`). В БД переходы ACTIVE → EXPIRED / USED записывает
+периодический сборщик (`sweep`) порциями по CERT_SWEEP_BATCH_SIZE строк;
+строки, заблокированные погашением, пропускаются (SKIP LOCKED) и
+подбираются следующим запуском.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+import certificate_cache
+from config import settings
+from database import SessionLocal
+from models import Certificate, CertificateStatus
+
+logger = logging.getLogger(__name__)
+
+
+def effective_status(
+    status: CertificateStatus,
+    valid_until: datetime,
+    current_amount: float,
+    now: datetime,
+) -> CertificateStatus:
+    """Статус с учётом срока действия и остатка, даже если сборщик ещё не прошёл"""
+    if status != CertificateStatus.ACTIVE:
+        return status
+    if valid_until.tzinfo is None:
+        valid_until = valid_until.replace(tzinfo=timezone.utc)
+    if now > valid_until:
+        return CertificateStatus.EXPIRED
+    if current_amount <= 0:
+        return CertificateStatus.USED
+    return CertificateStatus.ACTIVE
+
+
+def _sweep_batch(db: Session, condition, new_status: CertificateStatus, batch_size: int) -> list[str]:
+    batch = (
+        select(Certificate.id)
+        .where(Certificate.status == CertificateStatus.ACTIVE, condition)
+        .order_by(Certificate.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    values = {"status": new_status}
+    if new_status == CertificateStatus.USED:
+        values["used_at"] = func.coalesce(Certificate.used_at, func.now())
+
+    codes = db.execute(
+        update(Certificate)
+        .where(Certificate.id.in_(batch.scalar_subquery()))
+        .values(**values)
+        .returning(Certificate.code)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.commit()
+    return codes
+
+
+def sweep(db: Session, batch_size: int = 1000) -> dict[CertificateStatus, list[str]]:
+    """
+    Перевод активных сертификатов с истёкшим сроком в EXPIRED, а с нулевым
+    остатком — в USED. Каждая порция — отдельная транзакция.
+    Возвращает коды изменённых сертификатов по новому статусу.
+    """
+    # Порядок как в effective_status: сначала срок, затем остаток
+    passes = (
+        (CertificateStatus.EXPIRED, Certificate.valid_until < func.now()),
+        (CertificateStatus.USED, Certificate.current_amount <= 0),
+    )
+    changed: dict[CertificateStatus, list[str]] = {}
+    for new_status, condition in passes:
+        codes = changed.setdefault(new_status, [])
+        while True:
+            batch = _sweep_batch(db, condition, new_status, batch_size)
+            codes.extend(batch)
+            if len(batch) < batch_size:
+                break
+    return changed
+
+
+def _sweep_in_session() -> dict[CertificateStatus, list[str]]:
+    db = SessionLocal()
+    try:
+        return sweep(db, settings.CERT_SWEEP_BATCH_SIZE)
+    finally:
+        db.close()
+
+
+async def sweep_job() -> None:
+    """Периодическая задача (scheduler): сборщик статусов и сброс кеша проверки"""
+    changed = await asyncio.to_thread(_sweep_in_session)
+    codes = [code for batch in changed.values() for code in batch]
+    if codes:
+        await certificate_cache.invalidate(*codes)
+        logger.info(
+            "Сборщик статусов сертификатов: "
+            + ", ".join(f"{status.value}={len(batch)}" for status, batch in changed.items())
+        )
@@ -0,0 +1,147 @@
+"""
+Подписанное содержимое QR-кода сертификата.
+
+QR-код несёт код, номинал, срок действия и версию выпуска, подписанные
+Ed25519. Кассовый терминал (по открытому ключу из
+GET /api/certificates/signing-key) и сам сервис проверяют подлинность и
+срок без обращения к БД; поддельные и испорченные коды отсекаются до
+любого запроса. БД нужна только за живым остатком при погашении.
+
+Формат токена: c1.<body>.<signature>
+  body      — base64url("код|номинал в копейках|valid_until unix|issue_version")
+  signature — base64url(Ed25519("c1.<body>"))
+base64url без '=' в конце.
+
+Содержимое QR — https://{DOMAIN}/verify/{код}?t={токен}: прежний вид
+ссылки сохранён для сканеров, которые берут код из пути.
+
+Ключ — CERT_SIGNING_KEY (base64 32-байтового seed, `openssl rand -base64 32`),
+обязателен и не связан с JWT_SECRET: смена секрета JWT не должна делать
+недействительными напечатанные сертификаты. Без ключа приложение не
+запускается (`check_signing_key` в lifespan).
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from config import settings
+
+FORMAT = "c1"
+MAX_TOKEN_LENGTH = 512  # с запасом: код до 64 символов + подпись 86
+
+
+class InvalidCertificateToken(ValueError):
+    """Токен испорчен, подделан или подписан другим ключом."""
+
+
+class SigningKeyMissing(RuntimeError):
+    """CERT_SIGNING_KEY не задан или не является base64 32-байтового seed."""
+
+
+@dataclass(frozen=True)
+class CertificateClaims:
+    code: str
+    nominal: float
+    valid_until: datetime
+    issue_version: int
+
+    def expired(self, now: Optional[datetime] = None) -> bool:
+        return (now or datetime.now(timezone.utc)) > self.valid_until
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+@lru_cache(maxsize=1)
+def _private_key() -> Ed25519PrivateKey:
+    if not settings.CERT_SIGNING_KEY:
+        raise SigningKeyMissing("CERT_SIGNING_KEY не задан (сгенерируйте: openssl rand -base64 32)")
+    try:
+        seed = base64.b64decode(settings.CERT_SIGNING_KEY, validate=True)
+    except ValueError:
+        raise SigningKeyMissing("CERT_SIGNING_KEY должен быть в base64")
+    if len(seed) != 32:
+        raise SigningKeyMissing(f"CERT_SIGNING_KEY должен содержать 32 байта, получено {len(seed)}")
+    return Ed25519PrivateKey.from_private_bytes(seed)
+
+
+def check_signing_key() -> None:
+    """Проверка ключа при запуске: без него сертификаты нельзя ни выпустить, ни проверить"""
+    _private_key()
+
+
+@lru_cache(maxsize=1)
+def public_key_bytes() -> bytes:
+    return _private_key().public_key().public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
+
+
+def key_id() -> str:
+    """Короткий отпечаток открытого ключа — терминал видит смену ключа"""
+    return hashlib.sha256(public_key_bytes()).hexdigest()[:16]
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def sign(code: str, nominal: float, valid_until: datetime, issue_version: int = 1) -> str:
+    body = f"{code}|{round(nominal * 100)}|{int(_as_utc(valid_until).timestamp())}|{issue_version}"
+    signed = f"{FORMAT}.{_b64encode(body.encode('utf-8'))}"
+    return f"{signed}.{_b64encode(_private_key().sign(signed.encode('ascii')))}"
+
+
+def extract_token(scanned: str) -> str:
+    """Токен из отсканированного QR: принимается и вся ссылка, и сам токен"""
+    if scanned.startswith(f"{FORMAT}."):
+        return scanned
+    values = parse_qs(urlsplit(scanned).query).get("t")
+    if not values:
+        raise InvalidCertificateToken("QR-код не содержит подписи")
+    return values[0]
+
+
+def verify(scanned: str) -> CertificateClaims:
+    """Проверка подписи и разбор токена без обращения к БД"""
+    if len(scanned) > MAX_TOKEN_LENGTH * 2:
+        raise InvalidCertificateToken("Слишком длинный QR-код")
+    token = extract_token(scanned)
+    if len(token) > MAX_TOKEN_LENGTH:
+        raise InvalidCertificateToken("Слишком длинный QR-код")
+
+    signed, _, signature = token.rpartition(".")
+    fmt, _, body = signed.partition(".")
+    if fmt != FORMAT or not body or not signature:
+        raise InvalidCertificateToken("Неизвестный формат QR-кода")
+    try:
+        _private_key().public_key().verify(_b64decode(signature), signed.encode("ascii"))
+        code, nominal, valid_until, issue_version = _b64decode(body).decode("utf-8").rsplit("|", 3)
+        return CertificateClaims(
+            code=code,
+            nominal=int(nominal) / 100,
+            valid_until=datetime.fromtimestamp(int(valid_until), tz=timezone.utc),
+            issue_version=int(issue_version),
+        )
+    except (InvalidSignature, ValueError, UnicodeError) as e:
+        raise InvalidCertificateToken("Подпись QR-кода недействительна") from e
+
+
+def qr_content(code: str, nominal: float, valid_until: datetime, issue_version: int = 1) -> str:
+    """Строка, которая кодируется в QR-изображение сертификата"""
+    return f"https://{settings.DOMAIN}/verify/{code}?t={sign(code, nominal, valid_until, issue_version)}"
@@ -0,0 +1,163 @@
+"""
+Circuit breaker и bulkhead для исходящих вызовов (1С, Bitrix).
+
+Для каждого внешнего сервиса свой автомат состояний:
+  closed    — запросы идут как обычно, считаются подряд идущие сбои;
+  open      — после `failure_threshold` сбоев запросы сразу отклоняются
+              (CircuitOpenError), без ожидания таймаута httpx;
+  half_open — через `reset_timeout` секунд пропускается один пробный запрос:
+              успех замыкает цепь, сбой снова размыкает.
+
+Дополнительно число одновременных запросов к сервису ограничено
+`max_concurrent` (bulkhead): лишние запросы отклоняются сразу, чтобы
+медленный сервис не занял весь event loop и пул соединений БД.
+
+Использование:
+    async with get_breaker("1c"):
+        resp = await client.get(...)
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+
+import httpx
+
+from config import settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонён: сервис считается недоступным или занят."""
+
+    def __init__(self, name: str, reason: str):
+        super().__init__(f"{name}: {reason}")
+        self.name = name
+        self.reason = reason
+
+
+def _is_failure(exc: BaseException) -> bool:
+    """Сбоем считаются сетевые ошибки, таймауты и ответы 5xx."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+        max_concurrent: int,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_concurrent = max_concurrent
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self._probe_in_flight = False
+        self._probe_task: asyncio.Task | None = None
+        self._in_flight = 0
+
+        # Статистика
+        self.total_calls = 0
+        self.total_failures = 0
+        self.total_rejected = 0
+
+    def _reject(self, reason: str) -> None:
+        self.total_rejected += 1
+        raise CircuitOpenError(self.name, reason)
+
+    async def __aenter__(self) -> "CircuitBreaker":
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self._reject("цепь разомкнута")
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                self._reject("идёт пробный запрос")
+            self._probe_in_flight = True
+            self._probe_task = asyncio.current_task()
+        if self._in_flight >= self.max_concurrent:
+            self._end_probe()
+            self._reject("превышен лимит одновременных запросов")
+
+        self._in_flight += 1
+        self.total_calls += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        self._in_flight -= 1
+        # Состояние half_open/open меняет только пробный запрос: ответ
+        # запроса, начатого до размыкания цепи, о восстановлении не говорит
+        is_probe = self._probe_in_flight and self._probe_task is asyncio.current_task()
+        if is_probe:
+            self._end_probe()
+        if exc is None or (isinstance(exc, Exception) and not _is_failure(exc)):
+            self._on_success(is_probe)  # сервис ответил, даже если ответ нас не устроил
+        elif _is_failure(exc):
+            self._on_failure(is_probe)
+        # отмена запроса ничего не говорит о сервисе
+        return False
+
+    def _end_probe(self) -> None:
+        self._probe_in_flight = False
+        self._probe_task = None
+
+    def _on_success(self, is_probe: bool) -> None:
+        self.consecutive_failures = 0
+        if is_probe:
+            self.state = CLOSED
+            self.opened_at = None
+
+    def _on_failure(self, is_probe: bool) -> None:
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        if is_probe or (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def status(self) -> dict:
+        retry_in = None
+        if self.state == OPEN:
+            retry_in = max(0.0, round(self.reset_timeout - (time.monotonic() - self.opened_at), 1))
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "in_flight": self._in_flight,
+            "max_concurrent": self.max_concurrent,
+            "retry_in_seconds": retry_in,
+            "total_calls": self.total_calls,
+            "total_failures": self.total_failures,
+            "total_rejected": self.total_rejected,
+        }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+UPSTREAMS = ("1c", "bitrix", "bitrix_rest")
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Возвращает breaker внешнего сервиса (создаётся при первом обращении)."""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = CircuitBreaker(
+            name,
+            failure_threshold=settings.CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout=settings.CIRCUIT_RESET_TIMEOUT,
+            max_concurrent=settings.ONEC_MAX_CONCURRENT if name == "1c" else settings.BITRIX_MAX_CONCURRENT,
+        )
+        _breakers[name] = breaker
+    return breaker
+
+
+def breakers_status() -> dict[str, dict]:
+    return {name: get_breaker(name).status() for name in UPSTREAMS}
@@ -8,21 +8,51 @@ class Settings(BaseSettings):
     
     # Redis
     REDIS_URL: str = "redis://redis:6379/0"
-    
+    REDIS_SOCKET_TIMEOUT: float = 0.5  # сек, чтобы недоступный Redis не тормозил запросы
+
+    # Кеш каталогов 1С (врачи, услуги)
+    CATALOG_FRESH_TTL: int = 300  # сек, после этого запись считается устаревшей
+    CATALOG_MAX_STALE: int = 86400  # сек, сколько устаревшая запись живёт в Redis
+
+    # Пакетные проводки лояльности
+    LOYALTY_BATCH_MAX_ITEMS: int = 50000  # операций в одном запросе /transactions/batch
+
     # Security
     JWT_SECRET: str = "your-secret-key-change-in-production"
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     REFRESH_TOKEN_EXPIRE_DAYS: int = 7
+    REFRESH_REUSE_GRACE: int = 10  # сек, повтор только что обменянного refresh-токена не считается кражей
+    TOKEN_REVOCATION_SYNC_INTERVAL: float = 1  # сек, обновление списка отозванных токенов в воркере
+    PRINCIPAL_CACHE_TTL: int = 60  # сек, снимок пользователя (id, роль, активность) в Redis
+    PRINCIPAL_CACHE_L1_TTL: int = 5  # сек, тот же снимок в памяти процесса
+    PRINCIPAL_CACHE_L1_SIZE: int = 10000  # пользователей в памяти процесса
+    PASSWORD_HASH_WORKERS: int = 2  # процессов для bcrypt (хеширование и проверка паролей)
+    PASSWORD_HASH_MAX_PENDING: int = 32  # операций в очереди, сверх — 503
     
     # 1C Integration
     ONEC_API_URL: Optional[str] = None
     ONEC_USERNAME: Optional[str] = None
     ONEC_PASSWORD: Optional[str] = None
+    ONEC_TIMEOUT: float = 8.0  # сек, таймаут по умолчанию для запросов к 1С
+    ONEC_POOL_MAX_CONNECTIONS: int = 20
+    ONEC_POOL_MAX_KEEPALIVE: int = 10
+    ONEC_KEEPALIVE_EXPIRY: float = 30.0  # сек
+    ONEC_MAX_CONCURRENT: int = 10  # одновременных запросов к 1С (bulkhead)
     
     # Bitrix Integration
     BITRIX_API_URL: Optional[str] = None
     BITRIX_WEBHOOK: Optional[str] = None
+    BITRIX_MAX_CONCURRENT: int = 20  # одновременных запросов к Bitrix (bulkhead)
+    BITRIX_TIMEOUT: float = 10.0  # сек, запросы к личному кабинету Bitrix (SSO, бонусы)
+    BITRIX_POOL_MAX_CONNECTIONS: int = 20
+    BITRIX_POOL_MAX_KEEPALIVE: int = 10
+    BITRIX_KEEPALIVE_EXPIRY: float = 30.0  # сек
+    BITRIX_VERIFY_CACHE_TTL: int = 30  # сек, подтверждённый токен SSO не проверяется повторно
+
+    # Circuit breaker для внешних сервисов
+    CIRCUIT_FAILURE_THRESHOLD: int = 5  # сбоев подряд до размыкания цепи
+    CIRCUIT_RESET_TIMEOUT: float = 30.0  # сек до пробного запроса
     
     # Bitrix SSO
     bitrix_domain: str = "https://mydoctorarmavir.ru"
@@ -46,6 +76,23 @@ class Settings(BaseSettings):
     # File uploads
     UPLOAD_DIR: str = "/app/uploads"
     QR_CODE_DIR: str = "/app/qrcodes"
+    QR_RENDER_WORKERS: int = 2  # процессов для рендеринга QR-кодов
+    QR_SERVE_MODE: str = "direct"  # direct — отдаёт приложение, x-accel — nginx через X-Accel-Redirect
+    QR_ACCEL_PREFIX: str = "/_qr_storage"  # внутренний location nginx с каталогом QR_CODE_DIR
+    CERT_BATCH_MAX_COUNT: int = 5000  # сертификатов в одном пакетном выпуске
+    CERT_VERIFY_CACHE_TTL: int = 30  # сек, кеш публичной проверки сертификата
+    CERT_VERIFY_NEGATIVE_TTL: int = 10  # сек, кеш ответа «сертификат не найден»
+    CERT_SWEEP_INTERVAL: int = 300  # сек между запусками сборщика статусов сертификатов
+    CERT_SWEEP_BATCH_SIZE: int = 1000  # сертификатов в одной транзакции сборщика
+    REFERRAL_RECONCILE_INTERVAL: int = 3600  # сек между сверками счётчиков реферальных кодов
+    REFERRAL_RECONCILE_BATCH_SIZE: int = 1000  # кодов в одной транзакции сверки
+    REWARD_RULES_CACHE_TTL: int = 60  # сек, правила вознаграждений в памяти процесса
+    REFERRAL_MAX_DEPTH: int = 5  # уровней предков пользователя в referral_ancestry
+    REFERRAL_QUEUE_POLL_INTERVAL: int = 5  # сек между проходами обработчика реферальных событий
+    REFERRAL_QUEUE_BATCH_SIZE: int = 200  # событий в одной транзакции обработчика
+    REFERRAL_QUEUE_MAX_ATTEMPTS: int = 8  # после стольких ошибок событие остаётся необработанным
+    REFERRAL_QUEUE_RETRY_DELAY: int = 30  # сек до первого повтора, далее удваивается (не больше часа)
+    CERT_SIGNING_KEY: Optional[str] = None  # base64 seed Ed25519 для подписи QR, обязателен (openssl rand -base64 32)
     MAX_UPLOAD_SIZE: int = 5 * 1024 * 1024  # 5MB
     
     class Config:
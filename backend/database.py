@@ -1,8 +1,14 @@
+import logging
+from pathlib import Path
+
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from config import settings
 
+logger = logging.getLogger(__name__)
+
 # Создание движка базы данных
 engine = create_engine(
     settings.DATABASE_URL,
@@ -14,6 +20,31 @@ engine = create_engine(
 # Создание сессии
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def _async_database_url(url: str) -> str:
+    """postgresql://... → postgresql+asyncpg://... для асинхронного движка"""
+    for prefix in ("postgresql+psycopg2://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+# Асинхронный движок (asyncpg) для async-эндпоинтов, чтобы запросы к БД
+# не блокировали event loop
+async_engine = create_async_engine(
+    _async_database_url(settings.DATABASE_URL),
+    pool_pre_ping=True,
+    pool_size=10,
+    max_overflow=20
+)
+
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 # Базовый класс для моделей
 Base = declarative_base()
 
@@ -25,3 +56,34 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# Dependency для получения асинхронной сессии БД
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# SQL-миграции поверх create_all: индексы, новые колонки, бэкфиллы.
+# Файлы migrations/NNN_*.sql применяются по порядку один раз,
+# применённые записываются в schema_migrations.
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+
+
+def apply_migrations():
+    with engine.begin() as conn:
+        # Несколько воркеров uvicorn стартуют одновременно
+        conn.exec_driver_sql("SELECT pg_advisory_xact_lock(4242001)")
+        conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "name VARCHAR PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        )
+        applied = {row[0] for row in conn.exec_driver_sql("SELECT name FROM schema_migrations")}
+        for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+            if path.name in applied:
+                continue
+            logger.info(f"Применение миграции {path.name}")
+            conn.exec_driver_sql(path.read_text(encoding="utf-8"))
+            conn.exec_driver_sql(
+                "INSERT INTO schema_migrations (name) VALUES (%(name)s)", {"name": path.name}
+            )
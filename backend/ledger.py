@@ -0,0 +1,472 @@
+"""
+Проводки по счетам лояльности.
+
+Баланс меняется одним условным UPDATE ... RETURNING прямо в БД, без чтения
+аккаунта в Python: параллельные начисления/списания не теряют обновлений,
+а списание не может увести баланс в минус (проверка `balance >= :amount`
+входит в WHERE). Строка транзакции и запись аудита добавляются в ту же
+сессию — вызывающий код делает один commit на всю операцию.
+
+Функции не коммитят: если во время commit возникает IntegrityError по
+idempotency_key (параллельный дубль), вызывающий откатывает сессию и
+возвращает уже существующую транзакцию через `find_by_idempotency_key`.
+
+Есть синхронный (`post_entry`) и асинхронный (`post_entry_async`) варианты,
+SQL у них общий. Для пакетов из тысяч операций (ночное закрытие 1С) —
+`post_batch`: всё множественными операторами, без запросов на каждую строку.
+
+Каждая проводка тем же UPDATE увеличивает `transactions_count` и обновляет
+`last_transaction_at` аккаунта; расхождения (ручные правки, старые данные)
+исправляет `reconcile_account_counters`. Дневной агрегат для отчётов
+(rollups) обновляется последним оператором проводки, чтобы блокировка его
+строки держалась как можно меньше.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+from sqlalchemy import Float, Integer, column, insert, select, text, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+import rollups
+from models import AuditLog, LoyaltyAccount, LoyaltyTransaction, TransactionType
+
+# currency -> (баланс, всего начислено, всего списано)
+_COLUMNS = {
+    "points": ("points_balance", "total_points_earned", "total_points_spent"),
+    "cashback": ("cashback_balance", "total_cashback_earned", "total_cashback_spent"),
+}
+
+
+class LedgerError(Exception):
+    """Проводка не может быть выполнена."""
+
+
+class AccountNotFoundError(LedgerError):
+    def __init__(self, account_id: int):
+        super().__init__(f"Аккаунт лояльности {account_id} не найден")
+        self.account_id = account_id
+
+
+class InsufficientFundsError(LedgerError):
+    def __init__(self, currency: str, available: float):
+        label = "баллов" if currency == "points" else "кешбэка"
+        super().__init__(f"Недостаточно {label}. Доступно: {available}")
+        self.currency = currency
+        self.available = available
+
+
+@dataclass
+class LedgerResult:
+    transaction: LoyaltyTransaction
+    created: bool  # False — вернули существующую транзакцию по idempotency_key
+    balance: Optional[dict] = None  # {"points": ..., "cashback": ...} после проводки
+
+
+def _check_entry(transaction_type: TransactionType, currency: str, amount: float) -> None:
+    if currency not in _COLUMNS:
+        raise LedgerError(f"Неизвестная валюта: {currency}")
+    if amount <= 0:
+        raise LedgerError("Сумма должна быть больше нуля")
+    if transaction_type not in (TransactionType.ACCRUAL, TransactionType.DEDUCTION):
+        raise LedgerError(f"Тип проводки {transaction_type} не поддерживается")
+
+
+def _balance_update(account_id: int, transaction_type: TransactionType, currency: str, amount: float):
+    """UPDATE баланса одним оператором. Для списания в WHERE есть проверка остатка."""
+    _check_entry(transaction_type, currency, amount)
+
+    balance_col, earned_col, spent_col = _COLUMNS[currency]
+    balance = getattr(LoyaltyAccount, balance_col)
+    stmt = update(LoyaltyAccount).where(LoyaltyAccount.id == account_id)
+
+    if transaction_type == TransactionType.ACCRUAL:
+        earned = getattr(LoyaltyAccount, earned_col)
+        stmt = stmt.values({balance: balance + amount, earned: earned + amount})
+    else:
+        spent = getattr(LoyaltyAccount, spent_col)
+        stmt = stmt.where(balance >= amount).values({balance: balance - amount, spent: spent + amount})
+
+    return (
+        stmt.values(
+            transactions_count=LoyaltyAccount.transactions_count + 1,
+            last_transaction_at=func.now(),
+            updated_at=func.now(),
+        )
+        .returning(LoyaltyAccount.points_balance, LoyaltyAccount.cashback_balance)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _available_stmt(account_id: int, currency: str):
+    return select(getattr(LoyaltyAccount, _COLUMNS[currency][0])).where(LoyaltyAccount.id == account_id)
+
+
+def _idempotency_stmt(key: str):
+    return select(LoyaltyTransaction).where(LoyaltyTransaction.idempotency_key == key)
+
+
+def _entries(
+    row,
+    *,
+    account_id: int,
+    transaction_type: TransactionType,
+    amount: float,
+    currency: str,
+    source: str,
+    source_id: Optional[str],
+    description: Optional[str],
+    extra_data: Optional[dict],
+    idempotency_key: Optional[str],
+    created_by: Optional[int],
+) -> tuple[LoyaltyTransaction, dict, dict]:
+    new_balance = {"points": row.points_balance, "cashback": row.cashback_balance}
+    old_balance = dict(new_balance)
+    delta = amount if transaction_type == TransactionType.ACCRUAL else -amount
+    old_balance[currency] = new_balance[currency] - delta
+
+    transaction = LoyaltyTransaction(
+        account_id=account_id,
+        transaction_type=transaction_type,
+        amount=amount,
+        currency=currency,
+        source=source,
+        source_id=source_id,
+        description=description,
+        extra_data=extra_data,
+        idempotency_key=idempotency_key,
+        created_by=created_by,
+    )
+    return transaction, old_balance, new_balance
+
+
+def _audit(user_id: Optional[int], action: str, transaction_id: int, old_balance: dict, new_balance: dict) -> AuditLog:
+    return AuditLog(
+        user_id=user_id,
+        action=action,
+        entity_type="loyalty_transaction",
+        entity_id=transaction_id,
+        old_values=old_balance,
+        new_values=new_balance,
+    )
+
+
+def find_by_idempotency_key(db: Session, key: str) -> Optional[LoyaltyTransaction]:
+    return db.execute(_idempotency_stmt(key)).scalars().first()
+
+
+async def find_by_idempotency_key_async(db: AsyncSession, key: str) -> Optional[LoyaltyTransaction]:
+    return (await db.execute(_idempotency_stmt(key))).scalars().first()
+
+
+def post_entry(
+    db: Session,
+    *,
+    account_id: int,
+    transaction_type: TransactionType,
+    amount: float,
+    currency: str = "points",
+    source: str,
+    source_id: Optional[str] = None,
+    description: Optional[str] = None,
+    extra_data: Optional[dict] = None,
+    idempotency_key: Optional[str] = None,
+    created_by: Optional[int] = None,
+    audit_action: Optional[str] = None,
+) -> LedgerResult:
+    """
+    Проводка по счёту: изменение баланса, строка LoyaltyTransaction и,
+    если указан `audit_action`, запись AuditLog. Commit — за вызывающим.
+    """
+    if idempotency_key:
+        existing = find_by_idempotency_key(db, idempotency_key)
+        if existing:
+            return LedgerResult(existing, created=False)
+
+    row = db.execute(_balance_update(account_id, transaction_type, currency, amount)).first()
+    if row is None:
+        available = db.execute(_available_stmt(account_id, currency)).scalar_one_or_none()
+        if available is None:
+            raise AccountNotFoundError(account_id)
+        raise InsufficientFundsError(currency, available)
+
+    transaction, old_balance, new_balance = _entries(
+        row,
+        account_id=account_id, transaction_type=transaction_type, amount=amount,
+        currency=currency, source=source, source_id=source_id, description=description,
+        extra_data=extra_data, idempotency_key=idempotency_key, created_by=created_by,
+    )
+    db.add(transaction)
+    db.flush()
+    if audit_action:
+        db.add(_audit(created_by, audit_action, transaction.id, old_balance, new_balance))
+    db.execute(rollups.upsert_stmt([(currency, transaction_type, source, amount)]))
+    return LedgerResult(transaction, created=True, balance=new_balance)
+
+
+async def post_entry_async(
+    db: AsyncSession,
+    *,
+    account_id: int,
+    transaction_type: TransactionType,
+    amount: float,
+    currency: str = "points",
+    source: str,
+    source_id: Optional[str] = None,
+    description: Optional[str] = None,
+    extra_data: Optional[dict] = None,
+    idempotency_key: Optional[str] = None,
+    created_by: Optional[int] = None,
+    audit_action: Optional[str] = None,
+) -> LedgerResult:
+    """Асинхронный вариант `post_entry`."""
+    if idempotency_key:
+        existing = await find_by_idempotency_key_async(db, idempotency_key)
+        if existing:
+            return LedgerResult(existing, created=False)
+
+    row = (await db.execute(_balance_update(account_id, transaction_type, currency, amount))).first()
+    if row is None:
+        available = (await db.execute(_available_stmt(account_id, currency))).scalar_one_or_none()
+        if available is None:
+            raise AccountNotFoundError(account_id)
+        raise InsufficientFundsError(currency, available)
+
+    transaction, old_balance, new_balance = _entries(
+        row,
+        account_id=account_id, transaction_type=transaction_type, amount=amount,
+        currency=currency, source=source, source_id=source_id, description=description,
+        extra_data=extra_data, idempotency_key=idempotency_key, created_by=created_by,
+    )
+    db.add(transaction)
+    await db.flush()
+    if audit_action:
+        db.add(_audit(created_by, audit_action, transaction.id, old_balance, new_balance))
+    await db.execute(rollups.upsert_stmt([(currency, transaction_type, source, amount)]))
+    return LedgerResult(transaction, created=True, balance=new_balance)
+
+
+# Размер порции для IN (...), VALUES и многострочных INSERT в post_batch
+BATCH_CHUNK_SIZE = 5000
+
+
+@dataclass
+class BatchItemResult:
+    index: int
+    status: str  # created, duplicate, error
+    transaction_id: Optional[int] = None
+    error: Optional[str] = None
+
+
+def _chunks(seq: Sequence, size: int = BATCH_CHUNK_SIZE):
+    for start in range(0, len(seq), size):
+        yield seq[start:start + size]
+
+
+def post_batch(
+    db: Session,
+    items: Sequence,
+    *,
+    created_by: Optional[int] = None,
+    audit_action: str = "batch_transaction",
+) -> list[BatchItemResult]:
+    """
+    Пакетная проводка. `items` — объекты с полями LoyaltyTransactionCreate.
+
+    1. idempotency_key всех операций проверяются одним запросом на порцию;
+       уже записанные и повторы внутри пакета отмечаются как duplicate.
+    2. Затронутые аккаунты блокируются SELECT ... FOR UPDATE в порядке id
+       (параллельные пакеты не получат deadlock), операции применяются к
+       балансам по порядку, списания сверх остатка отклоняются.
+    3. Изменения балансов записываются одним UPDATE ... FROM (VALUES ...)
+       на порцию аккаунтов, транзакции и аудит — многострочными INSERT.
+
+    Commit — за вызывающим. IntegrityError при commit означает, что
+    параллельный запрос записал часть тех же ключей: после rollback
+    пакет можно безопасно повторить.
+    """
+    results: list[Optional[BatchItemResult]] = [None] * len(items)
+
+    # 1. Идемпотентность
+    keys = list({item.idempotency_key for item in items if item.idempotency_key})
+    existing: dict[str, int] = {}
+    for chunk in _chunks(keys):
+        existing.update(db.execute(
+            select(LoyaltyTransaction.idempotency_key, LoyaltyTransaction.id)
+            .where(LoyaltyTransaction.idempotency_key.in_(chunk))
+        ).tuples().all())
+
+    first_by_key: dict[str, int] = {}
+    repeats: dict[int, int] = {}  # индекс повтора -> индекс первой операции с тем же ключом
+    pending: list[int] = []
+    for index, item in enumerate(items):
+        key = item.idempotency_key
+        if key in existing:
+            results[index] = BatchItemResult(index, "duplicate", transaction_id=existing[key])
+            continue
+        if key:
+            if key in first_by_key:
+                repeats[index] = first_by_key[key]
+                continue
+            first_by_key[key] = index
+        try:
+            _check_entry(item.transaction_type, item.currency, item.amount)
+        except LedgerError as e:
+            results[index] = BatchItemResult(index, "error", error=str(e))
+            continue
+        pending.append(index)
+
+    # 2. Блокировка аккаунтов и расчёт балансов
+    balances: dict[int, dict] = {}
+    for chunk in _chunks(sorted({items[index].account_id for index in pending})):
+        rows = db.execute(
+            select(LoyaltyAccount.id, LoyaltyAccount.points_balance, LoyaltyAccount.cashback_balance)
+            .where(LoyaltyAccount.id.in_(chunk))
+            .order_by(LoyaltyAccount.id)
+            .with_for_update()
+        )
+        for row in rows:
+            balances[row.id] = {"points": row.points_balance, "cashback": row.cashback_balance}
+
+    deltas: dict[int, dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    transaction_rows: list[dict] = []
+    audit_balances: list[tuple[dict, dict]] = []
+    posted: list[int] = []
+    for index in pending:
+        item = items[index]
+        balance = balances.get(item.account_id)
+        if balance is None:
+            results[index] = BatchItemResult(index, "error", error=str(AccountNotFoundError(item.account_id)))
+            continue
+
+        balance_col, earned_col, spent_col = _COLUMNS[item.currency]
+        old_balance = dict(balance)
+        if item.transaction_type == TransactionType.ACCRUAL:
+            balance[item.currency] += item.amount
+            deltas[item.account_id][balance_col] += item.amount
+            deltas[item.account_id][earned_col] += item.amount
+        else:
+            if balance[item.currency] < item.amount:
+                results[index] = BatchItemResult(
+                    index, "error", error=str(InsufficientFundsError(item.currency, balance[item.currency]))
+                )
+                continue
+            balance[item.currency] -= item.amount
+            deltas[item.account_id][balance_col] -= item.amount
+            deltas[item.account_id][spent_col] += item.amount
+        deltas[item.account_id]["transactions_count"] += 1
+
+        transaction_rows.append({
+            "account_id": item.account_id,
+            "transaction_type": item.transaction_type,
+            "amount": item.amount,
+            "currency": item.currency,
+            "source": item.source,
+            "source_id": item.source_id,
+            "description": item.description,
+            "extra_data": item.metadata,
+            "idempotency_key": item.idempotency_key,
+            "created_by": created_by,
+        })
+        audit_balances.append((old_balance, dict(balance)))
+        posted.append(index)
+
+    # 3. Запись: UPDATE балансов, INSERT транзакций и аудита
+    accounts = LoyaltyAccount.__table__
+    delta_columns = [column(name, Float) for names in _COLUMNS.values() for name in names]
+    delta_columns.append(column("transactions_count", Integer))
+    for chunk in _chunks(list(deltas.items())):
+        delta_values = values(column("id", Integer), *delta_columns, name="deltas").data(
+            [(account_id, *[delta[c.name] for c in delta_columns]) for account_id, delta in chunk]
+        )
+        assignments = {accounts.c[c.name]: accounts.c[c.name] + delta_values.c[c.name] for c in delta_columns}
+        assignments[accounts.c.last_transaction_at] = func.now()
+        assignments[accounts.c.updated_at] = func.now()
+        db.execute(update(accounts).where(accounts.c.id == delta_values.c.id).values(assignments))
+
+    transaction_ids: list[int] = []
+    for chunk in _chunks(transaction_rows):
+        transaction_ids.extend(db.execute(
+            insert(LoyaltyTransaction).returning(LoyaltyTransaction.id, sort_by_parameter_order=True),
+            chunk,
+        ).scalars().all())
+
+    audit_rows = [
+        {
+            "user_id": created_by,
+            "action": audit_action,
+            "entity_type": "loyalty_transaction",
+            "entity_id": transaction_id,
+            "old_values": old_balance,
+            "new_values": new_balance,
+        }
+        for transaction_id, (old_balance, new_balance) in zip(transaction_ids, audit_balances)
+    ]
+    for chunk in _chunks(audit_rows):
+        db.execute(insert(AuditLog), chunk)
+    if transaction_rows:
+        db.execute(rollups.upsert_stmt(
+            (row["currency"], row["transaction_type"], row["source"], row["amount"]) for row in transaction_rows
+        ))
+
+    for index, transaction_id in zip(posted, transaction_ids):
+        results[index] = BatchItemResult(index, "created", transaction_id=transaction_id)
+    for index, first in repeats.items():
+        original = results[first]
+        if original.status == "error":
+            results[index] = BatchItemResult(index, "error", error=original.error)
+        else:
+            results[index] = BatchItemResult(index, "duplicate", transaction_id=original.transaction_id)
+    return results
+
+
+_LOCK_ACCOUNTS_SQL = text("""
+    SELECT max(id) FROM (
+        SELECT id FROM loyalty_accounts
+        WHERE id > :after_id
+        ORDER BY id
+        LIMIT :batch_size
+        FOR UPDATE
+    ) locked
+""")
+
+_RECONCILE_SQL = text("""
+    UPDATE loyalty_accounts a
+    SET transactions_count = actual.cnt,
+        last_transaction_at = actual.last_at
+    FROM (
+        SELECT acc.id, count(t.id) AS cnt, max(t.created_at) AS last_at
+        FROM loyalty_accounts acc
+        LEFT JOIN loyalty_transactions t ON t.account_id = acc.id
+        WHERE acc.id > :after_id AND acc.id <= :last_id
+        GROUP BY acc.id
+    ) actual
+    WHERE a.id = actual.id
+      AND (a.transactions_count IS DISTINCT FROM actual.cnt
+           OR a.last_transaction_at IS DISTINCT FROM actual.last_at)
+""")
+
+
+def reconcile_account_counters(db: Session, batch_size: int = 1000) -> int:
+    """
+    Сверка transactions_count / last_transaction_at с loyalty_transactions.
+
+    Идёт порциями по id, каждая порция — отдельная транзакция. Сначала
+    строки аккаунтов блокируются FOR UPDATE, затем отдельным оператором
+    (со свежим снимком) пересчитываются счётчики: параллельная проводка
+    либо уже закоммичена и попадёт в подсчёт, либо дождётся сверки.
+    Возвращает число исправленных аккаунтов.
+    """
+    after_id, total_fixed = 0, 0
+    while True:
+        last_id = db.execute(_LOCK_ACCOUNTS_SQL, {"after_id": after_id, "batch_size": batch_size}).scalar()
+        if last_id is None:
+            db.commit()
+            return total_fixed
+        total_fixed += db.execute(_RECONCILE_SQL, {"after_id": after_id, "last_id": last_id}).rowcount
+        db.commit()
+        after_id = last_id
@@ -7,10 +7,22 @@ import time
 import logging
 import os
 
+import certificate_status
+import certificate_token
+from circuit_breaker import breakers_status
 from config import settings
-from database import engine, Base
+from database import apply_migrations, async_engine, engine, Base
+from onec_utils import close_onec_client, get_onec_client
+from bitrix_client import close_bitrix_client, get_bitrix_client
+import password_hashing
+import qr_render
+import referral_queue
+import referral_stats
+import scheduler
+import token_store
+from redis_client import close_redis
 from routers import loyalty, certificates, referrals, auth, admin, integrations, bitrix_sso
-from routers import appointments, onec_sync
+from routers import appointments, onec_sync, exports, qrcodes
 
 # Настройка логирования
 logging.basicConfig(
@@ -24,10 +36,35 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Запуск приложения Моя ❤ скидка")
+    certificate_token.check_signing_key()
     Base.metadata.create_all(bind=engine)
+    apply_migrations()
+    qr_render.start_pool()
+    password_hashing.start_pool()
+    get_onec_client()
+    get_bitrix_client()
+    appointments.warm_catalogs()
+    await token_store.sync_revocations()
+    # Копия списка отозванных токенов нужна каждому воркеру
+    scheduler.start(
+        "token_revocations", settings.TOKEN_REVOCATION_SYNC_INTERVAL, token_store.sync_revocations, exclusive=False
+    )
+    scheduler.start("certificate_sweep", settings.CERT_SWEEP_INTERVAL, certificate_status.sweep_job)
+    scheduler.start("referral_reconcile", settings.REFERRAL_RECONCILE_INTERVAL, referral_stats.reconcile_job)
+    # Очередь делится между воркерами через SKIP LOCKED — выполняется всеми
+    scheduler.start(
+        "referral_events", settings.REFERRAL_QUEUE_POLL_INTERVAL, referral_queue.process_job, exclusive=False
+    )
     yield
     # Shutdown
     logger.info("Остановка приложения")
+    await scheduler.stop()
+    qr_render.shutdown_pool()
+    password_hashing.shutdown_pool()
+    await close_onec_client()
+    await close_bitrix_client()
+    await close_redis()
+    await async_engine.dispose()
 
 
 app = FastAPI(
@@ -83,6 +120,18 @@ async def health_check():
     }
 
 
+@app.get("/api/health/circuits")
+async def circuits_status():
+    """Состояние circuit breaker'ов внешних сервисов (1С, Bitrix)."""
+    return breakers_status()
+
+
+@app.get("/api/health/password-hashing")
+async def password_hashing_status():
+    """Очередь пула хеширования паролей (bcrypt)."""
+    return password_hashing.stats()
+
+
 # Подключение роутеров
 app.include_router(auth.router, prefix="/api/auth", tags=["Авторизация"])
 app.include_router(bitrix_sso.router, prefix="/api/auth/bitrix", tags=["Bitrix SSO"])
@@ -90,17 +139,16 @@ app.include_router(loyalty.router, prefix="/api/loyalty", tags=["Лояльно
 app.include_router(certificates.router, prefix="/api/certificates", tags=["Сертификаты"])
 app.include_router(referrals.router, prefix="/api/referrals", tags=["Рефералы"])
 app.include_router(admin.router, prefix="/api/admin", tags=["Администрирование"])
+app.include_router(exports.router, prefix="/api/admin/export", tags=["Выгрузки"])
 app.include_router(integrations.router, prefix="/api/integrations", tags=["Интеграции"])
 app.include_router(appointments.router, prefix="/api/appointments", tags=["Онлайн-запись"])
 app.include_router(onec_sync.router, prefix="/api/integrations/1c", tags=["1С Синхронизация"])
+app.include_router(qrcodes.router, prefix="/qrcodes", tags=["QR-коды"])
 
-# Статические файлы (QR-коды и uploads)
-qrcode_dir = "/app/qrcodes"
+# Статические файлы (uploads); QR-коды отдаёт роутер qrcodes
 uploads_dir = "/app/uploads"
-os.makedirs(qrcode_dir, exist_ok=True)
 os.makedirs(uploads_dir, exist_ok=True)
 
-app.mount("/qrcodes", StaticFiles(directory=qrcode_dir), name="qrcodes")
 app.mount("/uploads", StaticFiles(directory=uploads_dir), name="uploads")
 
 
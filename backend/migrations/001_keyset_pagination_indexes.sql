@@ -0,0 +1,23 @@
+-- Индексы для keyset-пагинации по (created_at, id).
+-- Индексы из init.sql повторены здесь: init.sql выполняется до того,
+-- как SQLAlchemy создаёт таблицы, и на новой БД они не появляются.
+
+CREATE INDEX IF NOT EXISTS idx_loyalty_transactions_account_created
+    ON loyalty_transactions(account_id, created_at DESC);
+
+CREATE INDEX IF NOT EXISTS idx_audit_logs_entity
+    ON audit_logs(entity_type, entity_id, created_at DESC);
+
+-- Журнал аудита без фильтра и с фильтром по типу сущности
+CREATE INDEX IF NOT EXISTS idx_audit_logs_created_id
+    ON audit_logs(created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_audit_logs_type_created_id
+    ON audit_logs(entity_type, created_at DESC, id DESC);
+
+-- Админские списки пользователей и сертификатов
+CREATE INDEX IF NOT EXISTS idx_users_created_id
+    ON users(created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_certificates_issued_id
+    ON certificates(issued_at DESC, id DESC);
@@ -0,0 +1,17 @@
+-- Денормализованный счётчик транзакций на аккаунте лояльности
+
+ALTER TABLE loyalty_accounts
+    ADD COLUMN IF NOT EXISTS transactions_count INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE loyalty_accounts
+    ADD COLUMN IF NOT EXISTS last_transaction_at TIMESTAMPTZ;
+
+UPDATE loyalty_accounts a
+SET transactions_count = t.cnt,
+    last_transaction_at = t.last_at
+FROM (
+    SELECT account_id, count(*) AS cnt, max(created_at) AS last_at
+    FROM loyalty_transactions
+    GROUP BY account_id
+) t
+WHERE a.id = t.account_id;
@@ -0,0 +1,17 @@
+-- Первичное заполнение loyalty_daily_rollups по истории транзакций.
+-- Таблицу создаёт create_all; блокировка не даёт проводкам других
+-- воркеров обновить агрегаты, пока история не перенесена.
+
+LOCK TABLE loyalty_daily_rollups IN EXCLUSIVE MODE;
+
+INSERT INTO loyalty_daily_rollups (day, currency, transaction_type, source, tx_count, amount_sum)
+SELECT (created_at AT TIME ZONE 'UTC')::date,
+       coalesce(currency, 'points'),
+       transaction_type,
+       coalesce(source, ''),
+       count(*),
+       coalesce(sum(amount), 0)
+FROM loyalty_transactions
+WHERE transaction_type IS NOT NULL
+GROUP BY 1, 2, 3, 4
+ON CONFLICT (day, currency, transaction_type, source) DO NOTHING;
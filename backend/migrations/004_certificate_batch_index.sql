@@ -0,0 +1,5 @@
+-- Поиск сертификатов пакетного выпуска по extra_data->>'batch_id'
+
+CREATE INDEX IF NOT EXISTS idx_certificates_batch_id
+    ON certificates ((extra_data ->> 'batch_id'))
+    WHERE extra_data IS NOT NULL;
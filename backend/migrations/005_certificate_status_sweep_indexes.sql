@@ -0,0 +1,7 @@
+-- Частичные индексы для сборщика статусов сертификатов (certificate_status.sweep):
+-- активные сертификаты по сроку действия и активные с нулевым остатком.
+CREATE INDEX IF NOT EXISTS idx_certificates_active_valid_until
+    ON certificates (valid_until) WHERE status = 'ACTIVE';
+
+CREATE INDEX IF NOT EXISTS idx_certificates_active_depleted
+    ON certificates (id) WHERE status = 'ACTIVE' AND current_amount <= 0;
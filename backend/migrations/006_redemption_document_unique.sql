@@ -0,0 +1,20 @@
+-- Один документ 1С — одно погашение (certificate_redemption).
+-- Погашение на кассе полагается на этот индекс: без него повтор запроса
+-- с тем же номером документа списал бы остаток дважды. Если в истории
+-- уже есть дубли, миграция падает (и не записывается в schema_migrations):
+-- приложение не запускается, пока дубли не разобраны вручную.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM certificate_redemptions
+        WHERE onec_document_id IS NOT NULL
+        GROUP BY onec_document_id HAVING count(*) > 1
+    ) THEN
+        RAISE EXCEPTION 'certificate_redemptions: есть повторяющиеся onec_document_id, уникальный индекс не создан'
+            USING HINT = 'SELECT onec_document_id, count(*) FROM certificate_redemptions WHERE onec_document_id IS NOT NULL GROUP BY 1 HAVING count(*) > 1';
+    END IF;
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_certificate_redemptions_onec_document_id
+        ON certificate_redemptions (onec_document_id)
+        WHERE onec_document_id IS NOT NULL;
+END
+$$;
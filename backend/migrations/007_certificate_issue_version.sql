@@ -0,0 +1,4 @@
+-- Версия выпуска сертификата, входит в подпись QR-кода (certificate_token)
+
+ALTER TABLE certificates
+    ADD COLUMN IF NOT EXISTS issue_version INTEGER NOT NULL DEFAULT 1;
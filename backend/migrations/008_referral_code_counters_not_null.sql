@@ -0,0 +1,18 @@
+-- Счётчики реферальных кодов обновляются приращением (referral_stats):
+-- NULL + 1 = NULL, поэтому колонки становятся NOT NULL DEFAULT 0
+
+UPDATE referral_codes
+SET total_referrals = coalesce(total_referrals, 0),
+    successful_referrals = coalesce(successful_referrals, 0),
+    total_revenue = coalesce(total_revenue, 0)
+WHERE total_referrals IS NULL
+   OR successful_referrals IS NULL
+   OR total_revenue IS NULL;
+
+ALTER TABLE referral_codes
+    ALTER COLUMN total_referrals SET DEFAULT 0,
+    ALTER COLUMN total_referrals SET NOT NULL,
+    ALTER COLUMN successful_referrals SET DEFAULT 0,
+    ALTER COLUMN successful_referrals SET NOT NULL,
+    ALTER COLUMN total_revenue SET DEFAULT 0,
+    ALTER COLUMN total_revenue SET NOT NULL;
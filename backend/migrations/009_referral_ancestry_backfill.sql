@@ -0,0 +1,31 @@
+-- Первичное заполнение referral_ancestry (referral_tree) по истории
+-- регистраций. Таблицу создаёт create_all. Прямой реферер — владелец кода
+-- первого события REGISTRATION пользователя; глубина ограничена 5
+-- (REFERRAL_MAX_DEPTH по умолчанию).
+
+WITH RECURSIVE direct AS (
+    SELECT DISTINCT ON (e.referred_user_id)
+           e.referred_user_id AS user_id,
+           c.user_id AS referrer_id
+    FROM referral_events e
+    JOIN referral_codes c ON c.id = e.referral_code_id
+    WHERE e.event_type = 'REGISTRATION'
+      AND e.referred_user_id IS NOT NULL
+      AND c.user_id IS NOT NULL
+      AND c.user_id <> e.referred_user_id
+    ORDER BY e.referred_user_id, e.occurred_at, e.id
+),
+chain AS (
+    SELECT user_id, 1 AS depth, referrer_id AS ancestor_id
+    FROM direct
+    UNION ALL
+    SELECT chain.user_id, chain.depth + 1, direct.referrer_id
+    FROM chain
+    JOIN direct ON direct.user_id = chain.ancestor_id
+    WHERE chain.depth < 5
+      AND direct.referrer_id <> chain.user_id
+)
+INSERT INTO referral_ancestry (descendant_user_id, depth, ancestor_user_id)
+SELECT user_id, depth, ancestor_id
+FROM chain
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,11 @@
+-- Очередь обработки реферальных событий (referral_queue): счётчик попыток,
+-- последняя ошибка и время следующей попытки; частичный индекс по
+-- необработанным событиям для выборки порций.
+
+ALTER TABLE referral_events
+    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_error TEXT,
+    ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_referral_events_pending
+    ON referral_events (id) WHERE processed = false;
@@ -0,0 +1,18 @@
+-- Прежняя версия 006 при дублях onec_document_id только предупреждала и
+-- записывалась как применённая без индекса. Индекс обязателен: создаём его
+-- здесь, а при оставшихся дублях миграция падает, как и 006.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM certificate_redemptions
+        WHERE onec_document_id IS NOT NULL
+        GROUP BY onec_document_id HAVING count(*) > 1
+    ) THEN
+        RAISE EXCEPTION 'certificate_redemptions: есть повторяющиеся onec_document_id, уникальный индекс не создан'
+            USING HINT = 'SELECT onec_document_id, count(*) FROM certificate_redemptions WHERE onec_document_id IS NOT NULL GROUP BY 1 HAVING count(*) > 1';
+    END IF;
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_certificate_redemptions_onec_document_id
+        ON certificate_redemptions (onec_document_id)
+        WHERE onec_document_id IS NOT NULL;
+END
+$$;
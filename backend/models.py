@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, Enum, JSON
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, Boolean, ForeignKey, Text, Enum, JSON
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -85,6 +85,10 @@ class LoyaltyAccount(Base):
     total_cashback_earned = Column(Float, default=0.0)
     total_cashback_spent = Column(Float, default=0.0)
     
+    # Счётчик транзакций, ведётся ledger (сверка — reconcile_account_counters)
+    transactions_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_transaction_at = Column(DateTime(timezone=True), nullable=True)
+    
     # Карта лояльности
     card_number = Column(String, unique=True, index=True, nullable=True)
     card_tier = Column(String, default="bronze")  # bronze, silver, gold, platinum
@@ -128,6 +132,19 @@ class LoyaltyTransaction(Base):
     account = relationship("LoyaltyAccount", back_populates="transactions")
 
 
+class LoyaltyDailyRollup(Base):
+    """Дневные агрегаты транзакций лояльности для отчётов (день — по UTC)"""
+    __tablename__ = "loyalty_daily_rollups"
+
+    day = Column(Date, primary_key=True)
+    currency = Column(String, primary_key=True)
+    transaction_type = Column(Enum(TransactionType), primary_key=True)
+    source = Column(String, primary_key=True)  # '' если источник не указан
+    
+    tx_count = Column(Integer, nullable=False, default=0)
+    amount_sum = Column(Float, nullable=False, default=0.0)
+
+
 # === МОДЕЛИ СЕРТИФИКАТОВ ===
 
 class Certificate(Base):
@@ -146,6 +163,7 @@ class Certificate(Base):
     
     # Статус
     status = Column(Enum(CertificateStatus), default=CertificateStatus.ACTIVE)
+    issue_version = Column(Integer, nullable=False, default=1, server_default="1")  # Версия выпуска в подписи QR
     
     # Владение
     owner_id = Column(Integer, ForeignKey("users.id"))
@@ -218,10 +236,10 @@ class ReferralCode(Base):
     # Тип реферала
     referrer_type = Column(String)  # patient, doctor
     
-    # Статистика
-    total_referrals = Column(Integer, default=0)
-    successful_referrals = Column(Integer, default=0)  # Завершили первый визит
-    total_revenue = Column(Float, default=0.0)  # Общая выручка от рефералов
+    # Статистика, ведётся referral_stats (сверка — reconcile_referral_counters)
+    total_referrals = Column(Integer, nullable=False, default=0, server_default="0")
+    successful_referrals = Column(Integer, nullable=False, default=0, server_default="0")  # Завершили первый визит
+    total_revenue = Column(Float, nullable=False, default=0.0, server_default="0")  # Общая выручка от рефералов
     
     is_active = Column(Boolean, default=True)
     
@@ -252,6 +270,11 @@ class ReferralEvent(Base):
     
     processed = Column(Boolean, default=False)  # Обработано ли вознаграждение
     
+    # Очередь обработки (referral_queue)
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)
+    
     occurred_at = Column(DateTime(timezone=True), server_default=func.now())
     extra_data = Column(JSON, nullable=True)
     
@@ -284,6 +307,15 @@ class ReferralReward(Base):
     event = relationship("ReferralEvent", back_populates="rewards")
 
 
+class ReferralAncestry(Base):
+    """Замыкание дерева рефералов: предки пользователя до REFERRAL_MAX_DEPTH уровней (ведёт referral_tree)"""
+    __tablename__ = "referral_ancestry"
+
+    descendant_user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    depth = Column(Integer, primary_key=True)  # 1 — прямой реферер
+    ancestor_user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+
+
 class RewardRule(Base):
     """Правила начисления вознаграждений"""
     __tablename__ = "reward_rules"
@@ -1,12 +1,128 @@
 """Общие утилиты для работы с 1С OData API."""
+from __future__ import annotations
+
+from typing import Any, Optional, Sequence
+
+import httpx
+
+from circuit_breaker import get_breaker
 from config import settings
 
+ODATA_PREFIX = "odata/standard.odata"
+
 
 def odata_url(entity: str) -> str:
     """Строит URL до OData-сущности 1С."""
     base = (settings.ONEC_API_URL or "").rstrip("/")
-    return f"{base}/odata/standard.odata/{entity}"
+    return f"{base}/{ODATA_PREFIX}/{entity}"
 
 
 def odata_auth() -> tuple[str, str]:
     return (settings.ONEC_USERNAME or "", settings.ONEC_PASSWORD or "")
+
+
+class OneCClient:
+    """
+    Общий клиент 1С с пулом keep-alive соединений.
+
+    Создаётся один раз в `main.lifespan` и переиспользуется всеми роутерами,
+    чтобы не открывать TCP/TLS-соединение через VPN на каждый запрос.
+    Все запросы идут через circuit breaker "1c": пока 1С недоступна,
+    вызовы сразу завершаются CircuitOpenError вместо ожидания таймаута.
+    """
+
+    def __init__(self):
+        base = (settings.ONEC_API_URL or "").rstrip("/") + "/"
+        self._http = httpx.AsyncClient(
+            base_url=base,
+            auth=odata_auth(),
+            timeout=settings.ONEC_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.ONEC_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.ONEC_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=settings.ONEC_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    async def _send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        async with get_breaker("1c"):
+            resp = await self._http.request(method, url, **kwargs)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+        return resp
+
+    async def query(
+        self,
+        entity: str,
+        *,
+        filter: Optional[str] = None,
+        select: Optional[Sequence[str]] = None,
+        top: Optional[int] = None,
+        skip: Optional[int] = None,
+        orderby: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> list[dict[str, Any]]:
+        """GET к OData-сущности. Возвращает список записей из поля `value`."""
+        params: dict[str, str] = {"$format": "json"}
+        if filter:
+            params["$filter"] = filter
+        if select:
+            params["$select"] = ",".join(select)
+        if top is not None:
+            params["$top"] = str(top)
+        if skip is not None:
+            params["$skip"] = str(skip)
+        if orderby:
+            params["$orderby"] = orderby
+
+        resp = await self._send(
+            "GET",
+            f"{ODATA_PREFIX}/{entity}",
+            params=params,
+            timeout=timeout or settings.ONEC_TIMEOUT,
+        )
+        resp.raise_for_status()
+        return resp.json().get("value", [])
+
+    async def create(
+        self,
+        entity: str,
+        payload: dict[str, Any],
+        *,
+        timeout: Optional[float] = None,
+    ) -> httpx.Response:
+        """POST новой записи в OData-сущность. Статус ответа проверяет вызывающий код."""
+        return await self._send(
+            "POST",
+            f"{ODATA_PREFIX}/{entity}",
+            json=payload,
+            params={"$format": "json"},
+            headers={"Content-Type": "application/json"},
+            timeout=timeout or settings.ONEC_TIMEOUT,
+        )
+
+    async def get(self, path: str, *, timeout: Optional[float] = None) -> httpx.Response:
+        """GET к HTTP-сервису 1С вне OData (путь относительно ONEC_API_URL)."""
+        return await self._send("GET", path.lstrip("/"), timeout=timeout or settings.ONEC_TIMEOUT)
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+
+_client: OneCClient | None = None
+
+
+def get_onec_client() -> OneCClient:
+    """Возвращает общий клиент 1С (создаётся при первом обращении)."""
+    global _client
+    if _client is None:
+        _client = OneCClient()
+    return _client
+
+
+async def close_onec_client() -> None:
+    """Закрывает пул соединений к 1С (вызывается при остановке приложения)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,60 @@
+"""
+Keyset-пагинация по (created_at, id).
+
+Вместо OFFSET клиент передаёт непрозрачный курсор — позицию последней
+записи предыдущей страницы. Запрос страницы идёт по индексу с
+`created_at <= :ts` и не зависит от глубины; отдельный count() не нужен.
+
+Курсор — base64url от JSON `[created_at в ISO, id]`.
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import and_, desc, or_
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (binascii.Error, ValueError, TypeError, UnicodeDecodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Некорректный курсор пагинации"
+        )
+
+
+def keyset_page(query, created_col, id_col, cursor: Optional[str], page_size: int):
+    """
+    Страница ORM-запроса `query` от новых к старым.
+
+    Возвращает (записи, next_cursor); next_cursor = None на последней странице.
+    Условие записано как `created_at <= ts AND (created_at < ts OR id < :id)`,
+    чтобы первая часть шла в индексное условие по (…, created_at DESC).
+    """
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.filter(
+            created_col <= created_at,
+            or_(created_col < created_at, and_(created_col == created_at, id_col < row_id)),
+        )
+
+    rows = query.order_by(desc(created_col), desc(id_col)).limit(page_size + 1).all()
+    if len(rows) <= page_size:
+        return rows, None
+
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, created_col.key), getattr(last, id_col.key))
@@ -0,0 +1,131 @@
+"""
+Хеширование и проверка паролей (bcrypt) в пуле процессов.
+
+bcrypt — около 250 мс чистого CPU на операцию. В потоке обработчика он
+конкурировал за GIL с остальными запросами, а в async-обработчике
+останавливал event loop. Операции выполняются в отдельном
+ProcessPoolExecutor (PASSWORD_HASH_WORKERS процессов, spawn, как у
+qr_render): одновременно хешируется не больше паролей, чем процессов,
+остальные ждут в очереди пула. Очередь ограничена
+PASSWORD_HASH_MAX_PENDING операциями — сверх этого вызов сразу получает
+PasswordHashingBusy (эндпоинт отвечает 503), а не копит ожидание.
+
+Вызовы синхронные: вызывающий поток (threadpool обработчика) ждёт
+результат, не занимая CPU и GIL. Счётчики очереди — `stats()`,
+эндпоинт /api/health/password-hashing.
+
+Пользователи без пароля (вход через Bitrix SSO) получают
+UNUSABLE_PASSWORD: такой хеш не создаётся и никогда не совпадает,
+проверка отвечает False без обращения к пулу.
+"""
+from __future__ import annotations
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+from config import settings
+
+# Не может быть результатом bcrypt (тот начинается с "$2")
+UNUSABLE_PASSWORD = "!"
+BCRYPT_MAX_BYTES = 72
+
+
+class PasswordHashingBusy(Exception):
+    """Очередь хеширования паролей переполнена."""
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+_pending = 0  # отправлено в пул и не завершено (выполняются + ждут)
+_peak_pending = 0
+_completed = 0
+_rejected = 0
+_total_seconds = 0.0
+
+
+def _hash(password: bytes) -> bytes:
+    """Выполняется в дочернем процессе"""
+    return bcrypt.hashpw(password, bcrypt.gensalt())
+
+
+def _check(password: bytes, hashed: bytes) -> bool:
+    """Выполняется в дочернем процессе"""
+    try:
+        return bcrypt.checkpw(password, hashed)
+    except ValueError:
+        # Повреждённый или не-bcrypt хеш
+        return False
+
+
+def _encode(password: str) -> bytes:
+    # bcrypt учитывает только первые 72 байта; passlib, которым созданы
+    # существующие хеши, так же отбрасывал остальное, а bcrypt>=5 вместо
+    # этого бросает ValueError
+    return password.encode("utf-8")[:BCRYPT_MAX_BYTES]
+
+
+def start_pool() -> None:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.PASSWORD_HASH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _run(fn, *args):
+    global _pending, _peak_pending, _completed, _rejected, _total_seconds
+    with _lock:
+        if _pending >= settings.PASSWORD_HASH_MAX_PENDING:
+            _rejected += 1
+            raise PasswordHashingBusy("Очередь хеширования паролей переполнена")
+        _pending += 1
+        _peak_pending = max(_peak_pending, _pending)
+    started = time.monotonic()
+    try:
+        start_pool()
+        return _pool.submit(fn, *args).result()
+    finally:
+        with _lock:
+            _pending -= 1
+            _completed += 1
+            _total_seconds += time.monotonic() - started
+
+
+def hash_password(password: str) -> str:
+    return _run(_hash, _encode(password)).decode("utf-8")
+
+
+def check_password(password: str, hashed: Optional[str]) -> bool:
+    if not hashed or hashed.startswith(UNUSABLE_PASSWORD):
+        return False
+    return _run(_check, _encode(password), hashed.encode("utf-8"))
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            "workers": settings.PASSWORD_HASH_WORKERS,
+            "max_pending": settings.PASSWORD_HASH_MAX_PENDING,
+            "in_flight": _pending,
+            "queued": max(_pending - settings.PASSWORD_HASH_WORKERS, 0),
+            "peak_in_flight": _peak_pending,
+            "completed": _completed,
+            "rejected": _rejected,
+            # Среднее время операции вместе с ожиданием в очереди
+            "avg_ms": round(_total_seconds / _completed * 1000, 1) if _completed else None,
+        }
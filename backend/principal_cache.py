@@ -0,0 +1,157 @@
+"""
+Кеш аутентифицированного пользователя (principal) для get_current_user.
+
+Для проверки прав эндпоинтам нужны только id, роль и is_active. Снимок
+хранится в двух уровнях:
+  L1 — LRU в памяти процесса (PRINCIPAL_CACHE_L1_SIZE записей) на
+       PRINCIPAL_CACHE_L1_TTL секунд: горячие запросы не ходят даже в Redis;
+  L2 — Redis, ключ auth:principal:{id}, на PRINCIPAL_CACHE_TTL секунд.
+Промах обоих уровней — один SELECT трёх колонок.
+
+Изменения активности и роли сбрасывают снимок через `invalidate`: L1
+текущего процесса и L2 сразу, L1 других воркеров — по истечении
+PRINCIPAL_CACHE_L1_TTL. Правка users напрямую в БД видна не позже
+PRINCIPAL_CACHE_TTL. Если Redis недоступен, работают L1 и БД.
+
+Чтобы снимок, прочитанный из БД до изменения, не вернулся в кеш уже
+после `invalidate`, у каждого пользователя есть счётчик поколений
+auth:principal:gen:{id}: `invalidate` увеличивает его, а `get` читает
+счётчик до запроса к БД и записывает снимок (Lua-скриптом) только если
+поколение с тех пор не сменилось.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from redis.exceptions import RedisError
+from sqlalchemy import bindparam, select
+
+from config import settings
+from database import AsyncSessionLocal
+from models import User
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "auth:principal:"
+GENERATION_PREFIX = "auth:principal:gen:"
+GENERATION_TTL = 86400  # сек; счётчик должен пережить любой запрос к БД в `get`
+
+# Запись снимка, только если поколение не изменилось с момента чтения
+# (отсутствующий счётчик передаётся пустой строкой)
+_SET_IF_GENERATION_LUA = """
+local generation = redis.call("GET", KEYS[2]) or ""
+if generation == ARGV[1] then
+    redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+    return 1
+end
+return 0
+"""
+
+_PRINCIPAL_STMT = select(User.id, User.role, User.is_active).where(User.id == bindparam("b_id"))
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Снимок пользователя для проверки прав"""
+    id: int
+    role: str
+    is_active: bool
+
+
+# user_id -> (снимок, момент истечения по time.monotonic)
+_local: OrderedDict[int, tuple[Principal, float]] = OrderedDict()
+
+
+def _key(user_id: int) -> str:
+    return f"{KEY_PREFIX}{user_id}"
+
+
+def _generation_key(user_id: int) -> str:
+    return f"{GENERATION_PREFIX}{user_id}"
+
+
+def _get_local(user_id: int) -> Optional[Principal]:
+    entry = _local.get(user_id)
+    if entry is None:
+        return None
+    principal, expires_at = entry
+    if expires_at < time.monotonic():
+        _local.pop(user_id, None)
+        return None
+    _local.move_to_end(user_id)
+    return principal
+
+
+def _put_local(principal: Principal) -> None:
+    _local[principal.id] = (principal, time.monotonic() + settings.PRINCIPAL_CACHE_L1_TTL)
+    _local.move_to_end(principal.id)
+    while len(_local) > settings.PRINCIPAL_CACHE_L1_SIZE:
+        _local.popitem(last=False)
+
+
+async def get(user_id: int) -> Optional[Principal]:
+    """Снимок пользователя; None — пользователя нет"""
+    principal = _get_local(user_id)
+    if principal is not None:
+        return principal
+
+    redis = get_redis()
+    try:
+        raw, generation = await redis.mget(_key(user_id), _generation_key(user_id))
+    except RedisError as e:
+        logger.warning(f"Redis недоступен, пользователь {user_id} читается из БД: {e}")
+        raw, generation = None, None
+    else:
+        generation = generation or b""
+    if raw is not None:
+        principal = Principal(id=user_id, **json.loads(raw))
+        _put_local(principal)
+        return principal
+
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(_PRINCIPAL_STMT, {"b_id": user_id})).first()
+    if row is None:
+        return None
+    principal = Principal(id=row.id, role=row.role, is_active=bool(row.is_active))
+    if generation is None:
+        # Redis недоступен: поколение неизвестно, снимок живёт только в L1
+        _put_local(principal)
+        return principal
+    try:
+        stored = await redis.register_script(_SET_IF_GENERATION_LUA)(
+            keys=[_key(user_id), _generation_key(user_id)],
+            args=[
+                generation,
+                json.dumps({"role": principal.role, "is_active": principal.is_active}),
+                settings.PRINCIPAL_CACHE_TTL,
+            ],
+        )
+    except RedisError as e:
+        logger.warning(f"Не удалось сохранить пользователя {user_id} в кеш: {e}")
+        stored = True
+    if stored:
+        _put_local(principal)
+    return principal
+
+
+async def invalidate(*user_ids: int) -> None:
+    """Сброс снимков после commit изменения роли или активности"""
+    for user_id in user_ids:
+        _local.pop(user_id, None)
+    if not user_ids:
+        return
+    try:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            for user_id in user_ids:
+                pipe.incr(_generation_key(user_id))
+                pipe.expire(_generation_key(user_id), GENERATION_TTL)
+            pipe.delete(*(_key(user_id) for user_id in user_ids))
+            await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Не удалось сбросить кеш пользователей {user_ids}: {e}")
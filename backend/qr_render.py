@@ -0,0 +1,116 @@
+"""
+Рендеринг PNG с QR-кодами сертификатов в пуле процессов.
+
+qrcode + PIL — чистая нагрузка на CPU, в обработчике запроса она занимала
+поток threadpool и GIL. Рендер выполняется в ProcessPoolExecutor
+(QR_RENDER_WORKERS процессов), который создаётся в `main.lifespan`.
+
+Функции, исполняемые в дочерних процессах, не импортируют ничего, кроме
+qrcode и os: процессы запускаются через spawn и не тянут за собой
+движки БД и event loop родителя. Содержимое QR (подписанная ссылка,
+см. certificate_token) передаётся вызывающим кодом, путь к файлу
+определяет qr_storage по ключу содержимого.
+"""
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Sequence
+
+import qrcode
+
+from config import settings
+from qr_storage import get_storage
+
+CODE_PATTERN = re.compile(r"^CERT-[0-9A-F]{16}$")
+RENDER_CHUNK_SIZE = 50  # QR-кодов на одну задачу пула при пакетном рендере
+
+_pool: Optional[ProcessPoolExecutor] = None
+_in_flight: dict[str, asyncio.Future] = {}  # ключ содержимого -> рендер
+
+
+def _render_png(data: str, path: str) -> str:
+    """Выполняется в дочернем процессе: рендер и атомарная запись файла"""
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    img.save(tmp_path, format="PNG")
+    os.replace(tmp_path, path)
+    return path
+
+
+def _render_png_batch(items: list[tuple[str, str]]) -> int:
+    """Выполняется в дочернем процессе: рендер порции QR-кодов"""
+    for data, path in items:
+        _render_png(data, path)
+    return len(items)
+
+
+def qr_code_url(code: str) -> str:
+    return f"https://{settings.DOMAIN}/qrcodes/{code}.png"
+
+
+def start_pool() -> None:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.QR_RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def render(content: str) -> str:
+    """
+    Рендер QR-кода, если файла с таким содержимым ещё нет. Возвращает путь к PNG.
+
+    Одновременные запросы одного содержимого (фоновая задача после создания
+    и запрос картинки клиентом) ждут один и тот же рендер.
+    """
+    storage = get_storage()
+    key = storage.key_for(content)
+    path = storage.local_path(key)
+    if os.path.exists(path):
+        return path
+
+    future = _in_flight.get(key)
+    if future is None:
+        start_pool()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_pool, _render_png, content, path)
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+    return await asyncio.shield(future)
+
+
+async def render_many(contents: Sequence[str]) -> list[str]:
+    """
+    Рендер QR-кодов пакета порциями по всем процессам пула; готовые файлы
+    пропускаются. Возвращает пути к PNG в порядке `contents`.
+    """
+    storage = get_storage()
+    paths = [storage.local_path(storage.key_for(content)) for content in contents]
+    missing = [(content, path) for content, path in zip(contents, paths) if not os.path.exists(path)]
+    if not missing:
+        return paths
+
+    start_pool()
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[
+        loop.run_in_executor(_pool, _render_png_batch, missing[start:start + RENDER_CHUNK_SIZE])
+        for start in range(0, len(missing), RENDER_CHUNK_SIZE)
+    ])
+    return paths
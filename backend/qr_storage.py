@@ -0,0 +1,89 @@
+"""
+Хранилище PNG с QR-кодами сертификатов.
+
+Файл адресуется содержимым QR-кода: ключ — sha256 закодированной строки,
+путь — QR_CODE_DIR/ab/cd/<ключ>.png. Два уровня подкаталогов по 256
+держат в каждом каталоге сотни файлов даже при миллионах сертификатов.
+Одинаковое содержимое всегда даёт один и тот же PNG, поэтому файл по
+ключу неизменяем: ключ служит strong ETag, а адрес
+/qrcodes/sha256/<ключ>.png кешируется навсегда (immutable). Перевыпуск
+сертификата меняет подписанное содержимое, а значит и ключ.
+
+Режимы отдачи (QR_SERVE_MODE):
+  direct  — байты отдаёт приложение (FileResponse);
+  x-accel — приложение отвечает только заголовками, а файл отдаёт nginx
+            через X-Accel-Redirect во внутренний location QR_ACCEL_PREFIX.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+
+from config import settings
+
+KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class QRStorage(ABC):
+    """Интерфейс хранилища: ключ содержимого → файл и HTTP-ответ с ним"""
+
+    def key_for(self, content: str) -> str:
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @abstractmethod
+    def relative_path(self, key: str) -> str:
+        """Путь файла относительно корня хранилища"""
+
+    @abstractmethod
+    def local_path(self, key: str) -> str:
+        """Путь, по которому рендер записывает файл"""
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.local_path(key))
+
+    @abstractmethod
+    def response(self, key: str, request: Request, cache_control: str) -> Response:
+        """Ответ с файлом по ключу (304 при совпадении ETag)"""
+
+
+class ShardedFileStorage(QRStorage):
+    """Локальный каталог с шардированием по первым байтам ключа"""
+
+    def __init__(self, root: str, serve_mode: str = "direct", accel_prefix: Optional[str] = None):
+        if serve_mode not in ("direct", "x-accel"):
+            raise ValueError(f"Неизвестный режим отдачи QR-кодов: {serve_mode}")
+        self.root = root
+        self.serve_mode = serve_mode
+        self.accel_prefix = (accel_prefix or "").rstrip("/")
+
+    def relative_path(self, key: str) -> str:
+        return f"{key[:2]}/{key[2:4]}/{key}.png"
+
+    def local_path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], f"{key}.png")
+
+    def response(self, key: str, request: Request, cache_control: str) -> Response:
+        headers = {"ETag": f'"{key}"', "Cache-Control": cache_control}
+        if key in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        if self.serve_mode == "x-accel":
+            headers["X-Accel-Redirect"] = f"{self.accel_prefix}/{self.relative_path(key)}"
+            return Response(media_type="image/png", headers=headers)
+        return FileResponse(self.local_path(key), media_type="image/png", headers=headers)
+
+
+_storage: Optional[QRStorage] = None
+
+
+def get_storage() -> QRStorage:
+    global _storage
+    if _storage is None:
+        _storage = ShardedFileStorage(settings.QR_CODE_DIR, settings.QR_SERVE_MODE, settings.QR_ACCEL_PREFIX)
+    return _storage
@@ -0,0 +1,28 @@
+"""Общий асинхронный клиент Redis (кеши, счётчики, блокировки)."""
+from __future__ import annotations
+
+import redis.asyncio as aioredis
+
+from config import settings
+
+_redis: aioredis.Redis | None = None
+
+
+def get_redis() -> aioredis.Redis:
+    """Возвращает общий клиент Redis (создаётся при первом обращении)."""
+    global _redis
+    if _redis is None:
+        _redis = aioredis.Redis.from_url(
+            settings.REDIS_URL,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        )
+    return _redis
+
+
+async def close_redis() -> None:
+    """Закрывает пул соединений Redis (вызывается при остановке приложения)."""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
@@ -0,0 +1,153 @@
+"""
+Обработка реферальных событий в фоне.
+
+Регистрация, SSO и касса только записывают ReferralEvent (processed=false)
+и отвечают; вознаграждения начисляет обработчик очереди. Каждый воркер
+uvicorn раз в REFERRAL_QUEUE_POLL_INTERVAL забирает порции событий
+SELECT ... FOR UPDATE SKIP LOCKED: воркеры не мешают друг другу и не
+обрабатывают одно событие дважды. Порция — одна транзакция: вознаграждения
+всех событий проводятся одним reward_engine.apply_rewards, события
+отмечаются processed одним UPDATE.
+
+Если порция падает, события повторяются по одному (каждое в своей точке
+сохранения), чтобы ошибка одного не задерживала остальные. У упавшего
+события растёт attempts, в last_error пишется ошибка, следующая попытка —
+через REFERRAL_QUEUE_RETRY_DELAY × 2^(attempts−1), не чаще раза в час.
+После REFERRAL_QUEUE_MAX_ATTEMPTS попыток событие больше не берётся;
+вернуть такие события в очередь — scripts/process_referral_events.py --retry-failed.
+
+Повторная обработка безопасна: проводки вознаграждений идемпотентны по
+(событие, правило).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Sequence
+
+from sqlalchemy import bindparam, func, or_, select, update
+from sqlalchemy.orm import Session
+
+import reward_engine
+from config import settings
+from database import SessionLocal
+from models import LoyaltyAccount, ReferralCode, ReferralEvent
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_DELAY = 3600
+
+_CLAIM_STMT = (
+    select(
+        ReferralEvent.id,
+        ReferralEvent.event_type,
+        ReferralEvent.transaction_amount,
+        ReferralCode.user_id,
+        ReferralCode.referrer_type,
+        LoyaltyAccount.id.label("account_id"),
+    )
+    .join(ReferralCode, ReferralCode.id == ReferralEvent.referral_code_id)
+    .outerjoin(LoyaltyAccount, LoyaltyAccount.user_id == ReferralCode.user_id)
+    .where(
+        ReferralEvent.processed == False,
+        ReferralEvent.attempts < bindparam("b_max_attempts"),
+        or_(ReferralEvent.next_attempt_at.is_(None), ReferralEvent.next_attempt_at <= func.now()),
+    )
+    .order_by(ReferralEvent.id)
+    .limit(bindparam("b_limit"))
+    .with_for_update(of=ReferralEvent, skip_locked=True)
+)
+
+_DONE_STMT = (
+    update(ReferralEvent)
+    .where(ReferralEvent.id.in_(bindparam("b_ids", expanding=True)))
+    .values(processed=True, attempts=ReferralEvent.attempts + 1, last_error=None, next_attempt_at=None)
+    .execution_options(synchronize_session=False)
+)
+
+_FAILED_STMT = (
+    update(ReferralEvent)
+    .where(ReferralEvent.id == bindparam("b_id"))
+    .values(
+        attempts=ReferralEvent.attempts + 1,
+        last_error=bindparam("b_error"),
+        next_attempt_at=func.now() + func.make_interval(
+            0, 0, 0, 0, 0, 0,
+            func.least(bindparam("b_delay") * func.power(2, ReferralEvent.attempts), MAX_RETRY_DELAY),
+        ),
+    )
+    .execution_options(synchronize_session=False)
+)
+
+
+def _target(row) -> reward_engine.RewardTarget:
+    return reward_engine.RewardTarget(
+        event_id=row.id,
+        event_type=row.event_type,
+        transaction_amount=row.transaction_amount,
+        recipient_user_id=row.user_id,
+        referrer_type=row.referrer_type,
+        account_id=row.account_id,
+    )
+
+
+def _apply(db: Session, rows: Sequence) -> None:
+    with db.begin_nested():
+        reward_engine.apply_rewards(db, [_target(row) for row in rows])
+        db.execute(_DONE_STMT, {"b_ids": [row.id for row in rows]})
+
+
+def process_batch(db: Session, batch_size: int) -> tuple[int, int]:
+    """
+    Одна порция очереди в одной транзакции (с commit).
+    Возвращает (взято событий, из них с ошибкой).
+    """
+    rows = db.execute(
+        _CLAIM_STMT, {"b_max_attempts": settings.REFERRAL_QUEUE_MAX_ATTEMPTS, "b_limit": batch_size}
+    ).all()
+    if not rows:
+        db.commit()
+        return 0, 0
+
+    failed = 0
+    try:
+        _apply(db, rows)
+    except Exception as e:
+        logger.warning(f"Порция реферальных событий не обработана, повтор по одному: {e}")
+        for row in rows:
+            try:
+                _apply(db, [row])
+            except Exception as e:
+                failed += 1
+                logger.error(f"Ошибка обработки реферального события {row.id}: {e}")
+                db.execute(_FAILED_STMT, {
+                    "b_id": row.id, "b_error": str(e)[:2000], "b_delay": settings.REFERRAL_QUEUE_RETRY_DELAY,
+                })
+    db.commit()
+    return len(rows), failed
+
+
+def drain(db: Session, batch_size: int) -> tuple[int, int]:
+    """Обработка порциями, пока в очереди есть готовые события"""
+    total, total_failed = 0, 0
+    while True:
+        taken, failed = process_batch(db, batch_size)
+        total += taken
+        total_failed += failed
+        if taken < batch_size:
+            return total, total_failed
+
+
+def _drain_in_session() -> tuple[int, int]:
+    db = SessionLocal()
+    try:
+        return drain(db, settings.REFERRAL_QUEUE_BATCH_SIZE)
+    finally:
+        db.close()
+
+
+async def process_job() -> None:
+    """Периодическая задача (scheduler, во всех воркерах): обработка очереди"""
+    taken, failed = await asyncio.to_thread(_drain_in_session)
+    if taken:
+        logger.info(f"Обработано реферальных событий: {taken - failed}, с ошибкой: {failed}")
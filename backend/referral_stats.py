@@ -0,0 +1,145 @@
+"""
+Счётчики статистики реферальных кодов.
+
+total_referrals, successful_referrals и total_revenue в referral_codes
+меняются одним UPDATE с приращением прямо в БД (`x = x + :delta`), без
+чтения кода в Python: параллельные регистрации по коду популярного врача
+не теряют обновлений. UPDATE — последний оператор перед commit
+вызывающего, блокировка строки кода держится только на время commit.
+
+Счётчики выводятся из referral_events: каждое событие +1 к
+total_referrals, FIRST_VISIT — ещё +1 к successful_referrals, сумма
+transaction_amount — total_revenue. Расхождения (ручные правки, старые
+данные, потерянные до перехода на приращения обновления) исправляет
+`reconcile_referral_counters` — периодическая задача и
+scripts/reconcile_referral_counters.py.
+
+Функции не коммитят.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Optional
+
+from sqlalchemy import Float, Integer, bindparam, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config import settings
+from database import SessionLocal
+from models import ReferralCode, ReferralEventType
+
+logger = logging.getLogger(__name__)
+
+_INCREMENT_STMT = (
+    update(ReferralCode)
+    .where(ReferralCode.id == bindparam("b_id"))
+    .values(
+        total_referrals=ReferralCode.total_referrals + 1,
+        successful_referrals=ReferralCode.successful_referrals + bindparam("b_successful", type_=Integer),
+        total_revenue=ReferralCode.total_revenue + bindparam("b_revenue", type_=Float),
+    )
+    .returning(ReferralCode.total_referrals)
+    .execution_options(synchronize_session=False)
+)
+
+
+def _increment_params(
+    referral_code_id: int, event_type: ReferralEventType, transaction_amount: Optional[float]
+) -> dict:
+    return {
+        "b_id": referral_code_id,
+        "b_successful": 1 if event_type == ReferralEventType.FIRST_VISIT else 0,
+        "b_revenue": transaction_amount or 0.0,
+    }
+
+
+def record_event(
+    db: Session,
+    referral_code_id: int,
+    event_type: ReferralEventType,
+    transaction_amount: Optional[float] = None,
+) -> int:
+    """Учёт события в счётчиках кода; возвращает новое total_referrals"""
+    params = _increment_params(referral_code_id, event_type, transaction_amount)
+    return db.execute(_INCREMENT_STMT, params).scalar_one()
+
+
+async def record_event_async(
+    db: AsyncSession,
+    referral_code_id: int,
+    event_type: ReferralEventType,
+    transaction_amount: Optional[float] = None,
+) -> int:
+    params = _increment_params(referral_code_id, event_type, transaction_amount)
+    return (await db.execute(_INCREMENT_STMT, params)).scalar_one()
+
+
+_LOCK_CODES_SQL = text("""
+    SELECT max(id) FROM (
+        SELECT id FROM referral_codes
+        WHERE id > :after_id
+        ORDER BY id
+        LIMIT :batch_size
+        FOR UPDATE
+    ) locked
+""")
+
+# total_revenue сравнивается с допуском: сумма float зависит от порядка слагаемых
+_RECONCILE_SQL = text("""
+    UPDATE referral_codes c
+    SET total_referrals = actual.total,
+        successful_referrals = actual.successful,
+        total_revenue = actual.revenue
+    FROM (
+        SELECT rc.id,
+               count(e.id) AS total,
+               count(e.id) FILTER (WHERE e.event_type = 'FIRST_VISIT') AS successful,
+               coalesce(sum(e.transaction_amount), 0) AS revenue
+        FROM referral_codes rc
+        LEFT JOIN referral_events e ON e.referral_code_id = rc.id
+        WHERE rc.id > :after_id AND rc.id <= :last_id
+        GROUP BY rc.id
+    ) actual
+    WHERE c.id = actual.id
+      AND (c.total_referrals IS DISTINCT FROM actual.total
+           OR c.successful_referrals IS DISTINCT FROM actual.successful
+           OR abs(c.total_revenue - actual.revenue) > 0.005)
+""")
+
+
+def reconcile_referral_counters(db: Session, batch_size: int = 1000) -> int:
+    """
+    Пересчёт счётчиков referral_codes по referral_events.
+
+    Порциями по id, каждая порция — отдельная транзакция: строки кодов
+    блокируются FOR UPDATE, затем отдельным оператором (со свежим снимком)
+    пересчитываются счётчики. Параллельное событие либо уже закоммичено и
+    попадёт в подсчёт, либо ждёт блокировку и прибавит своё после сверки.
+    Возвращает число исправленных кодов.
+    """
+    after_id, total_fixed = 0, 0
+    while True:
+        last_id = db.execute(_LOCK_CODES_SQL, {"after_id": after_id, "batch_size": batch_size}).scalar()
+        if last_id is None:
+            db.commit()
+            return total_fixed
+        total_fixed += db.execute(_RECONCILE_SQL, {"after_id": after_id, "last_id": last_id}).rowcount
+        db.commit()
+        after_id = last_id
+
+
+def _reconcile_in_session() -> int:
+    db = SessionLocal()
+    try:
+        return reconcile_referral_counters(db, settings.REFERRAL_RECONCILE_BATCH_SIZE)
+    finally:
+        db.close()
+
+
+async def reconcile_job() -> None:
+    """Периодическая задача (scheduler): сверка счётчиков реферальных кодов"""
+    fixed = await asyncio.to_thread(_reconcile_in_session)
+    if fixed:
+        logger.warning(f"Сверка реферальных счётчиков: исправлено кодов {fixed}")
@@ -0,0 +1,60 @@
+"""
+Дерево рефералов в виде таблицы замыкания (referral_ancestry).
+
+Для каждого пользователя, пришедшего по реферальному коду, хранятся все
+его предки до REFERRAL_MAX_DEPTH уровней: (потомок, глубина) → предок,
+глубина 1 — прямой реферер. Строки добавляются одним INSERT ... SELECT
+при регистрации (`link`): прямой реферер плюс предки реферера со
+сдвигом глубины на единицу. Цепочка предков любого пользователя читается
+одним запросом по первичному ключу, без обхода по уровню за запрос.
+
+Пользователь привязывается один раз — при регистрации, поэтому циклов
+не возникает. Первичное заполнение по истории регистраций —
+migrations/009. Функции не коммитят.
+"""
+from __future__ import annotations
+
+from typing import Iterable
+
+from sqlalchemy import Integer, bindparam, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config import settings
+from models import ReferralAncestry
+
+_LINK_SQL = text("""
+    INSERT INTO referral_ancestry (descendant_user_id, depth, ancestor_user_id)
+    SELECT :user_id, 1, :referrer_id
+    UNION ALL
+    SELECT :user_id, depth + 1, ancestor_user_id
+    FROM referral_ancestry
+    WHERE descendant_user_id = :referrer_id AND depth < :max_depth
+    ON CONFLICT DO NOTHING
+""").bindparams(
+    # asyncpg не выводит тип параметра в SELECT-списке INSERT ... SELECT
+    bindparam("user_id", type_=Integer),
+    bindparam("referrer_id", type_=Integer),
+    bindparam("max_depth", type_=Integer),
+)
+
+
+def _link_params(referrer_id: int, user_id: int) -> dict:
+    return {"referrer_id": referrer_id, "user_id": user_id, "max_depth": settings.REFERRAL_MAX_DEPTH}
+
+
+def link(db: Session, referrer_id: int, user_id: int) -> None:
+    """Привязка нового пользователя к рефереру и всем его предкам"""
+    db.execute(_LINK_SQL, _link_params(referrer_id, user_id))
+
+
+async def link_async(db: AsyncSession, referrer_id: int, user_id: int) -> None:
+    await db.execute(_LINK_SQL, _link_params(referrer_id, user_id))
+
+
+def ancestors_stmt(user_ids: Iterable[int], max_depth: int):
+    """Предки пользователей до глубины max_depth: (descendant_user_id, depth, ancestor_user_id)"""
+    return (
+        select(ReferralAncestry.descendant_user_id, ReferralAncestry.depth, ReferralAncestry.ancestor_user_id)
+        .where(ReferralAncestry.descendant_user_id.in_(list(user_ids)), ReferralAncestry.depth <= max_depth)
+    )
@@ -0,0 +1,260 @@
+"""
+Начисление вознаграждений за реферальные события.
+
+Активные RewardRule компилируются в индекс в памяти процесса: ключ —
+(тип события, тип реферера, уровень), значение — кортеж правил, уже
+включающий правила с referrer_type="any", с заранее посчитанной валютой
+и ставкой. Подбор правил — один поиск в словаре, без запросов к БД.
+
+Уровень 1 — владелец реферального кода события, уровни 2..N — его
+предки из referral_tree (прямой реферер владельца — уровень 2 и т. д.).
+Предки всех событий пачки читаются одним запросом и только если есть
+активные правила уровня выше первого.
+
+Индекс сбрасывается после commit любой сессии, в которой менялись
+RewardRule (события ORM), и перечитывается не реже раза в
+REWARD_RULES_CACHE_TTL: так изменения, сделанные в другом процессе
+(другой воркер uvicorn, seed_data, ручной SQL), доходят без перезапуска.
+
+`apply_rewards` обрабатывает пачку событий: вознаграждения всех
+уровней проводятся одним ledger.post_batch, строки ReferralReward пишутся
+многострочным INSERT. Аккаунт реферера вызывающий получает тем же
+запросом, которым читает событие и реферальный код. Ключ
+идемпотентности проводки — событие и правило (правило относится к
+одному уровню, а значит к одному получателю), поэтому повторная
+обработка события не начисляет дважды. Commit — за вызывающим.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from itertools import chain
+from typing import Optional, Sequence
+
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import Session
+
+import ledger
+import referral_tree
+from config import settings
+from models import (
+    LoyaltyAccount, ReferralAncestry, ReferralCode, ReferralEventType, ReferralReward, RewardRule, RewardType,
+    TransactionType,
+)
+from schemas import LoyaltyTransactionCreate
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    rule_id: int
+    reward_type: RewardType
+    value: float
+    level: int
+    currency: str
+
+    def amount(self, transaction_amount: Optional[float]) -> Optional[float]:
+        """Сумма вознаграждения; None — правило к событию не применяется"""
+        if self.reward_type == RewardType.PERCENTAGE:
+            return transaction_amount * self.value if transaction_amount else None
+        return self.value
+
+
+def _compile(rule: RewardRule) -> Optional[CompiledRule]:
+    if rule.reward_type == RewardType.PERCENTAGE:
+        value = rule.reward_value / 100
+    elif rule.reward_type in (RewardType.FIXED, RewardType.POINTS):
+        value = rule.reward_value
+    else:
+        return None
+    return CompiledRule(
+        rule_id=rule.id,
+        reward_type=rule.reward_type,
+        value=value,
+        level=rule.applies_to_level or 1,
+        currency="points" if rule.reward_type == RewardType.POINTS else "cashback",
+    )
+
+
+class RuleIndex:
+    """Активные правила по (event_type, referrer_type, level)"""
+
+    def __init__(self, rules: Sequence[RewardRule]):
+        specific: dict[tuple, list[CompiledRule]] = {}
+        any_type: dict[tuple, list[CompiledRule]] = {}
+        self.max_level = 0
+        for rule in sorted(rules, key=lambda r: r.id):
+            compiled = _compile(rule)
+            if compiled is None:
+                continue
+            self.max_level = max(self.max_level, compiled.level)
+            if rule.referrer_type == "any":
+                any_type.setdefault((rule.event_type, compiled.level), []).append(compiled)
+            else:
+                specific.setdefault((rule.event_type, rule.referrer_type, compiled.level), []).append(compiled)
+
+        self._any = {key: tuple(compiled) for key, compiled in any_type.items()}
+        self._rules = {
+            (event_type, referrer_type, level): tuple(
+                sorted(compiled + list(self._any.get((event_type, level), ())), key=lambda c: c.rule_id)
+            )
+            for (event_type, referrer_type, level), compiled in specific.items()
+        }
+
+    def lookup(
+        self, event_type: ReferralEventType, referrer_type: Optional[str], level: int = 1
+    ) -> tuple[CompiledRule, ...]:
+        rules = self._rules.get((event_type, referrer_type, level))
+        return rules if rules is not None else self._any.get((event_type, level), ())
+
+
+_index: Optional[RuleIndex] = None
+_index_loaded_at = 0.0
+_index_lock = threading.Lock()
+
+
+def get_index(db: Session) -> RuleIndex:
+    global _index, _index_loaded_at
+    index = _index
+    if index is not None and time.monotonic() - _index_loaded_at < settings.REWARD_RULES_CACHE_TTL:
+        return index
+    with _index_lock:
+        if _index is None or time.monotonic() - _index_loaded_at >= settings.REWARD_RULES_CACHE_TTL:
+            rules = db.execute(select(RewardRule).where(RewardRule.is_active == True)).scalars().all()
+            _index, _index_loaded_at = RuleIndex(rules), time.monotonic()
+        return _index
+
+
+def invalidate() -> None:
+    global _index
+    _index = None
+
+
+@event.listens_for(Session, "after_flush")
+def _track_rule_changes(session, flush_context):
+    if any(isinstance(obj, RewardRule) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info["reward_rules_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    if session.info.pop("reward_rules_changed", False):
+        invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rule_changes(session):
+    session.info.pop("reward_rules_changed", None)
+
+
+@dataclass(frozen=True)
+class RewardTarget:
+    """Событие и получатель вознаграждения"""
+    event_id: int
+    event_type: ReferralEventType
+    transaction_amount: Optional[float]
+    recipient_user_id: int
+    referrer_type: Optional[str]
+    account_id: Optional[int]  # аккаунт лояльности получателя
+    level: int = 1
+
+
+def _ancestor_targets(db: Session, targets: Sequence[RewardTarget], max_level: int) -> list[RewardTarget]:
+    """Получатели уровней 2..max_level: предки владельцев кодов, одним запросом"""
+    by_user: dict[int, list[RewardTarget]] = {}
+    for target in targets:
+        by_user.setdefault(target.recipient_user_id, []).append(target)
+
+    referrer_type = (
+        select(ReferralCode.referrer_type)
+        .where(ReferralCode.user_id == ReferralAncestry.ancestor_user_id, ReferralCode.is_active == True)
+        .order_by(ReferralCode.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    rows = db.execute(
+        referral_tree.ancestors_stmt(by_user, max_level - 1)
+        .add_columns(LoyaltyAccount.id.label("account_id"), referrer_type.label("referrer_type"))
+        .outerjoin(LoyaltyAccount, LoyaltyAccount.user_id == ReferralAncestry.ancestor_user_id)
+    ).all()
+    return [
+        RewardTarget(
+            event_id=target.event_id,
+            event_type=target.event_type,
+            transaction_amount=target.transaction_amount,
+            recipient_user_id=row.ancestor_user_id,
+            referrer_type=row.referrer_type,
+            account_id=row.account_id,
+            level=row.depth + 1,
+        )
+        for row in rows
+        for target in by_user[row.descendant_user_id]
+    ]
+
+
+def apply_rewards(db: Session, targets: Sequence[RewardTarget]) -> int:
+    """
+    Начисление по всем подходящим правилам всех уровней. `targets` —
+    события с получателем уровня 1 (владельцем кода). Возвращает число
+    новых вознаграждений.
+    """
+    index = get_index(db)
+    if index.max_level > 1 and targets:
+        targets = [*targets, *_ancestor_targets(db, targets, index.max_level)]
+
+    awards: list[tuple[RewardTarget, CompiledRule, float]] = []
+    for target in targets:
+        rules = index.lookup(target.event_type, target.referrer_type, target.level)
+        if not rules:
+            continue
+        if target.account_id is None:
+            logger.warning(f"Аккаунт лояльности не найден для пользователя {target.recipient_user_id}")
+            continue
+        for rule in rules:
+            amount = rule.amount(target.transaction_amount)
+            if amount is not None:
+                awards.append((target, rule, amount))
+    if not awards:
+        return 0
+
+    results = ledger.post_batch(
+        db,
+        [
+            LoyaltyTransactionCreate(
+                account_id=target.account_id,
+                transaction_type=TransactionType.ACCRUAL,
+                amount=amount,
+                currency=rule.currency,
+                source="referral",
+                source_id=str(target.event_id),
+                description=f"Вознаграждение за реферала: {target.event_type}",
+                idempotency_key=f"referral:{target.event_id}:{rule.rule_id}",
+            )
+            for target, rule, amount in awards
+        ],
+        audit_action="referral_reward",
+    )
+
+    rows = []
+    for (target, rule, amount), result in zip(awards, results):
+        if result.status == "error":
+            logger.warning(
+                f"Вознаграждение по правилу {rule.rule_id} за событие {target.event_id} "
+                f"не начислено: {result.error}"
+            )
+        elif result.status == "created":
+            rows.append({
+                "event_id": target.event_id,
+                "recipient_user_id": target.recipient_user_id,
+                "reward_type": rule.reward_type,
+                "reward_amount": amount,
+                "referral_level": target.level,
+                "loyalty_transaction_id": result.transaction_id,
+            })
+    if rows:
+        db.execute(insert(ReferralReward), rows)
+        logger.info(f"Начислено вознаграждений: {len(rows)} (событий: {len({row['event_id'] for row in rows})})")
+    return len(rows)
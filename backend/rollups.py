@@ -0,0 +1,175 @@
+"""
+Дневные агрегаты транзакций лояльности (loyalty_daily_rollups).
+
+Строка — день (UTC) × валюта × тип × источник → число транзакций и сумма.
+Ledger увеличивает агрегат текущего дня в той же транзакции БД, что и
+проводку (`upsert_stmt`), поэтому отчёт за любой период собирается из
+нескольких сотен строк агрегатов плюс «краевых» неполных дней из
+loyalty_transactions (`loyalty_totals`).
+
+`rebuild` пересчитывает агрегаты по сырым транзакциям — для истории
+и после ручных правок (scripts/backfill_loyalty_rollups.py).
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Iterable
+
+from sqlalchemy import Date, cast, func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from models import LoyaltyDailyRollup, LoyaltyTransaction, TransactionType
+
+# День проводки: now() — время начала транзакции БД, как и created_at
+_TODAY_UTC = cast(func.timezone("UTC", func.now()), Date)
+
+_REBUILD_CHUNK_DAYS = 31
+
+
+def upsert_stmt(entries: Iterable[tuple[str, TransactionType, str | None, float]]):
+    """
+    INSERT ... ON CONFLICT DO UPDATE агрегатов текущего дня.
+
+    `entries` — (currency, transaction_type, source, amount) проведённых
+    транзакций. Ключи сортируются, чтобы параллельные проводки брали
+    блокировки строк агрегатов в одном порядке.
+    """
+    grouped: dict[tuple, list] = defaultdict(lambda: [0, 0.0])
+    for currency, transaction_type, source, amount in entries:
+        bucket = grouped[(currency, transaction_type.name, source or "")]
+        bucket[0] += 1
+        bucket[1] += amount
+
+    rows = [
+        {
+            "day": _TODAY_UTC,
+            "currency": currency,
+            "transaction_type": TransactionType[type_name],
+            "source": source,
+            "tx_count": count,
+            "amount_sum": amount_sum,
+        }
+        for (currency, type_name, source), (count, amount_sum) in sorted(grouped.items())
+    ]
+    stmt = pg_insert(LoyaltyDailyRollup).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=["day", "currency", "transaction_type", "source"],
+        set_={
+            "tx_count": LoyaltyDailyRollup.tx_count + stmt.excluded.tx_count,
+            "amount_sum": LoyaltyDailyRollup.amount_sum + stmt.excluded.amount_sum,
+        },
+    )
+
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _midnight(day: date) -> datetime:
+    return datetime.combine(day, time.min, tzinfo=timezone.utc)
+
+
+def _raw_totals(db: Session, lower: datetime, upper: datetime, upper_inclusive: bool):
+    upper_cond = LoyaltyTransaction.created_at <= upper if upper_inclusive else LoyaltyTransaction.created_at < upper
+    return db.execute(
+        select(
+            LoyaltyTransaction.currency,
+            LoyaltyTransaction.transaction_type,
+            func.count(),
+            func.coalesce(func.sum(LoyaltyTransaction.amount), 0.0),
+        )
+        .where(LoyaltyTransaction.created_at >= lower, upper_cond)
+        .group_by(LoyaltyTransaction.currency, LoyaltyTransaction.transaction_type)
+    ).all()
+
+
+def _rollup_totals(db: Session, first_day: date, last_day: date):
+    return db.execute(
+        select(
+            LoyaltyDailyRollup.currency,
+            LoyaltyDailyRollup.transaction_type,
+            func.sum(LoyaltyDailyRollup.tx_count),
+            func.sum(LoyaltyDailyRollup.amount_sum),
+        )
+        .where(LoyaltyDailyRollup.day.between(first_day, last_day))
+        .group_by(LoyaltyDailyRollup.currency, LoyaltyDailyRollup.transaction_type)
+    ).all()
+
+
+def loyalty_totals(db: Session, start: datetime, end: datetime) -> dict[tuple[str, TransactionType], tuple[int, float]]:
+    """
+    Итоги по (валюта, тип) за [start, end].
+
+    Полные дни внутри периода берутся из агрегатов, неполные первый и
+    последний день — из loyalty_transactions по индексу created_at.
+    """
+    start, end = _as_utc(start), _as_utc(end)
+    first_full = start.date() if start == _midnight(start.date()) else start.date() + timedelta(days=1)
+    last_full = end.date() - timedelta(days=1)
+
+    parts = []
+    if first_full <= last_full:
+        parts.append(_rollup_totals(db, first_full, last_full))
+        if start < _midnight(first_full):
+            parts.append(_raw_totals(db, start, _midnight(first_full), upper_inclusive=False))
+        parts.append(_raw_totals(db, _midnight(last_full + timedelta(days=1)), end, upper_inclusive=True))
+    elif start <= end:
+        parts.append(_raw_totals(db, start, end, upper_inclusive=True))
+
+    totals: dict[tuple, list] = defaultdict(lambda: [0, 0.0])
+    for rows in parts:
+        for currency, transaction_type, count, amount_sum in rows:
+            bucket = totals[(currency, transaction_type)]
+            bucket[0] += int(count or 0)
+            bucket[1] += float(amount_sum or 0.0)
+    return {key: (count, amount_sum) for key, (count, amount_sum) in totals.items()}
+
+
+_REBUILD_SQL = (
+    text("LOCK TABLE loyalty_daily_rollups IN EXCLUSIVE MODE"),
+    text("DELETE FROM loyalty_daily_rollups WHERE day BETWEEN :first_day AND :last_day"),
+    text("""
+        INSERT INTO loyalty_daily_rollups (day, currency, transaction_type, source, tx_count, amount_sum)
+        SELECT (created_at AT TIME ZONE 'UTC')::date,
+               coalesce(currency, 'points'),
+               transaction_type,
+               coalesce(source, ''),
+               count(*),
+               coalesce(sum(amount), 0)
+        FROM loyalty_transactions
+        WHERE created_at >= :lower AND created_at < :upper
+          AND transaction_type IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+    """),
+)
+
+
+def rebuild(db: Session, first_day: date, last_day: date) -> int:
+    """
+    Пересчёт агрегатов за дни [first_day, last_day] порциями по месяцу.
+
+    Таблица агрегатов блокируется в EXCLUSIVE на время порции: проводки,
+    начатые раньше, успевают закоммититься и попадают в пересчёт, а
+    начатые позже ждут и добавляются поверх. Возвращает число строк.
+    """
+    written = 0
+    chunk_start = first_day
+    while chunk_start <= last_day:
+        chunk_end = min(chunk_start + timedelta(days=_REBUILD_CHUNK_DAYS - 1), last_day)
+        params = {
+            "first_day": chunk_start,
+            "last_day": chunk_end,
+            "lower": _midnight(chunk_start),
+            "upper": _midnight(chunk_end + timedelta(days=1)),
+        }
+        lock, delete, insert = _REBUILD_SQL
+        db.execute(lock)
+        db.execute(delete, params)
+        written += db.execute(insert, params).rowcount
+        db.commit()
+        chunk_start = chunk_end + timedelta(days=1)
+    return written
@@ -1,12 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, and_
+from sqlalchemy import func, desc
 from datetime import datetime, timedelta
+from typing import Optional
 
+import principal_cache
+import rollups
+import token_store
 from database import get_db
+from pagination import keyset_page
 from models import (
     User, LoyaltyAccount, Certificate, ReferralCode, 
-    LoyaltyTransaction, CertificateStatus, AuditLog
+    LoyaltyTransaction, CertificateStatus, AuditLog, TransactionType
 )
 from schemas import (
     AdminDashboardStats,
@@ -15,6 +20,7 @@ from schemas import (
     CertificateResponse,
     UserResponse
 )
+from principal_cache import Principal
 from routers.auth import get_current_active_user
 import logging
 
@@ -23,7 +29,7 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-def require_admin(current_user: User = Depends(get_current_active_user)):
+def require_admin(current_user: Principal = Depends(get_current_active_user)):
     """Проверка прав администратора или кассира"""
     if current_user.role not in ["admin", "cashier"]:
         raise HTTPException(
@@ -35,7 +41,7 @@ def require_admin(current_user: User = Depends(get_current_active_user)):
 
 @router.get("/dashboard", response_model=AdminDashboardStats)
 def get_dashboard_stats(
-    current_user: User = Depends(require_admin),
+    current_user: Principal = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Получение общей статистики для дашборда"""
@@ -89,10 +95,11 @@ def get_dashboard_stats(
 
 @router.get("/certificates", response_model=AdminCertificateList)
 def list_certificates(
-    page: int = Query(1, ge=1),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы"),
+    page: Optional[int] = Query(None, ge=1, description="Номер страницы (устаревший режим, с total)"),
     page_size: int = Query(20, ge=1, le=100),
     status: str = Query(None),
-    current_user: User = Depends(require_admin),
+    current_user: Principal = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Список всех сертификатов с фильтрацией"""
@@ -103,28 +110,35 @@ def list_certificates(
     if status:
         query = query.filter(Certificate.status == status)
     
-    # Подсчет общего количества
-    total = query.count()
-    
-    # Пагинация
-    certificates = query.order_by(
-        desc(Certificate.issued_at)
-    ).offset((page - 1) * page_size).limit(page_size).all()
+    if page is not None and not cursor:
+        # Постраничный режим для старых клиентов
+        total = query.count()
+        certificates = query.order_by(
+            desc(Certificate.issued_at), desc(Certificate.id)
+        ).offset((page - 1) * page_size).limit(page_size).all()
+        next_cursor = None
+    else:
+        total = None
+        certificates, next_cursor = keyset_page(
+            query, Certificate.issued_at, Certificate.id, cursor, page_size
+        )
     
     return AdminCertificateList(
         certificates=[CertificateResponse.from_orm(c) for c in certificates],
         total=total,
         page=page,
-        page_size=page_size
+        page_size=page_size,
+        next_cursor=next_cursor
     )
 
 
 @router.get("/users", response_model=AdminUserList)
 def list_users(
-    page: int = Query(1, ge=1),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы"),
+    page: Optional[int] = Query(None, ge=1, description="Номер страницы (устаревший режим, с total)"),
     page_size: int = Query(20, ge=1, le=100),
     role: str = Query(None),
-    current_user: User = Depends(require_admin),
+    current_user: Principal = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Список всех пользователей с фильтрацией"""
@@ -135,30 +149,35 @@ def list_users(
     if role:
         query = query.filter(User.role == role)
     
-    # Подсчет общего количества
-    total = query.count()
-    
-    # Пагинация
-    users = query.order_by(
-        desc(User.created_at)
-    ).offset((page - 1) * page_size).limit(page_size).all()
+    if page is not None and not cursor:
+        # Постраничный режим для старых клиентов
+        total = query.count()
+        users = query.order_by(
+            desc(User.created_at), desc(User.id)
+        ).offset((page - 1) * page_size).limit(page_size).all()
+        next_cursor = None
+    else:
+        total = None
+        users, next_cursor = keyset_page(query, User.created_at, User.id, cursor, page_size)
     
     return AdminUserList(
         users=[UserResponse.from_orm(u) for u in users],
         total=total,
         page=page,
-        page_size=page_size
+        page_size=page_size,
+        next_cursor=next_cursor
     )
 
 
 @router.get("/audit-log")
 def get_audit_log(
-    page: int = Query(1, ge=1),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы"),
+    page: Optional[int] = Query(None, ge=1, description="Номер страницы (устаревший режим, с total)"),
     page_size: int = Query(50, ge=1, le=200),
     entity_type: str = Query(None),
     action: str = Query(None),
     user_id: int = Query(None),
-    current_user: User = Depends(require_admin),
+    current_user: Principal = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Получение логов аудита"""
@@ -173,13 +192,16 @@ def get_audit_log(
     if user_id:
         query = query.filter(AuditLog.user_id == user_id)
     
-    # Подсчет общего количества
-    total = query.count()
-    
-    # Пагинация
-    logs = query.order_by(
-        desc(AuditLog.created_at)
-    ).offset((page - 1) * page_size).limit(page_size).all()
+    if page is not None and not cursor:
+        # Постраничный режим для старых клиентов
+        total = query.count()
+        logs = query.order_by(
+            desc(AuditLog.created_at), desc(AuditLog.id)
+        ).offset((page - 1) * page_size).limit(page_size).all()
+        next_cursor = None
+    else:
+        total = None
+        logs, next_cursor = keyset_page(query, AuditLog.created_at, AuditLog.id, cursor, page_size)
     
     return {
         "logs": [
@@ -197,14 +219,16 @@ def get_audit_log(
         ],
         "total": total,
         "page": page,
-        "page_size": page_size
+        "page_size": page_size,
+        "next_cursor": next_cursor
     }
 
 
 @router.post("/users/{user_id}/deactivate")
 def deactivate_user(
     user_id: int,
-    current_user: User = Depends(require_admin),
+    background_tasks: BackgroundTasks,
+    current_user: Principal = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Деактивация пользователя"""
@@ -231,8 +255,12 @@ def deactivate_user(
     db.add(audit)
     
     db.commit()
+    # Снимок в кеше аутентификации больше не пускает пользователя,
+    # выданные ему токены отзываются
+    background_tasks.add_task(principal_cache.invalidate, user.id)
+    background_tasks.add_task(token_store.revoke_user, user.id)
     
-    logger.info(f"Пользователь {user.email} деактивирован администратором {current_user.email}")
+    logger.info(f"Пользователь {user.email} деактивирован администратором {current_user.id}")
     
     return {"message": "Пользователь деактивирован", "user_id": user_id}
 
@@ -240,7 +268,8 @@ def deactivate_user(
 @router.post("/users/{user_id}/activate")
 def activate_user(
     user_id: int,
-    current_user: User = Depends(require_admin),
+    background_tasks: BackgroundTasks,
+    current_user: Principal = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Активация пользователя"""
@@ -267,8 +296,9 @@ def activate_user(
     db.add(audit)
     
     db.commit()
+    background_tasks.add_task(principal_cache.invalidate, user.id)
     
-    logger.info(f"Пользователь {user.email} активирован администратором {current_user.email}")
+    logger.info(f"Пользователь {user.email} активирован администратором {current_user.id}")
     
     return {"message": "Пользователь активирован", "user_id": user_id}
 
@@ -277,43 +307,28 @@ def activate_user(
 def loyalty_report(
     start_date: datetime = Query(...),
     end_date: datetime = Query(...),
-    current_user: User = Depends(require_admin),
+    current_user: Principal = Depends(require_admin),
     db: Session = Depends(get_db)
 ):
     """Отчет по программе лояльности за период"""
     
-    # Транзакции за период
-    transactions = db.query(LoyaltyTransaction).filter(
-        and_(
-            LoyaltyTransaction.created_at >= start_date,
-            LoyaltyTransaction.created_at <= end_date
-        )
-    ).all()
+    # Итоги из дневных агрегатов + неполные крайние дни из транзакций
+    totals = rollups.loyalty_totals(db, start_date, end_date)
     
-    # Агрегация
-    total_accrued_points = sum(
-        t.amount for t in transactions 
-        if t.transaction_type == "accrual" and t.currency == "points"
-    )
-    total_spent_points = sum(
-        t.amount for t in transactions 
-        if t.transaction_type == "deduction" and t.currency == "points"
-    )
-    total_accrued_cashback = sum(
-        t.amount for t in transactions 
-        if t.transaction_type == "accrual" and t.currency == "cashback"
-    )
-    total_spent_cashback = sum(
-        t.amount for t in transactions 
-        if t.transaction_type == "deduction" and t.currency == "cashback"
-    )
+    def total(currency: str, transaction_type: TransactionType) -> float:
+        return totals.get((currency, transaction_type), (0, 0.0))[1]
+    
+    total_accrued_points = total("points", TransactionType.ACCRUAL)
+    total_spent_points = total("points", TransactionType.DEDUCTION)
+    total_accrued_cashback = total("cashback", TransactionType.ACCRUAL)
+    total_spent_cashback = total("cashback", TransactionType.DEDUCTION)
     
     return {
         "period": {
             "start": start_date.isoformat(),
             "end": end_date.isoformat()
         },
-        "transactions_count": len(transactions),
+        "transactions_count": sum(count for count, _ in totals.values()),
         "points": {
             "accrued": total_accrued_points,
             "spent": total_spent_points,
@@ -5,6 +5,8 @@
   - Список врачей: из Catalog_Сотрудники (1С OData), fallback — статика
   - Список услуг: из Catalog_Номенклатура (1С OData), fallback — статика
   - Создание заявки: POST в Document_Заявка (1С OData) + сохранение в БД
+  - Списки врачей и услуг кешируются в Redis (stale-while-revalidate),
+    поэтому запрос пациента не ждёт ответа 1С
   - Клиент в 1С ищется по Catalog_Клиенты.phone
   - ONEC_API_URL формат: http://192.168.100.234/BITtest
                           (базовая часть без /odata/...)
@@ -15,16 +17,18 @@ import asyncio
 from datetime import datetime, timedelta
 from typing import List, Optional
 
-import httpx
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from catalog_cache import CatalogCache
 from config import settings
-from database import get_db
+from database import get_async_db
 from models import AppointmentRequest, AppointmentStatus, User
-from onec_utils import odata_auth, odata_url
-from routers.auth import get_current_user
+from onec_utils import get_onec_client
+from principal_cache import Principal
+from routers.auth import get_current_user, get_current_user_record
 
 import logging
 
@@ -130,20 +134,12 @@ async def _fetch_doctors_from_1c() -> list[dict] | None:
     if not settings.ONEC_API_URL:
         return None
     try:
-        params = {
-            "$filter": "IsFolder eq false and DeletionMark eq false",
-            "$select": "Ref_Key,Description",
-            "$format": "json",
-            "$orderby": "Description",
-        }
-        async with httpx.AsyncClient(timeout=8.0) as client:
-            resp = await client.get(
-                odata_url("Catalog_%D0%A1%D0%BE%D1%82%D1%80%D1%83%D0%B4%D0%BD%D0%B8%D0%BA%D0%B8"),
-                params=params,
-                auth=odata_auth(),
-            )
-            resp.raise_for_status()
-            data = resp.json()
+        values = await get_onec_client().query(
+            "Catalog_%D0%A1%D0%BE%D1%82%D1%80%D1%83%D0%B4%D0%BD%D0%B8%D0%BA%D0%B8",
+            filter="IsFolder eq false and DeletionMark eq false",
+            select=["Ref_Key", "Description"],
+            orderby="Description",
+        )
         return [
             {
                 "id": v["Ref_Key"],
@@ -151,7 +147,7 @@ async def _fetch_doctors_from_1c() -> list[dict] | None:
                 "specialty": "",   # Специализация требует отдельного запроса
                 "photo_url": None,
             }
-            for v in data.get("value", [])
+            for v in values
             if v.get("Description", "").strip()
         ]
     except Exception as e:
@@ -164,21 +160,13 @@ async def _fetch_services_from_1c() -> list[dict] | None:
     if not settings.ONEC_API_URL:
         return None
     try:
-        params = {
-            "$filter": "IsFolder eq false and DeletionMark eq false",
-            "$select": "Ref_Key,Description",
-            "$format": "json",
-            "$top": "200",
-            "$orderby": "Description",
-        }
-        async with httpx.AsyncClient(timeout=8.0) as client:
-            resp = await client.get(
-                odata_url("Catalog_%D0%9D%D0%BE%D0%BC%D0%B5%D0%BD%D0%BA%D0%BB%D0%B0%D1%82%D1%83%D1%80%D0%B0"),
-                params=params,
-                auth=odata_auth(),
-            )
-            resp.raise_for_status()
-            data = resp.json()
+        values = await get_onec_client().query(
+            "Catalog_%D0%9D%D0%BE%D0%BC%D0%B5%D0%BD%D0%BA%D0%BB%D0%B0%D1%82%D1%83%D1%80%D0%B0",
+            filter="IsFolder eq false and DeletionMark eq false",
+            select=["Ref_Key", "Description"],
+            top=200,
+            orderby="Description",
+        )
         return [
             {
                 "id": v["Ref_Key"],
@@ -186,7 +174,7 @@ async def _fetch_services_from_1c() -> list[dict] | None:
                 "category": "Услуги",
                 "duration_min": 30,
             }
-            for v in data.get("value", [])
+            for v in values
             if v.get("Description", "").strip()
         ]
     except Exception as e:
@@ -199,34 +187,30 @@ async def _find_client_in_1c(user: User) -> str | None:
     if not settings.ONEC_API_URL:
         return None
 
-    async def _lookup(client: httpx.AsyncClient, filter_expr: str) -> str | None:
+    onec = get_onec_client()
+
+    async def _lookup(filter_expr: str) -> str | None:
         try:
-            resp = await client.get(
-                odata_url("Catalog_%D0%9A%D0%BB%D0%B8%D0%B5%D0%BD%D1%82%D1%8B"),
-                params={"$filter": filter_expr, "$select": "Ref_Key", "$format": "json", "$top": "1"},
-                auth=odata_auth(),
+            vals = await onec.query(
+                "Catalog_%D0%9A%D0%BB%D0%B8%D0%B5%D0%BD%D1%82%D1%8B",
+                filter=filter_expr,
+                select=["Ref_Key"],
+                top=1,
             )
-            if resp.status_code == 200:
-                vals = resp.json().get("value", [])
-                return vals[0]["Ref_Key"] if vals else None
+            return vals[0]["Ref_Key"] if vals else None
         except Exception:
             pass
         return None
 
-    try:
-        async with httpx.AsyncClient(timeout=8.0) as client:
-            filters = []
-            if user.external_id:
-                filters.append(f"Code eq '{user.external_id}'")
-            if user.full_name:
-                filters.append(f"Description eq '{user.full_name}' and DeletionMark eq false")
-            if not filters:
-                return None
-            results = await asyncio.gather(*[_lookup(client, f) for f in filters])
-            return next((r for r in results if r), None)
-    except Exception as e:
-        logger.warning(f"Ошибка поиска клиента в 1С: {e}")
-    return None
+    filters = []
+    if user.external_id:
+        filters.append(f"Code eq '{user.external_id}'")
+    if user.full_name:
+        filters.append(f"Description eq '{user.full_name}' and DeletionMark eq false")
+    if not filters:
+        return None
+    results = await asyncio.gather(*[_lookup(f) for f in filters])
+    return next((r for r in results if r), None)
 
 
 async def _push_appointment_to_1c(appt: AppointmentRequest, user: User) -> str | None:
@@ -282,54 +266,64 @@ async def _push_appointment_to_1c(appt: AppointmentRequest, user: User) -> str |
                 "ПродолжительностьИзмененаВручную": False,
             }]
 
-        async with httpx.AsyncClient(timeout=15.0) as http:
-            resp = await http.post(
-                odata_url("Document_%D0%97%D0%B0%D1%8F%D0%B2%D0%BA%D0%B0"),
-                json=payload,
-                auth=odata_auth(),
-                headers={"Content-Type": "application/json"},
-                params={"$format": "json"},
-            )
-            if resp.status_code in (200, 201):
-                data = resp.json()
-                ref_key = data.get("Ref_Key") or data.get("value", {}).get("Ref_Key")
-                logger.info(f"Заявка создана в 1С: {ref_key}")
-                return ref_key
-            else:
-                logger.warning(f"1С вернул {resp.status_code}: {resp.text[:300]}")
-                return None
+        resp = await get_onec_client().create(
+            "Document_%D0%97%D0%B0%D1%8F%D0%B2%D0%BA%D0%B0",
+            payload,
+            timeout=15.0,
+        )
+        if resp.status_code in (200, 201):
+            data = resp.json()
+            ref_key = data.get("Ref_Key") or data.get("value", {}).get("Ref_Key")
+            logger.info(f"Заявка создана в 1С: {ref_key}")
+            return ref_key
+        else:
+            logger.warning(f"1С вернул {resp.status_code}: {resp.text[:300]}")
+            return None
     except Exception as e:
         logger.warning(f"Не удалось создать заявку в 1С: {e}")
         return None
 
 
+doctors_catalog = CatalogCache("doctors", _fetch_doctors_from_1c, STATIC_DOCTORS)
+services_catalog = CatalogCache("services", _fetch_services_from_1c, STATIC_SERVICES)
+
+
+def warm_catalogs() -> None:
+    """Фоновый прогрев кеша каталогов при старте приложения."""
+    doctors_catalog.schedule_refresh()
+    services_catalog.schedule_refresh()
+
+
 # ---------------------------------------------------------------------------
 # Эндпоинты
 # ---------------------------------------------------------------------------
 
 @router.get("/doctors", response_model=List[DoctorOut])
 async def get_doctors():
-    """Список врачей. Берётся из 1С если доступна, иначе — статика."""
-    data = await _fetch_doctors_from_1c()
-    if data:
-        return data
-    return STATIC_DOCTORS
+    """Список врачей из кеша каталога 1С (статика — только при холодном кеше)."""
+    return Response(content=await doctors_catalog.get(), media_type="application/json")
 
 
 @router.get("/services", response_model=List[ServiceOut])
 async def get_services():
-    """Список услуг. Берётся из 1С если доступна, иначе — статика."""
-    data = await _fetch_services_from_1c()
-    if data:
-        return data
-    return STATIC_SERVICES
+    """Список услуг из кеша каталога 1С (статика — только при холодном кеше)."""
+    return Response(content=await services_catalog.get(), media_type="application/json")
+
+
+@router.get("/catalog/stats")
+async def get_catalog_stats():
+    """Счётчики кеша каталогов: попадания, промахи, возраст последнего обновления."""
+    return {
+        "doctors": await doctors_catalog.stats(),
+        "services": await services_catalog.stats(),
+    }
 
 
 @router.post("/request", response_model=AppointmentOut, status_code=201)
 async def create_appointment(
     body: AppointmentCreate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user_record),
 ):
     """Создать заявку на запись. Сохраняется локально + пробрасывается в 1С."""
     if not body.doctor_id and not body.service_id:
@@ -349,16 +343,16 @@ async def create_appointment(
         comment=body.comment,
     )
     db.add(appt)
-    db.commit()
-    db.refresh(appt)
+    await db.commit()
+    await db.refresh(appt)
 
     # Попытка передачи в 1С (не блокирует если 1С недоступна)
     onec_id = await _push_appointment_to_1c(appt, current_user)
     if onec_id:
         appt.onec_document_id = onec_id
         appt.status = AppointmentStatus.CONFIRMED
-        db.commit()
-        db.refresh(appt)
+        await db.commit()
+        await db.refresh(appt)
         logger.info(f"Заявка {appt.id} передана в 1С: {onec_id}")
     else:
         logger.info(f"Заявка {appt.id} сохранена локально (1С недоступна)")
@@ -368,33 +362,35 @@ async def create_appointment(
 
 @router.get("/my", response_model=List[AppointmentOut])
 async def get_my_appointments(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_user),
 ):
     """История заявок текущего пользователя."""
-    appts = (
-        db.query(AppointmentRequest)
-        .filter(AppointmentRequest.user_id == current_user.id)
+    result = await db.execute(
+        select(AppointmentRequest)
+        .where(AppointmentRequest.user_id == current_user.id)
         .order_by(AppointmentRequest.created_at.desc())
-        .all()
     )
-    return appts
+    return result.scalars().all()
 
 
 @router.delete("/request/{appointment_id}", status_code=204)
 async def cancel_appointment(
     appointment_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_user),
 ):
     """Отменить заявку."""
-    appt = db.query(AppointmentRequest).filter(
-        AppointmentRequest.id == appointment_id,
-        AppointmentRequest.user_id == current_user.id,
-    ).first()
+    result = await db.execute(
+        select(AppointmentRequest).where(
+            AppointmentRequest.id == appointment_id,
+            AppointmentRequest.user_id == current_user.id,
+        )
+    )
+    appt = result.scalars().first()
     if not appt:
         raise HTTPException(status_code=404, detail="Заявка не найдена")
     if appt.status == AppointmentStatus.COMPLETED:
         raise HTTPException(status_code=400, detail="Выполненную заявку нельзя отменить")
     appt.status = AppointmentStatus.CANCELLED
-    db.commit()
+    await db.commit()
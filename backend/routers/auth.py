@@ -1,13 +1,22 @@
+import anyio
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
+from redis.exceptions import RedisError
 from datetime import datetime, timedelta
 from typing import Optional
-import bcrypt
+import time
 
-from database import get_db
+from database import get_async_db, get_db
 from models import User, LoyaltyAccount
+import password_hashing
+import principal_cache
+from principal_cache import Principal
+import referral_stats
+import referral_tree
+import token_store
 from schemas import UserCreate, UserLogin, UserResponse, TokenResponse
 from config import settings
 import logging
@@ -21,17 +30,21 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Проверка пароля используя bcrypt"""
-    password_bytes = plain_password.encode('utf-8')
-    hashed_bytes = hashed_password.encode('utf-8')
-    return bcrypt.checkpw(password_bytes, hashed_bytes)
+    """Проверка пароля (bcrypt в пуле процессов password_hashing)"""
+    return password_hashing.check_password(plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
-    """Хеширование пароля используя bcrypt"""
-    password_bytes = password.encode('utf-8')
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password_bytes, salt).decode('utf-8')
+    """Хеширование пароля (bcrypt в пуле процессов password_hashing)"""
+    return password_hashing.hash_password(password)
+
+
+def _hashing_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Сервис перегружен, повторите попытку",
+        headers={"Retry-After": "1"},
+    )
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -40,12 +53,14 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire, "type": "access"})
+    # iat с долями секунды: токены, выданные до отзыва (token_store), отличаются от выданных после
+    to_encode.update({"exp": expire, "iat": time.time(), "type": "access"})
     encoded_jwt = jwt.encode(to_encode, settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM)
     return encoded_jwt
 
 
 def create_refresh_token(data: dict):
+    """`data` содержит sub и jti/fam из token_store"""
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
     to_encode.update({"exp": expire, "type": "refresh"})
@@ -53,10 +68,55 @@ def create_refresh_token(data: dict):
     return encoded_jwt
 
 
-async def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
-) -> User:
+def _issue_tokens(user: User, grant: token_store.RefreshGrant) -> TokenResponse:
+    return TokenResponse(
+        access_token=create_access_token(data={"sub": str(user.id), "fam": grant.family}),
+        refresh_token=create_refresh_token(data={"sub": str(user.id), "jti": grant.jti, "fam": grant.family}),
+        user=UserResponse.from_orm(user)
+    )
+
+
+def _open_session(user: User) -> TokenResponse:
+    """Токены нового входа (из sync-эндпоинта, в потоке threadpool)"""
+    try:
+        grant = anyio.from_thread.run(token_store.open_family, user.id)
+    except RedisError as e:
+        # Вход не блокируем: access-токен работает, refresh-токен не обменяется
+        logger.error(f"Не удалось зарегистрировать refresh-токен пользователя {user.id}: {e}")
+        grant = token_store.RefreshGrant(family=token_store.new_id(), jti=token_store.new_id())
+    return _issue_tokens(user, grant)
+
+
+def _decode_refresh_token(refresh_token: str) -> tuple[int, str, str]:
+    """(user_id, fam, jti) из refresh-токена"""
+    try:
+        payload = jwt.decode(refresh_token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+        if payload.get("type") != "refresh":
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Неверный тип токена"
+            )
+        return int(payload["sub"]), str(payload["fam"]), str(payload["jti"])
+    except (JWTError, KeyError, ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Не удалось проверить токен"
+        )
+
+
+def _token_store_unavailable() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Сервис временно недоступен, повторите попытку",
+        headers={"Retry-After": "1"},
+    )
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> Principal:
+    """
+    Пользователь из JWT. Отзыв токена проверяется по копии списка в памяти
+    (token_store), снимок id/роли/активности берётся из principal_cache, без БД
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Не удалось проверить учетные данные",
@@ -65,24 +125,54 @@ async def get_current_user(
     try:
         payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
         user_id_str: str = payload.get("sub")
-        if user_id_str is None:
+        if user_id_str is None or payload.get("type") != "access":
             raise credentials_exception
         user_id = int(user_id_str)
+        issued_at = float(payload.get("iat", 0))
     except (JWTError, ValueError, TypeError):
         raise credentials_exception
     
-    user = db.query(User).filter(User.id == user_id).first()
-    if user is None:
+    if token_store.is_revoked(user_id, payload.get("fam"), issued_at):
         raise credentials_exception
-    return user
+    
+    principal = await principal_cache.get(user_id)
+    if principal is None:
+        raise credentials_exception
+    return principal
 
 
-async def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
+async def get_current_active_user(current_user: Principal = Depends(get_current_user)) -> Principal:
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Неактивный пользователь")
     return current_user
 
 
+async def _load_user(user_id: int, db: AsyncSession) -> User:
+    user = await db.get(User, user_id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Не удалось проверить учетные данные",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
+
+async def get_current_user_record(
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+) -> User:
+    """Полная запись пользователя — для эндпоинтов, которым нужны его данные (профиль, 1С, Битрикс)"""
+    return await _load_user(current_user.id, db)
+
+
+async def get_current_active_user_record(
+    current_user: Principal = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+) -> User:
+    return await _load_user(current_user.id, db)
+
+
 @router.post("/register", response_model=TokenResponse, status_code=status.HTTP_201_CREATED)
 def register(user_data: UserCreate, db: Session = Depends(get_db)):
     """Регистрация нового пользователя"""
@@ -100,7 +190,10 @@ def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Создание пользователя
-    hashed_password = get_password_hash(user_data.password)
+    try:
+        hashed_password = get_password_hash(user_data.password)
+    except password_hashing.PasswordHashingBusy:
+        raise _hashing_busy()
     new_user = User(
         email=user_data.email,
         phone=user_data.phone,
@@ -140,9 +233,13 @@ def register(user_data: UserCreate, db: Session = Depends(get_db)):
                 processed=False
             )
             db.add(event)
+            db.flush()
+            
+            # Место в дереве рефералов — для многоуровневых вознаграждений
+            referral_tree.link(db, referral_code.user_id, new_user.id)
             
             # Обновление статистики реферального кода
-            referral_code.total_referrals += 1
+            referral_stats.record_event(db, referral_code.id, ReferralEventType.REGISTRATION)
             
             db.commit()
             logger.info(f"Пользователь {new_user.email} зарегистрирован по реферальному коду {user_data.referral_code}")
@@ -150,14 +247,7 @@ def register(user_data: UserCreate, db: Session = Depends(get_db)):
     logger.info(f"Зарегистрирован новый пользователь: {new_user.email}")
     
     # Создание токенов
-    access_token = create_access_token(data={"sub": str(new_user.id)})
-    refresh_token = create_refresh_token(data={"sub": str(new_user.id)})
-    
-    return TokenResponse(
-        access_token=access_token,
-        refresh_token=refresh_token,
-        user=UserResponse.from_orm(new_user)
-    )
+    return _open_session(new_user)
 
 
 @router.post("/login", response_model=TokenResponse)
@@ -166,7 +256,12 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
     
     user = db.query(User).filter(User.email == form_data.username).first()
     
-    if not user or not verify_password(form_data.password, user.password_hash):
+    try:
+        password_ok = user is not None and verify_password(form_data.password, user.password_hash)
+    except password_hashing.PasswordHashingBusy:
+        raise _hashing_busy()
+    
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Неверный email или пароль",
@@ -179,57 +274,61 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
             detail="Пользователь неактивен"
         )
     
-    access_token = create_access_token(data={"sub": str(user.id)})
-    refresh_token = create_refresh_token(data={"sub": str(user.id)})
+    tokens = _open_session(user)
     
     logger.info(f"Пользователь вошел в систему: {user.email}")
     
-    return TokenResponse(
-        access_token=access_token,
-        refresh_token=refresh_token,
-        user=UserResponse.from_orm(user)
-    )
+    return tokens
 
 
 @router.post("/refresh", response_model=TokenResponse)
-def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
-    """Обновление токена доступа"""
+async def refresh_token(refresh_token: str, db: AsyncSession = Depends(get_async_db)):
+    """
+    Обновление токена доступа. Refresh-токен одноразовый: в ответе —
+    следующий токен того же семейства. Повторное предъявление уже
+    обменянного токена завершает сессию (token_store).
+    """
+    user_id, family, jti = _decode_refresh_token(refresh_token)
+    
+    user = await db.get(User, user_id)
+    if not user or not user.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Пользователь не найден"
+        )
     
     try:
-        payload = jwt.decode(refresh_token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
-        user_id: int = payload.get("sub")
-        token_type: str = payload.get("type")
-        
-        if token_type != "refresh":
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Неверный тип токена"
-            )
-        
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Пользователь не найден"
-            )
-        
-        new_access_token = create_access_token(data={"sub": user.id})
-        new_refresh_token = create_refresh_token(data={"sub": user.id})
-        
-        return TokenResponse(
-            access_token=new_access_token,
-            refresh_token=new_refresh_token,
-            user=UserResponse.from_orm(user)
+        grant = await token_store.rotate(user_id, family, jti)
+    except token_store.RefreshTokenReused:
+        logger.warning(f"Повторное использование refresh-токена пользователя {user_id}, сессия {family} отозвана")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Сессия завершена, войдите заново"
         )
-        
-    except JWTError:
+    except token_store.RefreshTokenError as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Не удалось проверить токен"
+            detail=str(e)
         )
+    except RedisError as e:
+        logger.error(f"Не удалось обновить токен пользователя {user_id}: {e}")
+        raise _token_store_unavailable()
+    
+    return _issue_tokens(user, grant)
+
+
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(refresh_token: str):
+    """Выход: refresh-токен и access-токены этой сессии отзываются"""
+    user_id, family, _ = _decode_refresh_token(refresh_token)
+    try:
+        await token_store.revoke_family(user_id, family)
+    except RedisError as e:
+        logger.error(f"Не удалось отозвать сессию пользователя {user_id}: {e}")
+        raise _token_store_unavailable()
 
 
 @router.get("/me", response_model=UserResponse)
-def get_current_user_info(current_user: User = Depends(get_current_active_user)):
+def get_current_user_info(current_user: User = Depends(get_current_active_user_record)):
     """Получение информации о текущем пользователе"""
     return UserResponse.from_orm(current_user)
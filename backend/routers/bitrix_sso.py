@@ -1,16 +1,47 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 import httpx
-import secrets
 
-from database import get_db
-from config import settings
+from bitrix_client import BitrixTokenRejected, get_bitrix_client
+from circuit_breaker import CircuitOpenError
+from database import get_async_db
 from models import User
-from routers.auth import create_access_token, get_password_hash, get_current_active_user
+import referral_stats
+import referral_tree
+from password_hashing import UNUSABLE_PASSWORD
+from routers.auth import create_access_token, get_current_active_user_record
 
 router = APIRouter()
 
+# Пользователь Bitrix одним запросом: по bitrix_id, иначе по email
+# (существующему аккаунту привязывается bitrix_id, пустое ФИО заполняется),
+# иначе — новый пользователь без пароля. Одновременный вход из двух вкладок
+# сходится на ON CONFLICT (email) к одной строке. created — строка вставлена
+# (xmax = 0), а не обновлена.
+_RESOLVE_USER_SQL = text("""
+    WITH existing AS (
+        SELECT id, email, role FROM users WHERE bitrix_id = :bitrix_id
+    ), upserted AS (
+        INSERT INTO users (email, full_name, password_hash, bitrix_id, role, is_active, is_verified)
+        SELECT :email, :full_name, :password_hash, :bitrix_id, 'patient', true, false
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+        ON CONFLICT (email) DO UPDATE SET
+            bitrix_id = EXCLUDED.bitrix_id,
+            full_name = CASE
+                WHEN users.full_name IS NULL OR users.full_name = '' OR users.full_name = :default_name
+                THEN EXCLUDED.full_name
+                ELSE users.full_name
+            END
+        RETURNING id, email, role, (xmax = 0) AS created
+    )
+    SELECT id, email, role, false AS created FROM existing
+    UNION ALL
+    SELECT id, email, role, created FROM upserted
+""")
+
+
 class TokenVerifyRequest(BaseModel):
     token: str
     referral_code: str = None  # Реферальный код (опционально)
@@ -18,7 +49,7 @@ class TokenVerifyRequest(BaseModel):
 @router.post("/verify-token")
 async def verify_bitrix_token(
     request: TokenVerifyRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Проверяет токен от Bitrix и авторизует пользователя"""
     
@@ -28,27 +59,16 @@ async def verify_bitrix_token(
     try:
         logger.info(f"🔄 Проверка токена Bitrix: {request.token[:20]}...")
         
-        # Проверяем токен у Bitrix
-        async with httpx.AsyncClient() as client:
-            logger.info(f"📡 Отправка запроса на {settings.bitrix_domain}/local/api/verify_token.php")
-            response = await client.post(
-                f"{settings.bitrix_domain}/local/api/verify_token.php",
-                json={"token": request.token},
-                timeout=10.0
-            )
-            logger.info(f"📥 Статус ответа: {response.status_code}")
-            response.raise_for_status()
-            result = response.json()
-            logger.info(f"📋 Ответ Bitrix: {result}")
-        
-        if not result.get('success'):
-            logger.error(f"❌ Bitrix вернул ошибку: {result.get('error')}")
+        # Проверяем токен у Bitrix (повторы одного токена — один запрос, см. bitrix_client)
+        try:
+            user_data = await get_bitrix_client().verify_token(request.token)
+        except BitrixTokenRejected as e:
+            logger.error(f"❌ Bitrix вернул ошибку: {e}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail=result.get('error', 'Invalid token')
+                detail=str(e)
             )
         
-        user_data = result['user']
         bitrix_id = str(user_data['bitrix_id'])
         email = user_data['email']
         name = user_data.get('name', '')
@@ -57,40 +77,16 @@ async def verify_bitrix_token(
         
         logger.info(f"👤 Пользователь Bitrix: ID={bitrix_id}, Email={email}, ФИО={full_name}")
         
-        # Ищем или создаем пользователя
-        user = db.query(User).filter(User.bitrix_id == bitrix_id).first()
-        is_new_user = False
-        
-        if not user:
-            logger.info(f"🔍 Пользователь с bitrix_id={bitrix_id} не найден, проверяем по email...")
-            # Проверяем по email
-            user = db.query(User).filter(User.email == email).first()
-            
-            if user:
-                logger.info(f"✅ Найден пользователь по email, привязываем bitrix_id")
-                # Привязываем существующего пользователя
-                user.bitrix_id = bitrix_id
-                # Обновляем ФИО если оно было пустым
-                if not user.full_name or user.full_name == email.split('@')[0]:
-                    user.full_name = full_name
-            else:
-                logger.info(f"🆕 Создаем нового пользователя: {email}")
-                is_new_user = True
-                # Создаем нового пользователя
-                user = User(
-                    email=email,
-                    full_name=full_name,
-                    password_hash=get_password_hash(secrets.token_urlsafe(16)),
-                    bitrix_id=bitrix_id,
-                    role="patient"
-                )
-            
-            db.add(user)
-            db.commit()
-            db.refresh(user)
-            logger.info(f"✅ Пользователь сохранен: ID={user.id}, Email={user.email}")
-        else:
-            logger.info(f"✅ Пользователь найден по bitrix_id: ID={user.id}")
+        # Находим или создаем пользователя — один запрос
+        user = (await db.execute(_RESOLVE_USER_SQL, {
+            "bitrix_id": bitrix_id,
+            "email": email,
+            "full_name": full_name,
+            "default_name": email.split('@')[0],
+            "password_hash": UNUSABLE_PASSWORD,
+        })).one()
+        is_new_user = user.created
+        logger.info(f"✅ Пользователь {'создан' if is_new_user else 'найден'}: ID={user.id}, Email={user.email}")
         
         # Обработка реферального кода, если указан И это новый пользователь
         if request.referral_code and is_new_user:
@@ -98,32 +94,41 @@ async def verify_bitrix_token(
             
             logger.info(f"🎯 Обработка реферального кода: {request.referral_code}")
             
-            referral_code = db.query(ReferralCode).filter(
-                ReferralCode.code == request.referral_code,
-                ReferralCode.is_active == True
-            ).first()
+            referral_code = (await db.execute(
+                select(ReferralCode.id, ReferralCode.user_id).where(
+                    ReferralCode.code == request.referral_code,
+                    ReferralCode.is_active == True
+                )
+            )).first()
             
             if referral_code and referral_code.user_id != user.id:
                 # Создание реферального события "registration"
-                event = ReferralEvent(
+                db.add(ReferralEvent(
                     referral_code_id=referral_code.id,
                     referred_user_id=user.id,
                     event_type=ReferralEventType.REGISTRATION,
                     processed=False
-                )
-                db.add(event)
+                ))
+                await db.flush()
+                
+                # Место в дереве рефералов — для многоуровневых вознаграждений
+                await referral_tree.link_async(db, referral_code.user_id, user.id)
                 
                 # Обновление статистики реферального кода
-                referral_code.total_referrals += 1
+                total_referrals = await referral_stats.record_event_async(
+                    db, referral_code.id, ReferralEventType.REGISTRATION
+                )
                 
-                db.commit()
                 logger.info(f"✅ Пользователь {user.email} зарегистрирован по реферальному коду {request.referral_code}")
-                logger.info(f"👥 Реферер: user_id={referral_code.user_id}, всего рефералов: {referral_code.total_referrals}")
+                logger.info(f"👥 Реферер: user_id={referral_code.user_id}, всего рефералов: {total_referrals}")
             elif referral_code and referral_code.user_id == user.id:
                 logger.warning(f"⚠️ Пользователь попытался использовать свой собственный реферальный код")
             else:
                 logger.warning(f"⚠️ Реферальный код {request.referral_code} не найден или неактивен")
         
+        # Пользователь и реферальное событие — одна транзакция
+        await db.commit()
+        
         # Генерируем JWT токен (используем ID как в обычном login)
         access_token = create_access_token(data={"sub": str(user.id)})
         
@@ -137,6 +142,14 @@ async def verify_bitrix_token(
             }
         }
         
+    except HTTPException:
+        raise
+    except CircuitOpenError as e:
+        logger.warning(f"⚠️ Bitrix временно недоступен: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Bitrix временно недоступен, попробуйте позже"
+        )
     except httpx.HTTPError as e:
         logger.error(f"❌ Ошибка связи с Bitrix: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -153,8 +166,8 @@ async def verify_bitrix_token(
 
 @router.get("/bonus-balance")
 async def get_bitrix_bonus_balance(
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_active_user_record),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получает актуальный баланс бонусов из личного кабинета Bitrix"""
     
@@ -173,14 +186,9 @@ async def get_bitrix_bonus_balance(
         logger.info(f"💰 Запрос баланса бонусов для пользователя: bitrix_id={current_user.bitrix_id}")
         
         # Запрашиваем баланс у Bitrix
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{settings.bitrix_domain}/local/api/get_bonuses.php",
-                json={"user_id": current_user.bitrix_id},
-                timeout=10.0
-            )
-            response.raise_for_status()
-            result = response.json()
+        result = await get_bitrix_client().post(
+            "/local/api/get_bonuses.php", {"user_id": current_user.bitrix_id}
+        )
         
         logger.info(f"📥 Ответ Bitrix: {result}")
         
@@ -202,6 +210,13 @@ async def get_bitrix_bonus_balance(
             "source": "bitrix"
         }
         
+    except CircuitOpenError as e:
+        logger.warning(f"⚠️ Bitrix временно недоступен: {e}")
+        return {
+            "success": False,
+            "error": "Bitrix временно недоступен",
+            "bonus_balance": 0
+        }
     except httpx.HTTPError as e:
         logger.error(f"❌ Ошибка связи с Bitrix: {str(e)}", exc_info=True)
         return {
@@ -221,8 +236,8 @@ async def get_bitrix_bonus_balance(
 @router.get("/bonus-history")
 async def get_bitrix_bonus_history(
     limit: int = 50,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_active_user_record),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получает историю бонусных транзакций из личного кабинета Bitrix"""
     
@@ -242,14 +257,9 @@ async def get_bitrix_bonus_history(
         logger.info(f"📜 Запрос истории бонусов для пользователя: bitrix_id={current_user.bitrix_id}")
         
         # Запрашиваем историю у Bitrix
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{settings.bitrix_domain}/local/api/get_bonus_history.php",
-                json={"user_id": current_user.bitrix_id, "limit": limit},
-                timeout=10.0
-            )
-            response.raise_for_status()
-            result = response.json()
+        result = await get_bitrix_client().post(
+            "/local/api/get_bonus_history.php", {"user_id": current_user.bitrix_id, "limit": limit}
+        )
         
         logger.info(f"📥 Ответ Bitrix: получено {len(result.get('transactions', []))} транзакций")
         
@@ -275,6 +285,14 @@ async def get_bitrix_bonus_history(
             "source": "bitrix"
         }
         
+    except CircuitOpenError as e:
+        logger.warning(f"⚠️ Bitrix временно недоступен: {e}")
+        return {
+            "success": False,
+            "error": "Bitrix временно недоступен",
+            "transactions": [],
+            "total": 0
+        }
     except httpx.HTTPError as e:
         logger.error(f"❌ Ошибка связи с Bitrix: {str(e)}", exc_info=True)
         return {
@@ -1,24 +1,42 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Body
+from fastapi.responses import StreamingResponse
+from sqlalchemy import insert, literal_column, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
-from typing import List
-import qrcode
+from typing import AsyncIterator, List
+import asyncio
+import base64
+import csv
+import io
 import secrets
-import os
+import uuid
+import zipfile
 
-from database import get_db
-from models import User, Certificate, CertificateTransfer, CertificateRedemption, CertificateStatus, AuditLog
+import certificate_cache
+import certificate_redemption
+import certificate_token
+import qr_render
+from certificate_status import effective_status
+from config import settings
+from database import AsyncSessionLocal, get_async_db, get_db
+from models import User, Certificate, CertificateTransfer, CertificateStatus, AuditLog
 from schemas import (
     CertificateCreate,
     CertificateResponse,
+    CertificateBatchCreate,
+    CertificateBatchResponse,
     CertificateTransferCreate,
     CertificateVerifyRequest,
     CertificateVerifyResponse,
     CertificateRedeemRequest,
-    CertificateRedeemResponse
+    CertificateRedeemResponse,
+    CertificateSigningKeyResponse
 )
+from principal_cache import Principal
 from routers.auth import get_current_active_user
-from config import settings
+from routers.qrcodes import fill_qr_code_path, qr_code_paths_update
 import logging
 
 logger = logging.getLogger(__name__)
@@ -31,26 +49,11 @@ def generate_certificate_code() -> str:
     return f"CERT-{secrets.token_hex(8).upper()}"
 
 
-def generate_qr_code(certificate_code: str) -> str:
-    """Генерация QR-кода для сертификата"""
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(f"https://{settings.DOMAIN}/verify/{certificate_code}")
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Сохранение QR-кода
-    os.makedirs(settings.QR_CODE_DIR, exist_ok=True)
-    qr_path = os.path.join(settings.QR_CODE_DIR, f"{certificate_code}.png")
-    img.save(qr_path)
-    
-    return qr_path
-
-
 @router.post("/create", response_model=CertificateResponse, status_code=status.HTTP_201_CREATED)
 def create_certificate(
     cert_data: CertificateCreate,
-    current_user: User = Depends(get_current_active_user),
+    background_tasks: BackgroundTasks,
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Создание нового подарочного сертификата"""
@@ -83,16 +86,7 @@ def create_certificate(
     )
     
     db.add(certificate)
-    db.commit()
-    db.refresh(certificate)
-    
-    # Генерация QR-кода
-    try:
-        qr_path = generate_qr_code(code)
-        certificate.qr_code_path = qr_path
-        db.commit()
-    except Exception as e:
-        logger.error(f"Ошибка генерации QR-кода: {e}")
+    db.flush()
     
     # Аудит
     audit = AuditLog(
@@ -105,19 +99,264 @@ def create_certificate(
     db.add(audit)
     db.commit()
     
+    # QR-код рендерится в пуле процессов после ответа; до готовности
+    # /qrcodes/{code}.png отрендерит его по запросу
+    background_tasks.add_task(
+        fill_qr_code_path,
+        certificate.id,
+        certificate_token.qr_content(code, certificate.initial_amount, certificate.valid_until, certificate.issue_version),
+    )
+    
     logger.info(f"Создан сертификат {code} на сумму {cert_data.initial_amount}")
     
     # TODO: Отправка email/SMS владельцу
     
     response = CertificateResponse.from_orm(certificate)
-    response.qr_code_url = f"https://{settings.DOMAIN}/qrcodes/{code}.png"
+    response.qr_code_url = qr_render.qr_code_url(code)
     
     return response
 
 
+# extra_data->>'batch_id' с литеральным ключом, чтобы совпадать с индексом idx_certificates_batch_id
+certificate_batch_id = Certificate.extra_data.op("->>")(literal_column("'batch_id'"))
+
+
+def generate_unique_certificate_codes(db: Session, count: int) -> List[str]:
+    """Пачка уникальных кодов: проверка коллизий с уже выпущенными одним запросом на итерацию"""
+    codes: set = set()
+    while len(codes) < count:
+        candidates = {generate_certificate_code() for _ in range(count - len(codes))} - codes
+        taken = set(db.execute(
+            select(Certificate.code).where(Certificate.code.in_(candidates))
+        ).scalars())
+        codes |= candidates - taken
+    return list(codes)
+
+
+async def fill_batch_qr_codes(batch_id: str, items: List[tuple]) -> None:
+    """Фоновая задача после пакетного выпуска: рендер QR-кодов (код, содержимое) по всем процессам пула"""
+    try:
+        paths = await qr_render.render_many([content for _, content in items])
+    except Exception as e:
+        logger.error(f"Ошибка генерации QR-кодов пакета {batch_id}: {e}")
+        return
+
+    async with AsyncSessionLocal() as db:
+        await db.execute(qr_code_paths_update([(code, path) for (code, _), path in zip(items, paths)]))
+        await db.commit()
+    logger.info(f"QR-коды пакета {batch_id} готовы ({len(items)} шт.)")
+
+
+@router.post("/batch", response_model=CertificateBatchResponse, status_code=status.HTTP_201_CREATED)
+def create_certificate_batch(
+    batch_data: CertificateBatchCreate,
+    background_tasks: BackgroundTasks,
+    current_user: Principal = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Пакетный выпуск сертификатов (корпоративный заказ)"""
+    
+    if current_user.role not in ["admin", "cashier"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Недостаточно прав для создания сертификатов"
+        )
+    
+    if batch_data.count > settings.CERT_BATCH_MAX_COUNT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Не более {settings.CERT_BATCH_MAX_COUNT} сертификатов в одном пакете"
+        )
+    
+    batch_id = uuid.uuid4().hex
+    valid_until = batch_data.valid_until or datetime.utcnow() + timedelta(days=365)
+    extra_data = {"batch_id": batch_id}
+    if batch_data.client_name:
+        extra_data["client_name"] = batch_data.client_name
+    
+    for attempt in range(2):
+        codes = generate_unique_certificate_codes(db, batch_data.count)
+        try:
+            ids = db.execute(
+                insert(Certificate).returning(Certificate.id, sort_by_parameter_order=True),
+                [
+                    {
+                        "code": code,
+                        "initial_amount": batch_data.initial_amount,
+                        "current_amount": batch_data.initial_amount,
+                        "owner_id": None,
+                        "issued_by_id": current_user.id,
+                        "valid_until": valid_until,
+                        "design_template": batch_data.design_template,
+                        "message": batch_data.message,
+                        "status": CertificateStatus.ACTIVE,
+                        "extra_data": extra_data,
+                    }
+                    for code in codes
+                ]
+            ).scalars().all()
+            db.execute(insert(AuditLog), [
+                {
+                    "user_id": current_user.id,
+                    "action": "create_certificate",
+                    "entity_type": "certificate",
+                    "entity_id": certificate_id,
+                    "new_values": {"code": code, "amount": batch_data.initial_amount, "batch_id": batch_id},
+                }
+                for certificate_id, code in zip(ids, codes)
+            ])
+            db.commit()
+            break
+        except IntegrityError:
+            # Параллельный выпуск занял один из кодов между проверкой и вставкой
+            db.rollback()
+            if attempt:
+                raise
+    
+    background_tasks.add_task(fill_batch_qr_codes, batch_id, [
+        (code, certificate_token.qr_content(code, batch_data.initial_amount, valid_until)) for code in codes
+    ])
+    
+    logger.info(
+        f"Выпущен пакет {batch_id}: {batch_data.count} сертификатов по {batch_data.initial_amount}"
+        f" для {batch_data.client_name or 'без заказчика'}"
+    )
+    
+    return CertificateBatchResponse(
+        batch_id=batch_id,
+        count=len(codes),
+        initial_amount=batch_data.initial_amount,
+        valid_until=valid_until,
+        codes=codes,
+        download_url=f"/api/certificates/batch/{batch_id}/download"
+    )
+
+
+class _ZipSink(io.RawIOBase):
+    """Неперематываемый приёмник для ZipFile: накопленные байты забираются через drain()"""
+    
+    def __init__(self):
+        self._chunks: List[bytes] = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _write_registry(archive: zipfile.ZipFile, rows, contents: dict[str, str]) -> None:
+    """Реестр пакета (CSV) в архив; выполняется в потоке"""
+    registry = io.StringIO()
+    writer = csv.writer(registry, delimiter=";")
+    writer.writerow(["Код", "Номинал", "Действует до", "Статус", "Содержимое QR"])
+    for row in rows:
+        writer.writerow([
+            row.code, row.initial_amount, row.valid_until.date().isoformat(),
+            row.status.value, contents[row.code]
+        ])
+    archive.writestr("registry.csv", "\ufeff" + registry.getvalue(), compress_type=zipfile.ZIP_DEFLATED)
+
+
+def _write_qr_codes(archive: zipfile.ZipFile, chunk, paths: list[str]) -> None:
+    """PNG порции в архив; выполняется в потоке"""
+    for row, path in zip(chunk, paths):
+        with open(path, "rb") as f:
+            # PNG уже сжат — без повторной компрессии
+            archive.writestr(f"qr/{row.code}.png", f.read(), compress_type=zipfile.ZIP_STORED)
+
+
+def _qr_contents(rows) -> dict[str, str]:
+    return {
+        row.code: certificate_token.qr_content(row.code, row.initial_amount, row.valid_until, row.issue_version)
+        for row in rows
+    }
+
+
+async def _stream_batch_zip(rows) -> AsyncIterator[bytes]:
+    """
+    ZIP с реестром (CSV) и PNG QR-кодов, отдаётся по мере сборки.
+    Подпись QR, сжатие и чтение файлов — в потоке, чтобы не останавливать
+    event loop; с архивом одновременно работает только один поток.
+    """
+    contents = await asyncio.to_thread(_qr_contents, rows)
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, mode="w")
+    try:
+        await asyncio.to_thread(_write_registry, archive, rows, contents)
+        yield sink.drain()
+        
+        for start in range(0, len(rows), qr_render.RENDER_CHUNK_SIZE):
+            chunk = rows[start:start + qr_render.RENDER_CHUNK_SIZE]
+            # QR-коды, которые фоновый рендер ещё не успел сделать
+            paths = await qr_render.render_many([contents[row.code] for row in chunk])
+            await asyncio.to_thread(_write_qr_codes, archive, chunk, paths)
+            yield sink.drain()
+    finally:
+        # Центральный каталог архива
+        await asyncio.to_thread(archive.close)
+    yield sink.drain()
+
+
+@router.get("/batch/{batch_id}/download")
+async def download_certificate_batch(
+    batch_id: str,
+    current_user: Principal = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """ZIP пакета: реестр сертификатов и QR-коды"""
+    
+    if current_user.role not in ["admin", "cashier"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Недостаточно прав"
+        )
+    
+    rows = (await db.execute(
+        select(
+            Certificate.code,
+            Certificate.initial_amount,
+            Certificate.valid_until,
+            Certificate.status,
+            Certificate.issue_version,
+        )
+        .where(certificate_batch_id == batch_id)
+        .order_by(Certificate.id)
+    )).all()
+    
+    if not rows:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пакет сертификатов не найден"
+        )
+    
+    return StreamingResponse(
+        _stream_batch_zip(rows),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="certificates_{batch_id}.zip"'}
+    )
+
+
+@router.get("/signing-key", response_model=CertificateSigningKeyResponse)
+def get_signing_key():
+    """Открытый ключ подписи QR-кодов для кассовых терминалов (публичный endpoint)"""
+    return CertificateSigningKeyResponse(
+        algorithm="Ed25519",
+        key_id=certificate_token.key_id(),
+        public_key=base64.b64encode(certificate_token.public_key_bytes()).decode("ascii"),
+        token_format="c1.base64url(code|nominal_kopecks|valid_until_unix|issue_version).base64url(signature)",
+    )
+
+
 @router.get("/my", response_model=List[CertificateResponse])
 def get_my_certificates(
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение списка сертификатов текущего пользователя"""
@@ -129,8 +368,7 @@ def get_my_certificates(
     responses = []
     for cert in certificates:
         response = CertificateResponse.from_orm(cert)
-        if cert.qr_code_path:
-            response.qr_code_url = f"https://{settings.DOMAIN}/qrcodes/{cert.code}.png"
+        response.qr_code_url = qr_render.qr_code_url(cert.code)
         responses.append(response)
     
     return responses
@@ -139,7 +377,7 @@ def get_my_certificates(
 @router.get("/{certificate_id}", response_model=CertificateResponse)
 def get_certificate(
     certificate_id: int,
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение информации о сертификате"""
@@ -160,16 +398,16 @@ def get_certificate(
         )
     
     response = CertificateResponse.from_orm(certificate)
-    if certificate.qr_code_path:
-        response.qr_code_url = f"https://{settings.DOMAIN}/qrcodes/{certificate.code}.png"
+    response.qr_code_url = qr_render.qr_code_url(certificate.code)
     
     return response
 
 
 @router.post("/transfer", status_code=status.HTTP_200_OK)
 def transfer_certificate(
+    background_tasks: BackgroundTasks,
     request_data: dict = Body(...),
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Передача сертификата другому пользователю (по коду или ID)"""
@@ -250,6 +488,7 @@ def transfer_certificate(
     db.add(audit)
     
     db.commit()
+    background_tasks.add_task(certificate_cache.invalidate, certificate.code)
     
     logger.info(f"Сертификат {certificate.code} передан к {recipient.email}")
     
@@ -259,61 +498,84 @@ def transfer_certificate(
 
 
 @router.post("/verify", response_model=CertificateVerifyResponse)
-def verify_certificate(
+async def verify_certificate(
     verify_data: CertificateVerifyRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Проверка действительности сертификата (публичный endpoint)"""
-    
-    certificate = db.query(Certificate).filter(Certificate.code == verify_data.code).first()
-    
-    if not certificate:
+    """Проверка действительности сертификата (публичный endpoint, только чтение)"""
+    
+    code = verify_data.code
+    claims = None
+    if verify_data.token:
+        # Подпись и срок проверяются без БД: поддельный или просроченный QR не доходит до запросов
+        try:
+            claims = certificate_token.verify(verify_data.token)
+        except certificate_token.InvalidCertificateToken as e:
+            return CertificateVerifyResponse(valid=False, certificate=None, message=str(e))
+        if code and code != claims.code:
+            return CertificateVerifyResponse(valid=False, certificate=None, message="Код не совпадает с QR-кодом")
+        if claims.expired():
+            return CertificateVerifyResponse(valid=False, certificate=None, message="Срок действия сертификата истек")
+        code = claims.code
+    
+    # Снимок из кеша; при попадании сессия БД не открывает соединение
+    hit, snapshot = await certificate_cache.get(code)
+    if not hit:
+        certificate = (await db.execute(
+            select(Certificate).where(Certificate.code == code)
+        )).scalars().first()
+        if certificate:
+            response = CertificateResponse.from_orm(certificate)
+            response.qr_code_url = qr_render.qr_code_url(certificate.code)
+            snapshot = response.model_dump(mode="json")
+        await certificate_cache.put(code, snapshot)
+    
+    if snapshot is None:
         return CertificateVerifyResponse(
             valid=False,
             certificate=None,
             message="Сертификат не найден"
         )
     
-    # Проверка срока действия
+    certificate = CertificateResponse(**snapshot)
+    if claims and claims.issue_version != certificate.issue_version:
+        return CertificateVerifyResponse(
+            valid=False,
+            certificate=certificate,
+            message="QR-код устарел: сертификат перевыпущен"
+        )
+    
+    stored_status = certificate.status
     now = datetime.now(timezone.utc)
-    valid_until = certificate.valid_until
-    if valid_until.tzinfo is None:
-        valid_until = valid_until.replace(tzinfo=timezone.utc)
+    certificate.status = effective_status(stored_status, certificate.valid_until, certificate.current_amount, now)
     
-    if now > valid_until:
-        certificate.status = CertificateStatus.EXPIRED
-        db.commit()
+    # Проверка срока действия
+    if certificate.status == CertificateStatus.EXPIRED:
         return CertificateVerifyResponse(
             valid=False,
-            certificate=CertificateResponse.from_orm(certificate),
+            certificate=certificate,
             message="Срок действия сертификата истек"
         )
     
     # Проверка статуса
-    if certificate.status != CertificateStatus.ACTIVE:
+    if stored_status != CertificateStatus.ACTIVE:
         return CertificateVerifyResponse(
             valid=False,
-            certificate=CertificateResponse.from_orm(certificate),
-            message=f"Сертификат имеет статус: {certificate.status}"
+            certificate=certificate,
+            message=f"Сертификат имеет статус: {stored_status}"
         )
     
     # Проверка баланса
-    if certificate.current_amount <= 0:
-        certificate.status = CertificateStatus.USED
-        db.commit()
+    if certificate.status == CertificateStatus.USED:
         return CertificateVerifyResponse(
             valid=False,
-            certificate=CertificateResponse.from_orm(certificate),
+            certificate=certificate,
             message="Сертификат полностью использован"
         )
     
-    response = CertificateResponse.from_orm(certificate)
-    if certificate.qr_code_path:
-        response.qr_code_url = f"https://{settings.DOMAIN}/qrcodes/{certificate.code}.png"
-    
     return CertificateVerifyResponse(
         valid=True,
-        certificate=response,
+        certificate=certificate,
         message=f"Сертификат действителен. Доступно: {certificate.current_amount} руб."
     )
 
@@ -321,7 +583,8 @@ def verify_certificate(
 @router.post("/redeem", response_model=CertificateRedeemResponse)
 def redeem_certificate(
     redeem_data: CertificateRedeemRequest,
-    current_user: User = Depends(get_current_active_user),
+    background_tasks: BackgroundTasks,
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Использование (погашение) сертификата на кассе"""
@@ -332,81 +595,75 @@ def redeem_certificate(
             detail="Недостаточно прав для погашения сертификата"
         )
     
-    certificate = db.query(Certificate).filter(Certificate.code == redeem_data.code).first()
+    code = redeem_data.code
+    issue_version = None
+    if redeem_data.token:
+        # Подпись и срок проверяются до запроса в БД
+        try:
+            claims = certificate_token.verify(redeem_data.token)
+        except certificate_token.InvalidCertificateToken as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        if code and code != claims.code:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Код не совпадает с QR-кодом")
+        if claims.expired():
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Срок действия сертификата истек")
+        code, issue_version = claims.code, claims.issue_version
     
-    if not certificate:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Сертификат не найден"
+    try:
+        result = certificate_redemption.redeem(
+            db,
+            code=code,
+            issue_version=issue_version,
+            amount=redeem_data.amount,
+            redeemed_by_id=current_user.id,  # Берем из токена, а не из запроса
+            onec_document_id=redeem_data.onec_document_id,
+            notes=redeem_data.notes,
         )
-    
-    # Проверка статуса
-    if certificate.status != CertificateStatus.ACTIVE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Сертификат не может быть использован. Статус: {certificate.status}"
+        
+        # Аудит
+        audit = AuditLog(
+            user_id=current_user.id,
+            action="redeem_certificate",
+            entity_type="certificate",
+            entity_id=result.certificate_id,
+            old_values={"amount": result.remaining_amount + redeem_data.amount, "status": "active"},
+            new_values={"amount": result.remaining_amount, "status": result.status}
         )
-    
-    # Проверка срока действия
-    now = datetime.now(timezone.utc)
-    valid_until = certificate.valid_until
-    if valid_until.tzinfo is None:
-        valid_until = valid_until.replace(tzinfo=timezone.utc)
-    
-    if now > valid_until:
-        certificate.status = CertificateStatus.EXPIRED
+        db.add(audit)
         db.commit()
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Срок действия сертификата истек"
-        )
-    
-    # Проверка суммы
-    if redeem_data.amount > certificate.current_amount:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Недостаточно средств на сертификате. Доступно: {certificate.current_amount}"
+    except certificate_redemption.CertificateNotFoundError as e:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except certificate_redemption.RedemptionError as e:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except IntegrityError:
+        # Документ 1С уже погашен — списание откатилось
+        db.rollback()
+        found = certificate_redemption.find_by_document(db, redeem_data.onec_document_id) if redeem_data.onec_document_id else None
+        if not found:
+            raise
+        try:
+            # Повтор запроса с кассы — ответ прежний; номер документа с другим погашением — 409
+            existing = certificate_redemption.check_replay(found, code, redeem_data.amount)
+        except certificate_redemption.DocumentConflictError as e:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+        return CertificateRedeemResponse(
+            success=True,
+            certificate_id=existing.certificate_id,
+            amount_used=existing.amount_used,
+            remaining_amount=existing.remaining_amount,
+            message=f"Погашение по документу {existing.onec_document_id} уже проведено. Остаток: {existing.remaining_amount} руб."
         )
     
-    # Списание суммы
-    old_amount = certificate.current_amount
-    certificate.current_amount -= redeem_data.amount
-    remaining_amount = certificate.current_amount
+    background_tasks.add_task(certificate_cache.invalidate, code)
+    remaining_amount = result.remaining_amount
     
-    # Если сертификат использован полностью
-    if certificate.current_amount <= 0:
-        certificate.status = CertificateStatus.USED
-        certificate.used_at = datetime.utcnow()
-    
-    # Создание записи о погашении
-    redemption = CertificateRedemption(
-        certificate_id=certificate.id,
-        amount_used=redeem_data.amount,
-        remaining_amount=remaining_amount,
-        onec_document_id=redeem_data.onec_document_id,
-        redeemed_by_id=current_user.id,  # Берем из токена, а не из запроса
-        notes=redeem_data.notes
-    )
-    db.add(redemption)
-    
-    # Аудит
-    audit = AuditLog(
-        user_id=current_user.id,
-        action="redeem_certificate",
-        entity_type="certificate",
-        entity_id=certificate.id,
-        old_values={"amount": old_amount, "status": "active"},
-        new_values={"amount": remaining_amount, "status": certificate.status}
-    )
-    db.add(audit)
-    
-    db.commit()
-    
-    logger.info(f"Сертификат {certificate.code} использован на сумму {redeem_data.amount}. Остаток: {remaining_amount}")
+    logger.info(f"Сертификат {code} использован на сумму {redeem_data.amount}. Остаток: {remaining_amount}")
     
     return CertificateRedeemResponse(
         success=True,
-        certificate_id=certificate.id,
+        certificate_id=result.certificate_id,
         amount_used=redeem_data.amount,
         remaining_amount=remaining_amount,
         message=f"Сертификат успешно использован. Остаток: {remaining_amount} руб."
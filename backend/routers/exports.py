@@ -0,0 +1,269 @@
+"""
+Выгрузки для бухгалтерии: транзакции лояльности, сертификаты, журнал аудита.
+
+Строки читаются серверным курсором (yield_per) порциями и сразу пишутся
+в ответ, поэтому память не зависит от размера выгрузки:
+  csv  — байты уходят клиенту с первой порции (UTF-8 с BOM, разделитель «;»,
+         чтобы файл открывался в Excel без мастера импорта);
+  xlsx — openpyxl в режиме write-only; XLSX — это zip, который собирается
+         только после записи последней строки, поэтому файл копится во
+         временном файле на диске и отдаётся целиком по готовности
+         (в nginx для /api/admin/export/ увеличен proxy_read_timeout).
+         Лист ограничен 1 048 576 строками, дальше создаются новые листы.
+
+Время во всех выгрузках — UTC.
+"""
+import csv
+import enum
+import io
+import json
+from datetime import datetime, timezone
+from tempfile import SpooledTemporaryFile
+from typing import Iterator, Optional
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from openpyxl import Workbook
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, get_db
+from models import AuditLog, Certificate, CertificateStatus, LoyaltyAccount, LoyaltyTransaction, User
+from principal_cache import Principal
+from routers.admin import require_admin
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+EXPORT_CHUNK_ROWS = 2000  # строк за одну выборку из серверного курсора
+XLSX_MAX_ROWS = 1_048_576  # лимит строк на лист Excel, включая заголовок
+XLSX_SPOOL_SIZE = 16 * 1024 * 1024  # до этого размера файл держится в памяти
+READ_BLOCK_SIZE = 64 * 1024
+
+MEDIA_TYPES = {
+    "csv": "text/csv",  # charset добавляет StreamingResponse
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def _cell(value):
+    """Приведение значения к виду, который понимают и csv, и openpyxl"""
+    if isinstance(value, datetime):
+        # Excel не поддерживает часовые пояса
+        return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def _fetch_chunks(stmt) -> Iterator[list[list]]:
+    """Порции строк из серверного курсора; сессия своя, т.к. ответ стримится после выхода из эндпоинта"""
+    db = SessionLocal()
+    try:
+        result = db.execute(stmt.execution_options(yield_per=EXPORT_CHUNK_ROWS))
+        for partition in result.partitions():
+            yield [[_cell(value) for value in row] for row in partition]
+    finally:
+        db.close()
+
+
+def _csv_stream(headers: list[str], chunks: Iterator[list[list]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    buffer.write("\ufeff")  # BOM для Excel
+    writer.writerow(headers)
+    yield buffer.getvalue().encode("utf-8")
+
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _xlsx_stream(headers: list[str], chunks: Iterator[list[list]], title: str) -> Iterator[bytes]:
+    workbook = Workbook(write_only=True)
+    sheet, rows_in_sheet, sheets = None, XLSX_MAX_ROWS, 0
+
+    for chunk in chunks:
+        for row in chunk:
+            if rows_in_sheet >= XLSX_MAX_ROWS:
+                sheets += 1
+                sheet = workbook.create_sheet(title if sheets == 1 else f"{title} {sheets}")
+                sheet.append(headers)
+                rows_in_sheet = 1
+            sheet.append(row)
+            rows_in_sheet += 1
+
+    if sheet is None:
+        workbook.create_sheet(title).append(headers)
+
+    with SpooledTemporaryFile(max_size=XLSX_SPOOL_SIZE) as tmp:
+        workbook.save(tmp)
+        tmp.seek(0)
+        while block := tmp.read(READ_BLOCK_SIZE):
+            yield block
+
+
+def _export_response(
+    name: str,
+    fmt: str,
+    headers: list[str],
+    stmt,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+) -> StreamingResponse:
+    chunks = _fetch_chunks(stmt)
+    body = _csv_stream(headers, chunks) if fmt == "csv" else _xlsx_stream(headers, chunks, name)
+
+    period = "_".join(d.strftime("%Y-%m-%d") for d in (start_date, end_date) if d)
+    filename = f"{name}_{period}.{fmt}" if period else f"{name}.{fmt}"
+    return StreamingResponse(
+        body,
+        media_type=MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _audit_export(db: Session, user: Principal, name: str, params: dict):
+    """Выгрузки содержат персональные данные — фиксируем, кто и что выгрузил"""
+    db.add(AuditLog(
+        user_id=user.id,
+        action="export",
+        entity_type=name,
+        new_values={k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in params.items()},
+    ))
+    db.commit()
+    logger.info(f"Выгрузка {name} пользователем {user.id}: {params}")
+
+
+@router.get("/transactions")
+def export_transactions(
+    fmt: str = Query("csv", alias="format", pattern="^(csv|xlsx)$"),
+    start_date: Optional[datetime] = Query(None),
+    end_date: Optional[datetime] = Query(None),
+    current_user: Principal = Depends(require_admin),
+    db: Session = Depends(get_db)
+):
+    """Выгрузка транзакций лояльности за период"""
+
+    _audit_export(db, current_user, "transactions", {"format": fmt, "start_date": start_date, "end_date": end_date})
+
+    stmt = (
+        select(
+            LoyaltyTransaction.id,
+            LoyaltyTransaction.created_at,
+            LoyaltyTransaction.account_id,
+            User.email,
+            User.full_name,
+            User.external_id,
+            LoyaltyTransaction.transaction_type,
+            LoyaltyTransaction.currency,
+            LoyaltyTransaction.amount,
+            LoyaltyTransaction.source,
+            LoyaltyTransaction.source_id,
+            LoyaltyTransaction.description,
+            LoyaltyTransaction.is_reversed,
+        )
+        .join(LoyaltyAccount, LoyaltyAccount.id == LoyaltyTransaction.account_id)
+        .join(User, User.id == LoyaltyAccount.user_id)
+        .order_by(LoyaltyTransaction.id)
+    )
+    if start_date:
+        stmt = stmt.where(LoyaltyTransaction.created_at >= start_date)
+    if end_date:
+        stmt = stmt.where(LoyaltyTransaction.created_at <= end_date)
+
+    headers = [
+        "ID", "Дата (UTC)", "Аккаунт", "Email", "ФИО", "ID в 1С", "Тип", "Валюта",
+        "Сумма", "Источник", "ID источника", "Описание", "Отменена",
+    ]
+    return _export_response("transactions", fmt, headers, stmt, start_date, end_date)
+
+
+@router.get("/certificates")
+def export_certificates(
+    fmt: str = Query("csv", alias="format", pattern="^(csv|xlsx)$"),
+    start_date: Optional[datetime] = Query(None),
+    end_date: Optional[datetime] = Query(None),
+    status: Optional[CertificateStatus] = Query(None),
+    current_user: Principal = Depends(require_admin),
+    db: Session = Depends(get_db)
+):
+    """Выгрузка сертификатов, выпущенных за период"""
+
+    _audit_export(db, current_user, "certificates", {
+        "format": fmt, "start_date": start_date, "end_date": end_date, "status": status and status.value
+    })
+
+    stmt = (
+        select(
+            Certificate.id,
+            Certificate.code,
+            Certificate.issued_at,
+            Certificate.valid_until,
+            Certificate.status,
+            Certificate.initial_amount,
+            Certificate.current_amount,
+            User.email,
+            Certificate.used_at,
+        )
+        .outerjoin(User, User.id == Certificate.owner_id)
+        .order_by(Certificate.id)
+    )
+    if start_date:
+        stmt = stmt.where(Certificate.issued_at >= start_date)
+    if end_date:
+        stmt = stmt.where(Certificate.issued_at <= end_date)
+    if status:
+        stmt = stmt.where(Certificate.status == status)
+
+    headers = [
+        "ID", "Код", "Выпущен (UTC)", "Действует до (UTC)", "Статус", "Номинал",
+        "Остаток", "Владелец", "Использован (UTC)",
+    ]
+    return _export_response("certificates", fmt, headers, stmt, start_date, end_date)
+
+
+@router.get("/audit-log")
+def export_audit_log(
+    fmt: str = Query("csv", alias="format", pattern="^(csv|xlsx)$"),
+    start_date: Optional[datetime] = Query(None),
+    end_date: Optional[datetime] = Query(None),
+    entity_type: Optional[str] = Query(None),
+    current_user: Principal = Depends(require_admin),
+    db: Session = Depends(get_db)
+):
+    """Выгрузка журнала аудита за период"""
+
+    _audit_export(db, current_user, "audit_log", {
+        "format": fmt, "start_date": start_date, "end_date": end_date, "entity_type": entity_type
+    })
+
+    stmt = select(
+        AuditLog.id,
+        AuditLog.created_at,
+        AuditLog.user_id,
+        AuditLog.action,
+        AuditLog.entity_type,
+        AuditLog.entity_id,
+        AuditLog.ip_address,
+        AuditLog.old_values,
+        AuditLog.new_values,
+    ).order_by(AuditLog.id)
+    if start_date:
+        stmt = stmt.where(AuditLog.created_at >= start_date)
+    if end_date:
+        stmt = stmt.where(AuditLog.created_at <= end_date)
+    if entity_type:
+        stmt = stmt.where(AuditLog.entity_type == entity_type)
+
+    headers = [
+        "ID", "Дата (UTC)", "Пользователь", "Действие", "Тип сущности", "ID сущности",
+        "IP", "Было", "Стало",
+    ]
+    return _export_response("audit_log", fmt, headers, stmt, start_date, end_date)
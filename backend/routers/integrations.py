@@ -1,12 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Header
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 import httpx
 from typing import Optional
 
-from database import get_db
-from models import User, LoyaltyAccount, LoyaltyTransaction, TransactionType, ReferralEvent, ReferralEventType
+import ledger
+from circuit_breaker import CircuitOpenError, get_breaker
+from database import get_async_db
+from models import User, LoyaltyAccount, TransactionType, ReferralEvent, ReferralEventType
 from schemas import OneCWebhookVisit, OneCWebhookPayment, BitrixWebhookContact
 from config import settings
+from onec_utils import get_onec_client
 import logging
 
 logger = logging.getLogger(__name__)
@@ -30,7 +35,7 @@ def verify_webhook_token(x_webhook_token: Optional[str] = Header(None)):
 @router.post("/1c/visit")
 async def handle_1c_visit(
     visit_data: OneCWebhookVisit,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     token: str = Depends(verify_webhook_token)
 ):
     """Webhook от 1С о визите пациента - начисление баллов/кешбэка"""
@@ -38,58 +43,54 @@ async def handle_1c_visit(
     logger.info(f"Получен webhook от 1С о визите: {visit_data.document_id}")
     
     # Поиск пользователя по external_id
-    user = db.query(User).filter(User.external_id == visit_data.patient_external_id).first()
+    user = (await db.execute(
+        select(User).where(User.external_id == visit_data.patient_external_id)
+    )).scalars().first()
     
     if not user:
         logger.warning(f"Пользователь с external_id {visit_data.patient_external_id} не найден")
         return {"status": "user_not_found", "message": "Пользователь не найден в системе"}
     
     # Поиск аккаунта лояльности
-    account = db.query(LoyaltyAccount).filter(LoyaltyAccount.user_id == user.id).first()
+    account = (await db.execute(
+        select(LoyaltyAccount).where(LoyaltyAccount.user_id == user.id)
+    )).scalars().first()
     
     if not account:
         logger.warning(f"Аккаунт лояльности не найден для пользователя {user.id}")
         return {"status": "account_not_found", "message": "Аккаунт лояльности не найден"}
     
-    # Начисление баллов (если указано)
-    if visit_data.points_to_accrue and visit_data.points_to_accrue > 0:
-        transaction = LoyaltyTransaction(
-            account_id=account.id,
-            transaction_type=TransactionType.ACCRUAL,
-            amount=visit_data.points_to_accrue,
-            currency="points",
-            source="1c_visit",
-            source_id=visit_data.document_id,
-            description=f"Начисление баллов за визит от {visit_data.visit_date.strftime('%d.%m.%Y')}",
-            idempotency_key=f"1c_visit_{visit_data.document_id}_points"
-        )
-        
-        account.points_balance += visit_data.points_to_accrue
-        account.total_points_earned += visit_data.points_to_accrue
-        
-        db.add(transaction)
-        logger.info(f"Начислено {visit_data.points_to_accrue} баллов пользователю {user.email}")
-    
-    # Начисление кешбэка (если указано)
-    if visit_data.cashback_to_accrue and visit_data.cashback_to_accrue > 0:
-        transaction = LoyaltyTransaction(
-            account_id=account.id,
-            transaction_type=TransactionType.ACCRUAL,
-            amount=visit_data.cashback_to_accrue,
-            currency="cashback",
-            source="1c_visit",
-            source_id=visit_data.document_id,
-            description=f"Начисление кешбэка за визит от {visit_data.visit_date.strftime('%d.%m.%Y')}",
-            idempotency_key=f"1c_visit_{visit_data.document_id}_cashback"
-        )
-        
-        account.cashback_balance += visit_data.cashback_to_accrue
-        account.total_cashback_earned += visit_data.cashback_to_accrue
-        
-        db.add(transaction)
-        logger.info(f"Начислено {visit_data.cashback_to_accrue} руб. кешбэка пользователю {user.email}")
-    
-    db.commit()
+    # Начисление баллов и кешбэка одной транзакцией БД
+    accruals = [
+        ("points", visit_data.points_to_accrue, "баллов", "баллов"),
+        ("cashback", visit_data.cashback_to_accrue, "кешбэка", "руб. кешбэка"),
+    ]
+    try:
+        for currency, amount, label, unit in accruals:
+            if not amount or amount <= 0:
+                continue
+            result = await ledger.post_entry_async(
+                db,
+                account_id=account.id,
+                transaction_type=TransactionType.ACCRUAL,
+                amount=amount,
+                currency=currency,
+                source="1c_visit",
+                source_id=visit_data.document_id,
+                description=f"Начисление {label} за визит от {visit_data.visit_date.strftime('%d.%m.%Y')}",
+                idempotency_key=f"1c_visit_{visit_data.document_id}_{currency}",
+                audit_action="1c_visit_accrual",
+            )
+            if result.created:
+                logger.info(f"Начислено {amount} {unit} пользователю {user.email}")
+            else:
+                logger.info(f"Визит {visit_data.document_id}: {currency} уже начислены ранее")
+        await db.commit()
+    except IntegrityError:
+        # Повторная доставка webhook параллельно с первой — начисление уже есть
+        await db.rollback()
+        logger.info(f"Визит {visit_data.document_id} уже обработан")
+        return {"status": "already_processed", "message": "Визит уже обработан", "user_id": user.id}
     
     return {
         "status": "success",
@@ -103,7 +104,7 @@ async def handle_1c_visit(
 @router.post("/1c/payment")
 async def handle_1c_payment(
     payment_data: OneCWebhookPayment,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     token: str = Depends(verify_webhook_token)
 ):
     """Webhook от 1С об оплате"""
@@ -119,7 +120,7 @@ async def handle_1c_payment(
 @router.get("/1c/sync-patient/{external_id}")
 async def sync_patient_from_1c(
     external_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Синхронизация данных пациента из 1С"""
     
@@ -131,17 +132,12 @@ async def sync_patient_from_1c(
     
     try:
         # Запрос к 1С API
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{settings.ONEC_API_URL}/patients/{external_id}",
-                auth=(settings.ONEC_USERNAME, settings.ONEC_PASSWORD),
-                timeout=10.0
-            )
-            response.raise_for_status()
-            patient_data = response.json()
+        response = await get_onec_client().get(f"patients/{external_id}", timeout=10.0)
+        response.raise_for_status()
+        patient_data = response.json()
         
         # Обновление или создание пользователя
-        user = db.query(User).filter(User.external_id == external_id).first()
+        user = (await db.execute(select(User).where(User.external_id == external_id))).scalars().first()
         
         if user:
             user.full_name = patient_data.get("full_name", user.full_name)
@@ -153,10 +149,16 @@ async def sync_patient_from_1c(
             logger.info(f"Создание нового пользователя из 1С: {external_id}")
             # Здесь должна быть логика создания пользователя
         
-        db.commit()
+        await db.commit()
         
         return {"status": "success", "message": "Данные синхронизированы"}
         
+    except CircuitOpenError as e:
+        logger.warning(f"1С временно недоступна: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="1С временно недоступна, попробуйте позже"
+        )
     except httpx.HTTPError as e:
         logger.error(f"Ошибка синхронизации с 1С: {e}")
         raise HTTPException(
@@ -170,7 +172,7 @@ async def sync_patient_from_1c(
 @router.post("/bitrix/contact")
 async def handle_bitrix_contact(
     contact_data: BitrixWebhookContact,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     token: str = Depends(verify_webhook_token)
 ):
     """Webhook от Bitrix о создании/обновлении контакта"""
@@ -178,7 +180,7 @@ async def handle_bitrix_contact(
     logger.info(f"Получен webhook от Bitrix о контакте: {contact_data.contact_id}")
     
     # Поиск или создание пользователя
-    user = db.query(User).filter(User.email == contact_data.email).first()
+    user = (await db.execute(select(User).where(User.email == contact_data.email))).scalars().first()
     
     if user:
         # Обновление данных
@@ -198,7 +200,7 @@ async def handle_bitrix_contact(
             role="patient"
         )
         db.add(user)
-        db.flush()
+        await db.flush()
         
         # Создание аккаунта лояльности
         import random
@@ -211,7 +213,7 @@ async def handle_bitrix_contact(
         
         logger.info(f"Создан новый пользователь из Bitrix: {user.email}")
     
-    db.commit()
+    await db.commit()
     
     return {
         "status": "success",
@@ -223,7 +225,7 @@ async def handle_bitrix_contact(
 @router.get("/bitrix/push-balance/{user_id}")
 async def push_balance_to_bitrix(
     user_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Отправка баланса пользователя в Bitrix"""
     
@@ -233,14 +235,16 @@ async def push_balance_to_bitrix(
             detail="Bitrix интеграция не настроена"
         )
     
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Пользователь не найден"
         )
     
-    account = db.query(LoyaltyAccount).filter(LoyaltyAccount.user_id == user_id).first()
+    account = (await db.execute(
+        select(LoyaltyAccount).where(LoyaltyAccount.user_id == user_id)
+    )).scalars().first()
     if not account:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -249,7 +253,7 @@ async def push_balance_to_bitrix(
     
     try:
         # Отправка в Bitrix
-        async with httpx.AsyncClient() as client:
+        async with get_breaker("bitrix_rest"), httpx.AsyncClient() as client:
             response = await client.post(
                 f"{settings.BITRIX_API_URL}/{settings.BITRIX_WEBHOOK}/crm.contact.update",
                 json={
@@ -268,6 +272,12 @@ async def push_balance_to_bitrix(
         
         return {"status": "success", "message": "Баланс отправлен в Bitrix"}
         
+    except CircuitOpenError as e:
+        logger.warning(f"Bitrix временно недоступен: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Bitrix временно недоступен, попробуйте позже"
+        )
     except httpx.HTTPError as e:
         logger.error(f"Ошибка отправки в Bitrix: {e}")
         raise HTTPException(
@@ -1,17 +1,26 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from sqlalchemy.orm import Session
 from sqlalchemy import desc
-from typing import List
+from sqlalchemy.exc import IntegrityError
+from typing import List, Optional
+from collections import Counter
 
+import ledger
+from config import settings
 from database import get_db
-from models import User, LoyaltyAccount, LoyaltyTransaction, TransactionType, AuditLog
+from pagination import keyset_page
+from models import LoyaltyAccount, LoyaltyTransaction, TransactionType
 from schemas import (
     LoyaltyAccountResponse, 
     LoyaltyTransactionCreate, 
     LoyaltyTransactionResponse,
     BalanceResponse,
-    TransactionHistoryResponse
+    TransactionHistoryResponse,
+    LoyaltyTransactionBatchCreate,
+    LoyaltyTransactionBatchItemResult,
+    LoyaltyTransactionBatchResponse
 )
+from principal_cache import Principal
 from routers.auth import get_current_active_user
 import logging
 
@@ -20,23 +29,9 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-def create_audit_log(db: Session, user_id: int, action: str, entity_type: str, entity_id: int, 
-                     old_values: dict = None, new_values: dict = None):
-    """Создание записи аудита"""
-    audit = AuditLog(
-        user_id=user_id,
-        action=action,
-        entity_type=entity_type,
-        entity_id=entity_id,
-        old_values=old_values,
-        new_values=new_values
-    )
-    db.add(audit)
-
-
 @router.get("/balance", response_model=BalanceResponse)
 def get_balance(
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение баланса текущего пользователя"""
@@ -49,22 +44,19 @@ def get_balance(
             detail="Аккаунт лояльности не найден"
         )
     
-    transactions_count = db.query(LoyaltyTransaction).filter(
-        LoyaltyTransaction.account_id == account.id
-    ).count()
-    
     return BalanceResponse(
         points_balance=account.points_balance,
         cashback_balance=account.cashback_balance,
         card_tier=account.card_tier,
-        transactions_count=transactions_count
+        transactions_count=account.transactions_count,
+        last_transaction_at=account.last_transaction_at
     )
 
 
 @router.get("/balance/{user_id}", response_model=BalanceResponse)
 def get_user_balance(
     user_id: int,
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение баланса пользователя (для админов и кассиров)"""
@@ -83,23 +75,21 @@ def get_user_balance(
             detail="Аккаунт лояльности не найден"
         )
     
-    transactions_count = db.query(LoyaltyTransaction).filter(
-        LoyaltyTransaction.account_id == account.id
-    ).count()
-    
     return BalanceResponse(
         points_balance=account.points_balance,
         cashback_balance=account.cashback_balance,
         card_tier=account.card_tier,
-        transactions_count=transactions_count
+        transactions_count=account.transactions_count,
+        last_transaction_at=account.last_transaction_at
     )
 
 
 @router.get("/transactions", response_model=TransactionHistoryResponse)
 def get_transactions(
-    page: int = Query(1, ge=1),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы"),
+    page: Optional[int] = Query(None, ge=1, description="Номер страницы (устаревший режим, с total)"),
     page_size: int = Query(20, ge=1, le=100),
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение истории транзакций текущего пользователя"""
@@ -112,30 +102,81 @@ def get_transactions(
             detail="Аккаунт лояльности не найден"
         )
     
-    # Подсчет общего количества
-    total = db.query(LoyaltyTransaction).filter(
-        LoyaltyTransaction.account_id == account.id
-    ).count()
-    
-    # Получение транзакций с пагинацией
-    transactions = db.query(LoyaltyTransaction).filter(
-        LoyaltyTransaction.account_id == account.id
-    ).order_by(desc(LoyaltyTransaction.created_at)).offset(
-        (page - 1) * page_size
-    ).limit(page_size).all()
+    query = db.query(LoyaltyTransaction).filter(LoyaltyTransaction.account_id == account.id)
+    
+    if page is not None and not cursor:
+        # Постраничный режим для старых клиентов
+        total = query.count()
+        transactions = query.order_by(
+            desc(LoyaltyTransaction.created_at), desc(LoyaltyTransaction.id)
+        ).offset((page - 1) * page_size).limit(page_size).all()
+        next_cursor = None
+    else:
+        total = None
+        transactions, next_cursor = keyset_page(
+            query, LoyaltyTransaction.created_at, LoyaltyTransaction.id, cursor, page_size
+        )
     
     return TransactionHistoryResponse(
         transactions=[LoyaltyTransactionResponse.from_orm(t) for t in transactions],
         total=total,
         page=page,
-        page_size=page_size
+        page_size=page_size,
+        next_cursor=next_cursor
     )
 
 
+def _post_transaction(
+    transaction: LoyaltyTransactionCreate,
+    transaction_type: TransactionType,
+    audit_action: str,
+    current_user: Principal,
+    db: Session,
+) -> LoyaltyTransactionResponse:
+    """Проводка через ledger с одним commit и обработкой параллельного дубля"""
+    try:
+        result = ledger.post_entry(
+            db,
+            account_id=transaction.account_id,
+            transaction_type=transaction_type,
+            amount=transaction.amount,
+            currency=transaction.currency,
+            source=transaction.source,
+            source_id=transaction.source_id,
+            description=transaction.description,
+            extra_data=transaction.metadata,
+            idempotency_key=transaction.idempotency_key,
+            created_by=current_user.id,
+            audit_action=audit_action,
+        )
+        if result.created:
+            db.commit()
+    except ledger.AccountNotFoundError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Аккаунт лояльности не найден"
+        )
+    except ledger.LedgerError as e:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except IntegrityError:
+        # Параллельный запрос с тем же ключом успел раньше
+        db.rollback()
+        existing = transaction.idempotency_key and ledger.find_by_idempotency_key(db, transaction.idempotency_key)
+        if not existing:
+            raise
+        result = ledger.LedgerResult(existing, created=False)
+
+    if not result.created:
+        logger.info(f"Транзакция с ключом {transaction.idempotency_key} уже существует")
+    return LoyaltyTransactionResponse.from_orm(result.transaction)
+
+
 @router.post("/accrue", response_model=LoyaltyTransactionResponse, status_code=status.HTTP_201_CREATED)
 def accrue_points(
     transaction: LoyaltyTransactionCreate,
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Начисление баллов/кешбэка (только для админов и системы)"""
@@ -146,73 +187,15 @@ def accrue_points(
             detail="Недостаточно прав для начисления баллов"
         )
     
-    # Проверка идемпотентности
-    if transaction.idempotency_key:
-        existing = db.query(LoyaltyTransaction).filter(
-            LoyaltyTransaction.idempotency_key == transaction.idempotency_key
-        ).first()
-        if existing:
-            logger.info(f"Транзакция с ключом {transaction.idempotency_key} уже существует")
-            return LoyaltyTransactionResponse.from_orm(existing)
-    
-    account = db.query(LoyaltyAccount).filter(LoyaltyAccount.id == transaction.account_id).first()
-    
-    if not account:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Аккаунт лояльности не найден"
-        )
-    
-    # Сохранение старого баланса для аудита
-    old_balance = {
-        "points": account.points_balance,
-        "cashback": account.cashback_balance
-    }
-    
-    # Обновление баланса
-    if transaction.currency == "points":
-        account.points_balance += transaction.amount
-        account.total_points_earned += transaction.amount
-    elif transaction.currency == "cashback":
-        account.cashback_balance += transaction.amount
-        account.total_cashback_earned += transaction.amount
-    
-    # Создание транзакции
-    new_transaction = LoyaltyTransaction(
-        account_id=account.id,
-        transaction_type=TransactionType.ACCRUAL,
-        amount=transaction.amount,
-        currency=transaction.currency,
-        source=transaction.source,
-        source_id=transaction.source_id,
-        description=transaction.description,
-        metadata=transaction.metadata,
-        idempotency_key=transaction.idempotency_key,
-        created_by=current_user.id
-    )
-    
-    db.add(new_transaction)
-    db.commit()
-    db.refresh(new_transaction)
-    
-    # Аудит
-    new_balance = {
-        "points": account.points_balance,
-        "cashback": account.cashback_balance
-    }
-    create_audit_log(db, current_user.id, "accrue_points", "loyalty_transaction", 
-                     new_transaction.id, old_balance, new_balance)
-    db.commit()
-    
-    logger.info(f"Начислено {transaction.amount} {transaction.currency} на аккаунт {account.id}")
-    
-    return LoyaltyTransactionResponse.from_orm(new_transaction)
+    response = _post_transaction(transaction, TransactionType.ACCRUAL, "accrue_points", current_user, db)
+    logger.info(f"Начислено {transaction.amount} {transaction.currency} на аккаунт {transaction.account_id}")
+    return response
 
 
 @router.post("/deduct", response_model=LoyaltyTransactionResponse, status_code=status.HTTP_201_CREATED)
 def deduct_points(
     transaction: LoyaltyTransactionCreate,
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Списание баллов/кешбэка"""
@@ -223,86 +206,57 @@ def deduct_points(
             detail="Недостаточно прав для списания баллов"
         )
     
-    # Проверка идемпотентности
-    if transaction.idempotency_key:
-        existing = db.query(LoyaltyTransaction).filter(
-            LoyaltyTransaction.idempotency_key == transaction.idempotency_key
-        ).first()
-        if existing:
-            logger.info(f"Транзакция с ключом {transaction.idempotency_key} уже существует")
-            return LoyaltyTransactionResponse.from_orm(existing)
-    
-    account = db.query(LoyaltyAccount).filter(LoyaltyAccount.id == transaction.account_id).first()
+    response = _post_transaction(transaction, TransactionType.DEDUCTION, "deduct_points", current_user, db)
+    logger.info(f"Списано {transaction.amount} {transaction.currency} с аккаунта {transaction.account_id}")
+    return response
+
+
+@router.post("/transactions/batch", response_model=LoyaltyTransactionBatchResponse)
+def post_transactions_batch(
+    batch: LoyaltyTransactionBatchCreate,
+    current_user: Principal = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Пакетное начисление/списание (ночное закрытие 1С). Результат — по каждой операции"""
     
-    if not account:
+    if current_user.role not in ["admin", "cashier"]:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Аккаунт лояльности не найден"
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Недостаточно прав для проведения операций"
         )
     
-    # Проверка достаточности средств
-    if transaction.currency == "points":
-        if account.points_balance < transaction.amount:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Недостаточно баллов. Доступно: {account.points_balance}"
-            )
-    elif transaction.currency == "cashback":
-        if account.cashback_balance < transaction.amount:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Недостаточно кешбэка. Доступно: {account.cashback_balance}"
-            )
-    
-    # Сохранение старого баланса для аудита
-    old_balance = {
-        "points": account.points_balance,
-        "cashback": account.cashback_balance
-    }
-    
-    # Обновление баланса
-    if transaction.currency == "points":
-        account.points_balance -= transaction.amount
-        account.total_points_spent += transaction.amount
-    elif transaction.currency == "cashback":
-        account.cashback_balance -= transaction.amount
-        account.total_cashback_spent += transaction.amount
+    if len(batch.transactions) > settings.LOYALTY_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Не более {settings.LOYALTY_BATCH_MAX_ITEMS} операций в одном пакете"
+        )
     
-    # Создание транзакции
-    new_transaction = LoyaltyTransaction(
-        account_id=account.id,
-        transaction_type=TransactionType.DEDUCTION,
-        amount=transaction.amount,
-        currency=transaction.currency,
-        source=transaction.source,
-        source_id=transaction.source_id,
-        description=transaction.description,
-        metadata=transaction.metadata,
-        idempotency_key=transaction.idempotency_key,
-        created_by=current_user.id
+    try:
+        results = ledger.post_batch(db, batch.transactions, created_by=current_user.id)
+        db.commit()
+    except IntegrityError:
+        # Параллельный запрос записал часть тех же ключей — при повторе они станут дубликатами
+        db.rollback()
+        results = ledger.post_batch(db, batch.transactions, created_by=current_user.id)
+        db.commit()
+    
+    counts = Counter(r.status for r in results)
+    logger.info(
+        f"Пакет из {len(results)} операций: проведено {counts['created']}, "
+        f"дубликатов {counts['duplicate']}, ошибок {counts['error']}"
     )
     
-    db.add(new_transaction)
-    db.commit()
-    db.refresh(new_transaction)
-    
-    # Аудит
-    new_balance = {
-        "points": account.points_balance,
-        "cashback": account.cashback_balance
-    }
-    create_audit_log(db, current_user.id, "deduct_points", "loyalty_transaction", 
-                     new_transaction.id, old_balance, new_balance)
-    db.commit()
-    
-    logger.info(f"Списано {transaction.amount} {transaction.currency} с аккаунта {account.id}")
-    
-    return LoyaltyTransactionResponse.from_orm(new_transaction)
+    return LoyaltyTransactionBatchResponse(
+        results=[LoyaltyTransactionBatchItemResult.from_orm(r) for r in results],
+        created=counts["created"],
+        duplicates=counts["duplicate"],
+        failed=counts["error"]
+    )
 
 
 @router.get("/account", response_model=LoyaltyAccountResponse)
 def get_loyalty_account(
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение полной информации об аккаунте лояльности"""
@@ -15,15 +15,18 @@ from __future__ import annotations
 import logging
 from typing import Optional
 
-import httpx
 from fastapi import APIRouter, Depends, HTTPException, Header, status
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
+import certificate_cache
+import certificate_redemption
 from config import settings
-from database import get_db
-from models import Certificate, CertificateRedemption, CertificateStatus, User
-from onec_utils import odata_auth, odata_url
+from database import get_async_db
+from models import Certificate, CertificateStatus, User
+from onec_utils import get_onec_client
 
 logger = logging.getLogger(__name__)
 
@@ -66,7 +69,7 @@ def _verify_token(x_webhook_token: Optional[str] = Header(None)):
 
 
 
-async def push_certificate_to_1c(cert: Certificate, db: Session) -> bool:
+async def push_certificate_to_1c(cert: Certificate, db: AsyncSession) -> bool:
     """
     Создаёт/обновляет запись в Catalog_КартыСкидок в 1С.
     Возвращает True при успехе.
@@ -75,7 +78,7 @@ async def push_certificate_to_1c(cert: Certificate, db: Session) -> bool:
         logger.debug("ONEC_API_URL не задан, пропускаем отправку в 1С")
         return False
 
-    owner: User | None = db.get(User, cert.owner_id)
+    owner: User | None = await db.get(User, cert.owner_id)
     null_guid = "00000000-0000-0000-0000-000000000000"
 
     payload = {
@@ -86,58 +89,48 @@ async def push_certificate_to_1c(cert: Certificate, db: Session) -> bool:
         "Примечание": f"Сертификат {cert.initial_amount} руб. Источник: loyalty_app",
     }
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(
-                odata_url("Catalog_%D0%9A%D0%B0%D1%80%D1%82%D1%8B%D0%A1%D0%BA%D0%B8%D0%B4%D0%BE%D0%BA"),
-                json=payload,
-                auth=odata_auth(),
-                headers={"Content-Type": "application/json"},
-                params={"$format": "json"},
-            )
-            if resp.status_code in (200, 201):
-                data = resp.json()
-                ref_key = data.get("Ref_Key")
-                if ref_key:
-                    extra = cert.extra_data or {}
-                    extra["onec_card_key"] = ref_key
-                    cert.extra_data = extra
-                    db.commit()
-                logger.info(f"Сертификат {cert.code} передан в 1С (key={ref_key})")
-                return True
-            logger.warning(f"1С вернул {resp.status_code}: {resp.text[:200]}")
-            return False
+        resp = await get_onec_client().create(
+            "Catalog_%D0%9A%D0%B0%D1%80%D1%82%D1%8B%D0%A1%D0%BA%D0%B8%D0%B4%D0%BE%D0%BA",
+            payload,
+            timeout=10.0,
+        )
+        if resp.status_code in (200, 201):
+            data = resp.json()
+            ref_key = data.get("Ref_Key")
+            if ref_key:
+                extra = cert.extra_data or {}
+                extra["onec_card_key"] = ref_key
+                cert.extra_data = extra
+                await db.commit()
+            logger.info(f"Сертификат {cert.code} передан в 1С (key={ref_key})")
+            return True
+        logger.warning(f"1С вернул {resp.status_code}: {resp.text[:200]}")
+        return False
     except Exception as e:
         logger.warning(f"Ошибка передачи сертификата {cert.code} в 1С: {e}")
         return False
 
 
-async def sync_certificate_from_1c(code: str, db: Session) -> Certificate | None:
+async def sync_certificate_from_1c(code: str, db: AsyncSession) -> Certificate | None:
     """
     Ищет Catalog_КартыСкидок по Description=code и обновляет local cert.
     """
     if not settings.ONEC_API_URL:
         return None
     try:
-        async with httpx.AsyncClient(timeout=8.0) as client:
-            resp = await client.get(
-                odata_url("Catalog_%D0%9A%D0%B0%D1%80%D1%82%D1%8B%D0%A1%D0%BA%D0%B8%D0%B4%D0%BE%D0%BA"),
-                params={
-                    "$filter": f"Description eq '{code}' and DeletionMark eq false",
-                    "$format": "json",
-                    "$top": "1",
-                },
-                auth=odata_auth(),
-            )
-            resp.raise_for_status()
-            vals = resp.json().get("value", [])
-            if not vals:
-                return None
-            data = vals[0]
+        vals = await get_onec_client().query(
+            "Catalog_%D0%9A%D0%B0%D1%80%D1%82%D1%8B%D0%A1%D0%BA%D0%B8%D0%B4%D0%BE%D0%BA",
+            filter=f"Description eq '{code}' and DeletionMark eq false",
+            top=1,
+        )
+        if not vals:
+            return None
+        data = vals[0]
     except Exception as e:
         logger.warning(f"Не удалось получить сертификат {code} из 1С: {e}")
         return None
 
-    cert = db.query(Certificate).filter(Certificate.code == code).first()
+    cert = (await db.execute(select(Certificate).where(Certificate.code == code))).scalars().first()
     if not cert:
         return None
 
@@ -147,8 +140,9 @@ async def sync_certificate_from_1c(code: str, db: Session) -> Certificate | None
         cert.status = CertificateStatus(raw_status)
     except ValueError:
         pass
-    db.commit()
-    db.refresh(cert)
+    await db.commit()
+    await certificate_cache.invalidate(code)
+    await db.refresh(cert)
     return cert
 
 
@@ -159,7 +153,7 @@ async def sync_certificate_from_1c(code: str, db: Session) -> Certificate | None
 @router.post("/certificate", summary="Вебхук: создать/обновить сертификат из 1С")
 async def webhook_certificate_from_1c(
     data: OneCCertificateWebhook,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _token: str = Depends(_verify_token),
 ):
     """
@@ -167,7 +161,7 @@ async def webhook_certificate_from_1c(
     - администратор создал сертификат вручную
     - изменился статус или остаток сертификата
     """
-    cert = db.query(Certificate).filter(Certificate.code == data.code).first()
+    cert = (await db.execute(select(Certificate).where(Certificate.code == data.code))).scalars().first()
 
     if cert:
         # Обновляем существующий
@@ -181,16 +175,21 @@ async def webhook_certificate_from_1c(
             extra = cert.extra_data or {}
             extra["onec_document_id"] = data.document_id
             cert.extra_data = extra
-        db.commit()
+        await db.commit()
+        await certificate_cache.invalidate(data.code)
         logger.info(f"Сертификат {data.code} обновлён из вебхука 1С")
         return {"status": "updated", "code": data.code}
 
     # Сертификат не найден — создаём. Ищем владельца по телефону или external_id.
     owner: User | None = None
     if data.owner_external_id:
-        owner = db.query(User).filter(User.external_id == data.owner_external_id).first()
+        owner = (await db.execute(
+            select(User).where(User.external_id == data.owner_external_id)
+        )).scalars().first()
     if not owner and data.owner_phone:
-        owner = db.query(User).filter(User.phone == data.owner_phone).first()
+        owner = (await db.execute(
+            select(User).where(User.phone == data.owner_phone)
+        )).scalars().first()
 
     if not owner:
         # Нет владельца в нашей системе — сохраняем без привязки к пользователю.
@@ -221,63 +220,81 @@ async def webhook_certificate_from_1c(
         extra_data={"onec_document_id": data.document_id} if data.document_id else None,
     )
     db.add(new_cert)
-    db.commit()
+    await db.commit()
+    await certificate_cache.invalidate(data.code)  # код мог попасть в кеш как «не найден»
     logger.info(f"Сертификат {data.code} создан из вебхука 1С для пользователя {owner.id}")
     return {"status": "created", "code": data.code, "owner_id": owner.id}
 
 
+def _already_processed(found, data: OneCRedeemWebhook) -> dict:
+    """Документ уже учтён: повтор вебхука — ответ прежний, другое погашение под тем же номером — 409"""
+    try:
+        redemption = certificate_redemption.check_replay(found, data.code, data.amount_used)
+    except certificate_redemption.DocumentConflictError as e:
+        logger.error(f"Вебхук 1С: {e} (сертификат {data.code}, сумма {data.amount_used})")
+        raise HTTPException(409, detail=str(e))
+    return {"status": "already_processed", "redemption_id": redemption.id}
+
+
 @router.post("/certificate/redeem", summary="Вебхук: погашение сертификата на кассе 1С")
 async def webhook_redeem_from_1c(
     data: OneCRedeemWebhook,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _token: str = Depends(_verify_token),
 ):
     """
     1С вызывает этот эндпоинт при добавлении сертификата к документу «Оказание услуг».
     """
-    cert = db.query(Certificate).filter(Certificate.code == data.code).first()
-    if not cert:
-        logger.warning(f"Погашение: сертификат {data.code} не найден")
-        return {"status": "not_found"}
-
-    # Проверка идемпотентности — один документ не должен дважды снять деньги
-    already = db.query(CertificateRedemption).filter(
-        CertificateRedemption.onec_document_id == data.document_id
-    ).first()
-    if already:
-        return {"status": "already_processed", "redemption_id": already.id}
-
-    cert.current_amount = data.remaining_amount
-    if data.remaining_amount <= 0:
-        cert.status = CertificateStatus.USED
-
-    redemption = CertificateRedemption(
-        certificate_id=cert.id,
-        amount_used=data.amount_used,
-        remaining_amount=data.remaining_amount,
-        onec_document_id=data.document_id,
-        redeemed_by_id=None,
-        notes=data.cashier_comment,
-    )
-    db.add(redemption)
-    db.commit()
+    # Быстрая проверка идемпотентности — один документ не должен дважды снять деньги
+    found = (await db.execute(certificate_redemption.find_by_document_stmt(data.document_id))).first()
+    if found:
+        return _already_processed(found, data)
 
+    # Погашение уже проведено в 1С — списываем относительно текущего остатка,
+    # не затирая параллельные погашения на нашей кассе
+    try:
+        result = await certificate_redemption.record_external_async(
+            db,
+            code=data.code,
+            amount_used=data.amount_used,
+            onec_document_id=data.document_id,
+            notes=data.cashier_comment,
+        )
+        if result is None:
+            logger.warning(f"Погашение: сертификат {data.code} не найден")
+            return {"status": "not_found"}
+        await db.commit()
+    except IntegrityError:
+        # Тот же документ пришёл параллельным вебхуком
+        await db.rollback()
+        found = (await db.execute(certificate_redemption.find_by_document_stmt(data.document_id))).first()
+        if not found:
+            raise
+        return _already_processed(found, data)
+
+    await certificate_cache.invalidate(data.code)
+
+    if abs(result.remaining_amount - data.remaining_amount) > 0.01:
+        logger.warning(
+            f"Сертификат {data.code}: остаток в 1С {data.remaining_amount} руб., "
+            f"у нас {result.remaining_amount} руб. (doc {data.document_id})"
+        )
     logger.info(
         f"Сертификат {data.code}: списано {data.amount_used} руб., "
-        f"остаток {data.remaining_amount} руб. (doc {data.document_id})"
+        f"остаток {result.remaining_amount} руб. (doc {data.document_id})"
     )
     return {
         "status": "success",
         "code": data.code,
         "amount_used": data.amount_used,
-        "remaining_amount": data.remaining_amount,
+        "remaining_amount": result.remaining_amount,
     }
 
 
 @router.get("/certificate/sync/{code}", summary="Принудительная синхронизация сертификата из 1С")
 async def force_sync_certificate(
     code: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Запросить актуальный остаток сертификата напрямую из 1С."""
     if not settings.ONEC_API_URL:
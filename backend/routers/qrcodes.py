@@ -0,0 +1,109 @@
+"""
+Раздача PNG с QR-кодами сертификатов.
+
+  /qrcodes/{code}.png          — по коду сертификата: адрес постоянный, а
+                                 картинка меняется при перевыпуске, поэтому
+                                 кешируется на сутки с ревалидацией по ETag;
+  /qrcodes/sha256/{key}.png    — по ключу содержимого в qr_storage: без
+                                 запроса в БД, immutable.
+
+Вместо StaticFiles: если фоновый рендер после создания сертификата ещё не
+завершился, картинка рендерится по запросу. По коду отдаются только
+существующие сертификаты. В QR кодируется подписанная ссылка
+(certificate_token.qr_content). Байты отдаёт приложение или nginx
+(QR_SERVE_MODE=x-accel).
+"""
+import logging
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy import String, column, select, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import certificate_token
+import qr_render
+from qr_storage import IMMUTABLE_CACHE_CONTROL, KEY_PATTERN, get_storage
+from database import AsyncSessionLocal, get_async_db
+from models import Certificate
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+CODE_CACHE_CONTROL = "public, max-age=86400"
+
+
+def qr_code_paths_update(pairs: list[tuple[str, str]]):
+    """Один UPDATE ... FROM (VALUES ...) для пар (код сертификата, путь к PNG)"""
+    paths = values(column("code", String), column("path", String), name="qr_paths").data(pairs)
+    return (
+        update(Certificate)
+        .where(Certificate.code == paths.c.code, Certificate.qr_code_path.is_distinct_from(paths.c.path))
+        .values(qr_code_path=paths.c.path)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def fill_qr_code_path(certificate_id: int, content: str) -> None:
+    """Фоновая задача после создания сертификата: рендер и запись qr_code_path"""
+    try:
+        path = await qr_render.render(content)
+    except Exception as e:
+        logger.error(f"Ошибка генерации QR-кода сертификата {certificate_id}: {e}")
+        return
+
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(Certificate)
+            .where(Certificate.id == certificate_id, Certificate.qr_code_path.is_distinct_from(path))
+            .values(qr_code_path=path)
+        )
+        await db.commit()
+
+
+@router.get("/sha256/{filename}")
+async def get_qr_code_by_key(filename: str, request: Request):
+    """PNG по ключу содержимого; неизменяем, в БД не обращается"""
+
+    key, ext = filename[:-4], filename[-4:]
+    storage = get_storage()
+    if ext != ".png" or not KEY_PATTERN.match(key) or not storage.exists(key):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Не найдено")
+    return storage.response(key, request, IMMUTABLE_CACHE_CONTROL)
+
+
+@router.get("/{filename}")
+async def get_qr_code(filename: str, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """PNG с QR-кодом сертификата"""
+
+    code, ext = filename[:-4], filename[-4:]
+    if ext != ".png" or not qr_render.CODE_PATTERN.match(code):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Не найдено")
+
+    certificate = (await db.execute(
+        select(
+            Certificate.id,
+            Certificate.qr_code_path,
+            Certificate.initial_amount,
+            Certificate.valid_until,
+            Certificate.issue_version,
+        ).where(Certificate.code == code)
+    )).first()
+    if not certificate:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Не найдено")
+
+    content = certificate_token.qr_content(
+        code, certificate.initial_amount, certificate.valid_until, certificate.issue_version
+    )
+    path = await qr_render.render(content)
+    if certificate.qr_code_path != path:
+        # Первый запрос, перевыпуск или файл из старого плоского каталога
+        await db.execute(
+            update(Certificate)
+            .where(Certificate.id == certificate.id)
+            .values(qr_code_path=path)
+        )
+        await db.commit()
+
+    storage = get_storage()
+    return storage.response(storage.key_for(content), request, CODE_CACHE_CONTROL)
@@ -4,10 +4,11 @@ from sqlalchemy import func
 import secrets
 import string
 
+import referral_stats
 from database import get_db
 from models import (
-    User, ReferralCode, ReferralEvent, ReferralReward, RewardRule, 
-    LoyaltyAccount, LoyaltyTransaction, TransactionType, ReferralEventType, RewardType
+    ReferralCode, ReferralEvent, ReferralReward,
+    ReferralEventType
 )
 from schemas import (
     ReferralCodeCreate,
@@ -17,6 +18,7 @@ from schemas import (
     ReferralRewardResponse,
     ReferralStatsResponse
 )
+from principal_cache import Principal
 from routers.auth import get_current_active_user
 import logging
 
@@ -31,81 +33,10 @@ def generate_referral_code(prefix: str = "REF") -> str:
     return f"{prefix}-{random_part}"
 
 
-def process_referral_rewards(db: Session, event: ReferralEvent, referral_code: ReferralCode):
-    """Обработка вознаграждений за реферальное событие"""
-    
-    # Получение правил вознаграждений
-    rules = db.query(RewardRule).filter(
-        RewardRule.event_type == event.event_type,
-        RewardRule.is_active == True
-    ).all()
-    
-    for rule in rules:
-        # Проверка типа реферера
-        if rule.referrer_type != "any" and rule.referrer_type != referral_code.referrer_type:
-            continue
-        
-        # Расчет суммы вознаграждения
-        if rule.reward_type == RewardType.FIXED:
-            reward_amount = rule.reward_value
-        elif rule.reward_type == RewardType.PERCENTAGE:
-            if event.transaction_amount:
-                reward_amount = event.transaction_amount * (rule.reward_value / 100)
-            else:
-                continue
-        elif rule.reward_type == RewardType.POINTS:
-            reward_amount = rule.reward_value
-        else:
-            continue
-        
-        # Получение аккаунта лояльности реферера
-        referrer_account = db.query(LoyaltyAccount).filter(
-            LoyaltyAccount.user_id == referral_code.user_id
-        ).first()
-        
-        if not referrer_account:
-            logger.warning(f"Аккаунт лояльности не найден для пользователя {referral_code.user_id}")
-            continue
-        
-        # Создание транзакции лояльности
-        loyalty_transaction = LoyaltyTransaction(
-            account_id=referrer_account.id,
-            transaction_type=TransactionType.ACCRUAL,
-            amount=reward_amount,
-            currency="points" if rule.reward_type == RewardType.POINTS else "cashback",
-            source="referral",
-            source_id=str(event.id),
-            description=f"Вознаграждение за реферала: {event.event_type}"
-        )
-        db.add(loyalty_transaction)
-        db.flush()
-        
-        # Обновление баланса
-        if rule.reward_type == RewardType.POINTS:
-            referrer_account.points_balance += reward_amount
-            referrer_account.total_points_earned += reward_amount
-        else:
-            referrer_account.cashback_balance += reward_amount
-            referrer_account.total_cashback_earned += reward_amount
-        
-        # Создание записи о вознаграждении
-        reward = ReferralReward(
-            event_id=event.id,
-            recipient_user_id=referral_code.user_id,
-            reward_type=rule.reward_type,
-            reward_amount=reward_amount,
-            referral_level=rule.applies_to_level,
-            loyalty_transaction_id=loyalty_transaction.id
-        )
-        db.add(reward)
-        
-        logger.info(f"Начислено вознаграждение {reward_amount} пользователю {referral_code.user_id} за событие {event.event_type}")
-
-
 @router.post("/create-code", response_model=ReferralCodeResponse, status_code=status.HTTP_201_CREATED)
 def create_referral_code(
     code_data: ReferralCodeCreate,
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Создание реферального кода"""
@@ -157,7 +88,7 @@ def create_referral_code(
 
 @router.get("/my-code", response_model=ReferralCodeResponse)
 def get_my_referral_code(
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение реферального кода текущего пользователя"""
@@ -186,10 +117,10 @@ def get_my_referral_code(
 @router.post("/register-event", response_model=ReferralEventResponse, status_code=status.HTTP_201_CREATED)
 def register_referral_event(
     event_data: ReferralEventCreate,
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Регистрация реферального события"""
+    """Регистрация реферального события (вознаграждения начисляет referral_queue)"""
     
     if current_user.role not in ["admin", "cashier"]:
         raise HTTPException(
@@ -223,32 +154,17 @@ def register_referral_event(
         event_type=event_data.event_type,
         transaction_amount=event_data.transaction_amount,
         onec_document_id=event_data.onec_document_id,
-        metadata=event_data.metadata,
+        extra_data=event_data.metadata,
         processed=False
     )
     
     db.add(event)
     db.flush()
     
-    # Обработка вознаграждений
-    try:
-        process_referral_rewards(db, event, referral_code)
-        event.processed = True
-        
-        # Обновление статистики реферального кода
-        referral_code.total_referrals += 1
-        if event_data.event_type == ReferralEventType.FIRST_VISIT:
-            referral_code.successful_referrals += 1
-        if event_data.transaction_amount:
-            referral_code.total_revenue += event_data.transaction_amount
-        
-    except Exception as e:
-        logger.error(f"Ошибка обработки вознаграждений: {e}")
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка обработки вознаграждений: {str(e)}"
-        )
+    # Статистика кода — приращением в БД, последним оператором перед commit
+    referral_stats.record_event(
+        db, referral_code.id, event_data.event_type, event_data.transaction_amount
+    )
     
     db.commit()
     db.refresh(event)
@@ -260,7 +176,7 @@ def register_referral_event(
 
 @router.get("/stats", response_model=ReferralStatsResponse)
 def get_referral_stats(
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение статистики по рефералам текущего пользователя"""
@@ -317,7 +233,7 @@ def get_referral_stats(
 
 @router.get("/rewards", response_model=list[ReferralRewardResponse])
 def get_my_rewards(
-    current_user: User = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Получение истории вознаграждений"""
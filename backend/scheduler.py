@@ -0,0 +1,61 @@
+"""
+Периодические фоновые задачи приложения.
+
+Задачи запускаются в lifespan каждого воркера uvicorn. Чтобы за интервал
+задачу выполнял один воркер, перед запуском берётся блокировка в Redis
+(SET NX EX на время интервала). Если Redis недоступен, задача выполняется
+без блокировки, поэтому задачи должны быть идемпотентными. Задачи,
+которые сами делят работу между воркерами (очереди на SKIP LOCKED),
+запускаются с exclusive=False и выполняются всеми воркерами.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable
+
+from redis.exceptions import RedisError
+
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_tasks: list[asyncio.Task] = []
+
+
+async def _acquire(name: str, interval: float) -> bool:
+    try:
+        return bool(await get_redis().set(f"scheduler:{name}", "1", nx=True, ex=max(1, int(interval))))
+    except RedisError as e:
+        logger.warning(f"Redis недоступен, задача {name} выполняется без блокировки: {e}")
+        return True
+
+
+async def _run_periodically(
+    name: str, interval: float, job: Callable[[], Awaitable[None]], exclusive: bool
+) -> None:
+    # Разносим старт воркеров, чтобы они не боролись за блокировку одновременно
+    await asyncio.sleep(random.uniform(1, min(interval, 30)))
+    while True:
+        if not exclusive or await _acquire(name, interval):
+            try:
+                await job()
+            except Exception as e:
+                logger.error(f"Ошибка периодической задачи {name}: {e}", exc_info=True)
+        await asyncio.sleep(interval)
+
+
+def start(name: str, interval: float, job: Callable[[], Awaitable[None]], exclusive: bool = True) -> None:
+    """Запуск задачи `job` раз в `interval` секунд (из lifespan)"""
+    _tasks.append(
+        asyncio.create_task(_run_periodically(name, interval, job, exclusive), name=f"scheduler:{name}")
+    )
+
+
+async def stop() -> None:
+    """Остановка всех задач (при остановке приложения)"""
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
@@ -92,13 +92,36 @@ class BalanceResponse(BaseModel):
     cashback_balance: float
     card_tier: str
     transactions_count: int
+    last_transaction_at: Optional[datetime] = None
 
 
 class TransactionHistoryResponse(BaseModel):
     transactions: List[LoyaltyTransactionResponse]
-    total: int
-    page: int
+    total: Optional[int] = None  # Только в режиме page
+    page: Optional[int] = None
     page_size: int
+    next_cursor: Optional[str] = None  # Курсор следующей страницы, None — последняя
+
+
+class LoyaltyTransactionBatchCreate(BaseModel):
+    transactions: List[LoyaltyTransactionCreate]
+
+
+class LoyaltyTransactionBatchItemResult(BaseModel):
+    index: int  # Позиция операции в запросе
+    status: str  # created, duplicate, error
+    transaction_id: Optional[int] = None
+    error: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
+class LoyaltyTransactionBatchResponse(BaseModel):
+    results: List[LoyaltyTransactionBatchItemResult]
+    created: int
+    duplicates: int
+    failed: int
 
 
 # === CERTIFICATE SCHEMAS ===
@@ -130,20 +153,69 @@ class CertificateResponse(BaseModel):
     used_at: Optional[datetime]
     design_template: str
     message: Optional[str]
+    issue_version: int = 1
     qr_code_url: Optional[str] = None
     
     class Config:
         from_attributes = True
 
 
+class CertificateBatchCreate(BaseModel):
+    """Пакетный выпуск сертификатов для корпоративного заказа"""
+    count: int
+    initial_amount: float
+    valid_until: Optional[datetime] = None  # По умолчанию +1 год
+    client_name: Optional[str] = None  # Заказчик (организация)
+    message: Optional[str] = None
+    design_template: str = "default"
+    
+    @validator('initial_amount')
+    def validate_amount(cls, v):
+        if v <= 0:
+            raise ValueError('Сумма должна быть больше нуля')
+        return v
+    
+    @validator('count')
+    def validate_count(cls, v):
+        if v <= 0:
+            raise ValueError('Количество должно быть больше нуля')
+        return v
+
+
+class CertificateBatchResponse(BaseModel):
+    batch_id: str
+    count: int
+    initial_amount: float
+    valid_until: datetime
+    codes: List[str]
+    download_url: str  # ZIP с QR-кодами и реестром
+
+
 class CertificateTransferCreate(BaseModel):
     certificate_id: int
     to_user_email: str
     message: Optional[str] = None
 
 
+def _validate_certificate_code(v):
+    # Отсекаем мусор до запроса в БД; коды из 1С не обязаны быть вида CERT-...
+    if v is not None and (not v or len(v) > 64 or not v.isprintable()):
+        raise ValueError('Некорректный код сертификата')
+    return v
+
+
+def _require_code_or_token(v, values):
+    if v is None and values.get('code') is None:
+        raise ValueError('Укажите код сертификата или содержимое QR-кода')
+    return v
+
+
 class CertificateVerifyRequest(BaseModel):
-    code: str
+    code: Optional[str] = None
+    token: Optional[str] = None  # Содержимое QR-кода: подписанная ссылка или токен
+    
+    _check_code = validator('code', allow_reuse=True)(_validate_certificate_code)
+    _check_token = validator('token', always=True, allow_reuse=True)(_require_code_or_token)
 
 
 class CertificateVerifyResponse(BaseModel):
@@ -153,10 +225,22 @@ class CertificateVerifyResponse(BaseModel):
 
 
 class CertificateRedeemRequest(BaseModel):
-    code: str
+    code: Optional[str] = None
+    token: Optional[str] = None  # Содержимое QR-кода: подписанная ссылка или токен
     amount: float
     onec_document_id: Optional[str] = None
     notes: Optional[str] = None
+    
+    _check_code = validator('code', allow_reuse=True)(_validate_certificate_code)
+    _check_token = validator('token', always=True, allow_reuse=True)(_require_code_or_token)
+
+
+class CertificateSigningKeyResponse(BaseModel):
+    """Открытый ключ для офлайн-проверки QR-кодов на кассовых терминалах"""
+    algorithm: str
+    key_id: str
+    public_key: str  # base64, 32 байта Ed25519
+    token_format: str
 
 
 class CertificateRedeemResponse(BaseModel):
@@ -249,16 +333,18 @@ class AdminDashboardStats(BaseModel):
 
 class AdminCertificateList(BaseModel):
     certificates: List[CertificateResponse]
-    total: int
-    page: int
+    total: Optional[int] = None  # Только в режиме page
+    page: Optional[int] = None
     page_size: int
+    next_cursor: Optional[str] = None  # Курсор следующей страницы, None — последняя
 
 
 class AdminUserList(BaseModel):
     users: List[UserResponse]
-    total: int
-    page: int
+    total: Optional[int] = None  # Только в режиме page
+    page: Optional[int] = None
     page_size: int
+    next_cursor: Optional[str] = None  # Курсор следующей страницы, None — последняя
 
 
 # === INTEGRATION SCHEMAS ===
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Пересчёт дневных агрегатов loyalty_daily_rollups по loyalty_transactions.
+
+Нужен после ручных правок транзакций или для проверки расхождений.
+Безопасен при работающем приложении.
+
+    python scripts/backfill_loyalty_rollups.py                      # вся история
+    python scripts/backfill_loyalty_rollups.py --from 2025-01-01 --to 2025-03-31
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import date, datetime, timezone
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func
+
+import rollups
+from database import SessionLocal
+from models import LoyaltyTransaction
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчёт дневных агрегатов лояльности")
+    parser.add_argument("--from", dest="first_day", type=date.fromisoformat, help="Первый день (UTC), YYYY-MM-DD")
+    parser.add_argument("--to", dest="last_day", type=date.fromisoformat, help="Последний день (UTC), YYYY-MM-DD")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        first_day, last_day = args.first_day, args.last_day
+        if first_day is None:
+            oldest = db.query(func.min(LoyaltyTransaction.created_at)).scalar()
+            if oldest is None:
+                print("ℹ️  Транзакций нет, пересчитывать нечего")
+                return
+            first_day = oldest.astimezone(timezone.utc).date()
+        if last_day is None:
+            last_day = datetime.now(timezone.utc).date()
+
+        print(f"📊 Пересчёт агрегатов за {first_day} — {last_day}...")
+        started = time.monotonic()
+        written = rollups.rebuild(db, first_day, last_day)
+        print(f"✅ Записано строк агрегатов: {written} ({time.monotonic() - started:.1f} с)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк проверки access-токена: только разбор JWT (как до token_store)
+против разбора с проверкой отзыва и полного get_current_user.
+
+Список отозванных токенов заполняется --revoked записями (пользователи и
+сессии), проверка идёт по копии в памяти, как в воркере. get_current_user
+измеряется с тёплым principal_cache (L1) — так проходит подавляющее
+большинство запросов. С --rotations дополнительно измеряется обмен
+refresh-токена (WATCH/MULTI в Redis из REDIS_URL).
+
+Пример:
+    python scripts/bench_auth_overhead.py --iterations 20000 --revoked 10000 --rotations 1000
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jose import jwt
+
+import principal_cache
+import token_store
+from config import settings
+from principal_cache import Principal
+from redis_client import close_redis
+from routers.auth import create_access_token, get_current_user
+
+USER_ID = 1
+
+
+def _decode(token: str) -> None:
+    payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+    int(payload["sub"])
+
+
+def _decode_and_check(token: str) -> None:
+    payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+    if token_store.is_revoked(int(payload["sub"]), payload.get("fam"), float(payload.get("iat", 0))):
+        raise RuntimeError("токен отозван")
+
+
+def _summary(mode: str, samples: list[float], baseline: float = None) -> dict:
+    samples.sort()
+    p50 = statistics.median(samples)
+    result = {
+        "mode": mode,
+        "p50_us": round(p50, 1),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1], 1),
+        "ops_per_s": round(len(samples) / (sum(samples) / 1e6)),
+    }
+    if baseline is not None:
+        result["overhead_p50_us"] = round(p50 - baseline, 1)
+    return result
+
+
+def _measure_sync(fn, token: str, iterations: int) -> list[float]:
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn(token)
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+async def _measure_dependency(token: str, iterations: int) -> list[float]:
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await get_current_user(token)
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+async def _measure_rotation(rotations: int) -> list[float]:
+    grant = await token_store.open_family(USER_ID)
+    samples = []
+    for _ in range(rotations):
+        started = time.perf_counter()
+        grant = await token_store.rotate(USER_ID, grant.family, grant.jti)
+        samples.append((time.perf_counter() - started) * 1e6)
+    await token_store.revoke_family(USER_ID, grant.family)
+    return samples
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--revoked", type=int, default=10000)
+    parser.add_argument("--rotations", type=int, default=0)
+    args = parser.parse_args()
+
+    now = time.time()
+    for i in range(args.revoked):
+        # Половина — пользователи (не тот, чей токен проверяется), половина — сессии
+        member = f"u:{USER_ID + 1 + i}" if i % 2 else f"f:{token_store.new_id()}"
+        token_store._revoked[member] = now
+    token = create_access_token(data={"sub": str(USER_ID), "fam": token_store.new_id()})
+    principal_cache._put_local(Principal(id=USER_ID, role="patient", is_active=True))
+    settings.PRINCIPAL_CACHE_L1_TTL = 3600
+
+    print(f"📊 {args.iterations} проверок токена, отозвано записей: {len(token_store._revoked)}")
+    _measure_sync(_decode, token, 1000)  # прогрев
+    baseline = _summary("decode", _measure_sync(_decode, token, args.iterations))
+    print(baseline)
+    print(_summary("decode+revocation", _measure_sync(_decode_and_check, token, args.iterations), baseline["p50_us"]))
+    print(_summary("get_current_user", await _measure_dependency(token, args.iterations), baseline["p50_us"]))
+
+    if args.rotations:
+        print(_summary("refresh_rotation", await _measure_rotation(args.rotations)))
+    await close_redis()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк задержки event loop: синхронная сессия SQLAlchemy внутри
+async-обработчика против AsyncSession (asyncpg).
+
+Запускает N конкурентных «обработчиков», каждый выполняет запрос к БД так,
+как это делали async-роутеры до перехода на get_async_db (sync Session прямо
+в корутине) и после. Параллельно корутина-монитор просыпается каждые
+--tick-ms миллисекунд и измеряет, на сколько она опоздала — это и есть
+задержка event loop, которую видят все остальные запросы процесса.
+
+Пример:
+    python scripts/bench_event_loop_lag.py --requests 500 --concurrency 50 --db-latency-ms 5
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from database import AsyncSessionLocal, SessionLocal, async_engine
+
+# pg_sleep имитирует сетевую задержку до Postgres (VPN, другой хост)
+QUERY = text("SELECT pg_sleep(:delay), count(*) FROM users")
+
+
+async def _monitor(tick: float, lags: list, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(tick)
+        lags.append((time.perf_counter() - started - tick) * 1000)
+
+
+async def _sync_handler(delay: float) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(QUERY, {"delay": delay}).all()
+    finally:
+        db.close()
+
+
+async def _async_handler(delay: float) -> None:
+    async with AsyncSessionLocal() as db:
+        (await db.execute(QUERY, {"delay": delay})).all()
+
+
+async def run(mode: str, requests: int, concurrency: int, delay: float, tick: float) -> dict:
+    handler = _sync_handler if mode == "sync" else _async_handler
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one() -> None:
+        async with semaphore:
+            await handler(delay)
+
+    # Прогрев пулов соединений
+    await asyncio.gather(*[handler(0) for _ in range(min(concurrency, 10))])
+
+    lags: list[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(_monitor(tick, lags, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+
+    lags.sort()
+    return {
+        "mode": mode,
+        "elapsed_s": round(elapsed, 2),
+        "rps": round(requests / elapsed, 1),
+        "lag_p50_ms": round(statistics.median(lags), 2),
+        "lag_p99_ms": round(lags[int(len(lags) * 0.99) - 1], 2) if len(lags) > 1 else round(lags[0], 2),
+        "lag_max_ms": round(lags[-1], 2),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--db-latency-ms", type=float, default=5.0)
+    parser.add_argument("--tick-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    delay = args.db_latency_ms / 1000
+    tick = args.tick_ms / 1000
+    print(f"📊 {args.requests} запросов, concurrency={args.concurrency}, задержка БД {args.db_latency_ms} мс")
+    for mode in ("sync", "async"):
+        print(await run(mode, args.requests, args.concurrency, delay, tick))
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк параллельного погашения сертификатов.
+
+Создаёт временные сертификаты (коды BENCH-...), запускает --workers потоков,
+каждый погашает --redeems-per-worker раз по --amount руб., и удаляет
+сертификаты после прогона. Сценарии:
+  distinct — у каждого кассира свой сертификат: погашения не должны
+             мешать друг другу, пропускная способность растёт с числом
+             потоков;
+  hot      — все кассиры гасят один сертификат: погашения выстраиваются
+             в очередь на блокировке строки, остаток не уходит в минус.
+
+Режим --mode naive воспроизводит прежнюю схему (прочитать остаток,
+вычесть в Python, закоммитить) для сравнения: в сценарии hot она теряет
+обновления и списывает больше номинала.
+
+Пример:
+    python scripts/bench_parallel_redeem.py --workers 20 --redeems-per-worker 50
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import delete, func, select
+
+import certificate_redemption
+from database import SessionLocal
+from models import Certificate, CertificateRedemption, CertificateStatus
+
+
+def _create_certificates(count: int, amount: float) -> list[str]:
+    prefix = f"BENCH-{uuid.uuid4().hex[:8].upper()}"
+    codes = [f"{prefix}-{i:04d}" for i in range(count)]
+    db = SessionLocal()
+    try:
+        db.add_all(
+            Certificate(
+                code=code,
+                initial_amount=amount,
+                current_amount=amount,
+                status=CertificateStatus.ACTIVE,
+                valid_until=datetime.now(timezone.utc) + timedelta(days=1),
+            )
+            for code in codes
+        )
+        db.commit()
+    finally:
+        db.close()
+    return codes
+
+
+def _cleanup(codes: list[str]) -> None:
+    db = SessionLocal()
+    try:
+        ids = select(Certificate.id).where(Certificate.code.in_(codes)).scalar_subquery()
+        db.execute(delete(CertificateRedemption).where(CertificateRedemption.certificate_id.in_(ids)))
+        db.execute(delete(Certificate).where(Certificate.code.in_(codes)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _redeem_atomic(code: str, amount: float) -> bool:
+    db = SessionLocal()
+    try:
+        certificate_redemption.redeem(db, code=code, amount=amount, redeemed_by_id=None, notes="bench")
+        db.commit()
+        return True
+    except certificate_redemption.RedemptionError:
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+
+def _redeem_naive(code: str, amount: float) -> bool:
+    """Прежняя схема: чтение, вычитание в Python, commit"""
+    db = SessionLocal()
+    try:
+        certificate = db.query(Certificate).filter(Certificate.code == code).first()
+        if certificate.status != CertificateStatus.ACTIVE or amount > certificate.current_amount:
+            return False
+        certificate.current_amount -= amount
+        if certificate.current_amount <= 0:
+            certificate.status = CertificateStatus.USED
+        db.add(CertificateRedemption(
+            certificate_id=certificate.id,
+            amount_used=amount,
+            remaining_amount=certificate.current_amount,
+            notes="bench",
+        ))
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+def run(scenario: str, mode: str, workers: int, per_worker: int, amount: float) -> dict:
+    total = workers * per_worker
+    # В hot номинал покрывает половину попыток: вторая половина должна получить отказ
+    nominal = amount * (total // 2) if scenario == "hot" else amount * per_worker
+    codes = _create_certificates(1 if scenario == "hot" else workers, nominal)
+    redeem = _redeem_atomic if mode == "atomic" else _redeem_naive
+
+    latencies: list[float] = []
+    succeeded = 0
+    lock = threading.Lock()
+
+    def cashier(index: int) -> None:
+        nonlocal succeeded
+        code = codes[0] if scenario == "hot" else codes[index]
+        for _ in range(per_worker):
+            started = time.perf_counter()
+            ok = redeem(code, amount)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                succeeded += ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(cashier, range(workers)))
+    elapsed = time.perf_counter() - started
+
+    db = SessionLocal()
+    try:
+        remaining = db.execute(
+            select(func.sum(Certificate.current_amount)).where(Certificate.code.in_(codes))
+        ).scalar()
+        redeemed = db.execute(
+            select(func.coalesce(func.sum(CertificateRedemption.amount_used), 0))
+            .join(Certificate, Certificate.id == CertificateRedemption.certificate_id)
+            .where(Certificate.code.in_(codes))
+        ).scalar()
+    finally:
+        db.close()
+    _cleanup(codes)
+
+    issued = nominal * len(codes)
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "mode": mode,
+        "elapsed_s": round(elapsed, 2),
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 2),
+        "succeeded": succeeded,
+        # Списано по журналу погашений сверх номинала — двойное списание
+        "overspent": round(max(redeemed - issued, 0), 2),
+        # Погашено по журналу, но не вычтено из остатка — потерянные обновления
+        "lost_updates": round(redeemed - (issued - remaining), 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=20, help="параллельных кассиров (не больше пула соединений)")
+    parser.add_argument("--redeems-per-worker", type=int, default=50)
+    parser.add_argument("--amount", type=float, default=100.0)
+    parser.add_argument("--mode", choices=("atomic", "naive", "both"), default="both")
+    args = parser.parse_args()
+
+    modes = ("atomic", "naive") if args.mode == "both" else (args.mode,)
+    print(f"📊 {args.workers} кассиров × {args.redeems_per_worker} погашений по {args.amount} руб.")
+    for scenario in ("distinct", "hot"):
+        for mode in modes:
+            print(run(scenario, mode, args.workers, args.redeems_per_worker, args.amount))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Перенос QR-кодов сертификатов в шардированное хранилище (qr_storage).
+
+Для каждого сертификата рендерит PNG с подписанной ссылкой в
+QR_CODE_DIR/ab/cd/<sha256>.png (уже готовые файлы пропускаются) и
+обновляет certificates.qr_code_path. Старые файлы плоского каталога
+(QR_CODE_DIR/<код>.png) содержат неподписанную ссылку и не переносятся,
+а рендерятся заново; с --delete-flat они удаляются после переноса.
+
+Безопасен при работающем приложении, можно прерывать и запускать повторно:
+
+    docker compose exec -T backend python scripts/migrate_qr_storage.py --delete-flat
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select
+
+import certificate_token
+import qr_render
+from config import settings
+from database import AsyncSessionLocal, async_engine
+from models import Certificate
+from routers.qrcodes import qr_code_paths_update
+
+
+async def migrate(batch_size: int) -> int:
+    migrated, last_id = 0, 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            rows = (await db.execute(
+                select(
+                    Certificate.id,
+                    Certificate.code,
+                    Certificate.initial_amount,
+                    Certificate.valid_until,
+                    Certificate.issue_version,
+                )
+                .where(Certificate.id > last_id, Certificate.valid_until.is_not(None))
+                .order_by(Certificate.id)
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                return migrated
+
+            contents = [
+                certificate_token.qr_content(row.code, row.initial_amount, row.valid_until, row.issue_version)
+                for row in rows
+            ]
+            paths = await qr_render.render_many(contents)
+            await db.execute(qr_code_paths_update([(row.code, path) for row, path in zip(rows, paths)]))
+            await db.commit()
+
+            migrated += len(rows)
+            last_id = rows[-1].id
+            print(f"   {migrated} сертификатов")
+
+
+def delete_flat_files() -> int:
+    """PNG в корне QR_CODE_DIR — прежняя плоская раскладка"""
+    deleted = 0
+    with os.scandir(settings.QR_CODE_DIR) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".png"):
+                os.unlink(entry.path)
+                deleted += 1
+    return deleted
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--delete-flat", action="store_true", help="удалить файлы старого плоского каталога")
+    args = parser.parse_args()
+
+    print(f"🔄 Перенос QR-кодов в {settings.QR_CODE_DIR}/ab/cd/...")
+    started = time.monotonic()
+    qr_render.start_pool()
+    try:
+        migrated = await migrate(args.batch_size)
+    finally:
+        qr_render.shutdown_pool()
+        await async_engine.dispose()
+    print(f"✅ Перенесено сертификатов: {migrated} ({time.monotonic() - started:.1f} с)")
+
+    if args.delete_flat:
+        print(f"🗑  Удалено файлов плоского каталога: {delete_flat_files()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
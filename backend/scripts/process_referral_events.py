@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Обработка очереди реферальных событий вручную.
+
+Обычно очередь разбирают воркеры приложения (referral_queue, раз в
+REFERRAL_QUEUE_POLL_INTERVAL). Скрипт нужен, чтобы разобрать накопившееся
+разом или вернуть в очередь события, исчерпавшие попытки:
+
+    docker compose exec -T backend python scripts/process_referral_events.py --retry-failed
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import update
+
+from config import settings
+from database import SessionLocal
+from models import ReferralEvent
+from referral_queue import drain
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=settings.REFERRAL_QUEUE_BATCH_SIZE)
+    parser.add_argument(
+        "--retry-failed", action="store_true", help="сбросить попытки событий с ошибками и обработать их сейчас"
+    )
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.retry_failed:
+            requeued = db.execute(
+                update(ReferralEvent)
+                .where(ReferralEvent.processed == False, ReferralEvent.last_error.is_not(None))
+                .values(attempts=0, next_attempt_at=None)
+            ).rowcount
+            db.commit()
+            print(f"↩️  Возвращено в очередь событий: {requeued}")
+
+        print("🔄 Обработка реферальных событий...")
+        started = time.monotonic()
+        taken, failed = drain(db, args.batch_size)
+    finally:
+        db.close()
+    print(f"✅ Обработано: {taken - failed}, с ошибкой: {failed} ({time.monotonic() - started:.1f} с)")
+
+
+if __name__ == "__main__":
+    main()
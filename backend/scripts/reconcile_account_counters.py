@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Сверка счётчиков транзакций аккаунтов лояльности.
+
+Пересчитывает loyalty_accounts.transactions_count и last_transaction_at по
+таблице loyalty_transactions и исправляет расхождения. Безопасен при
+работающем приложении; рекомендуется запускать по cron раз в сутки:
+
+    0 4 * * * docker compose exec -T backend python scripts/reconcile_account_counters.py
+"""
+
+import os
+import sys
+import time
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal
+from ledger import reconcile_account_counters
+
+
+def main():
+    print("🔄 Сверка счётчиков транзакций...")
+    started = time.monotonic()
+    db = SessionLocal()
+    try:
+        fixed = reconcile_account_counters(db)
+    finally:
+        db.close()
+    print(f"✅ Исправлено аккаунтов: {fixed} ({time.monotonic() - started:.1f} с)")
+
+
+if __name__ == "__main__":
+    main()
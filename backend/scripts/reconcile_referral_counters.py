@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Сверка счётчиков реферальных кодов.
+
+Пересчитывает referral_codes.total_referrals, successful_referrals и
+total_revenue по таблице referral_events и исправляет расхождения. То же
+делает периодическая задача приложения (REFERRAL_RECONCILE_INTERVAL);
+скрипт — для ручного запуска, например после импорта данных:
+
+    docker compose exec -T backend python scripts/reconcile_referral_counters.py
+"""
+
+import os
+import sys
+import time
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal
+from referral_stats import reconcile_referral_counters
+
+
+def main():
+    print("🔄 Сверка счётчиков реферальных кодов...")
+    started = time.monotonic()
+    db = SessionLocal()
+    try:
+        fixed = reconcile_referral_counters(db)
+    finally:
+        db.close()
+    print(f"✅ Исправлено кодов: {fixed} ({time.monotonic() - started:.1f} с)")
+
+
+if __name__ == "__main__":
+    main()
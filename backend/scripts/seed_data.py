@@ -5,7 +5,7 @@
 
 import sys
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 # Добавление родительской директории в путь для импорта модулей
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -16,6 +16,8 @@ from models import (
     Certificate, CertificateStatus,
     ReferralCode, ReferralEvent, ReferralEventType, RewardRule, RewardType
 )
+from ledger import reconcile_account_counters
+import rollups
 from routers.auth import get_password_hash
 import random
 
@@ -214,6 +216,7 @@ def seed_test_transactions(db, users):
         },
     ]
     
+    seeded = []
     for trans_data in transactions:
         trans = LoyaltyTransaction(
             account_id=account.id,
@@ -224,8 +227,14 @@ def seed_test_transactions(db, users):
             source=trans_data["source"]
         )
         db.add(trans)
+        seeded.append(trans)
     
     db.commit()
+    # Транзакции добавлены в обход ledger — пересчитать счётчики аккаунтов
+    # и дневные агрегаты отчётов за дни созданных транзакций
+    reconcile_account_counters(db)
+    days = [trans.created_at.astimezone(timezone.utc).date() for trans in seeded]
+    rollups.rebuild(db, min(days), max(days))
     print(f"✅ Создано {len(transactions)} тестовых транзакций")
 
 
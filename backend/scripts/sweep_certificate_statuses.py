@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Перевод просроченных сертификатов в EXPIRED и сертификатов с нулевым
+остатком в USED.
+
+Приложение делает это само раз в CERT_SWEEP_INTERVAL секунд; скрипт нужен
+для разового прогона (например, после импорта сертификатов из 1С):
+
+    docker compose exec -T backend python scripts/sweep_certificate_statuses.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+# Добавление родительской директории в путь для импорта модулей
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import certificate_cache
+from certificate_status import sweep
+from config import settings
+from database import SessionLocal
+
+
+def main():
+    print("🔄 Обновление статусов сертификатов...")
+    started = time.monotonic()
+    db = SessionLocal()
+    try:
+        changed = sweep(db, settings.CERT_SWEEP_BATCH_SIZE)
+    finally:
+        db.close()
+
+    codes = [code for batch in changed.values() for code in batch]
+    if codes:
+        asyncio.run(certificate_cache.invalidate(*codes))
+    for status, batch in changed.items():
+        print(f"   {status.value}: {len(batch)}")
+    print(f"✅ Готово ({time.monotonic() - started:.1f} с)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Реестр токенов: семейства refresh-токенов и отзыв access-токенов.
+
+Refresh-токены. Вход (login, register) открывает семейство: случайный id
+(claim `fam`), в Redis — hash auth:rtf:{fam} с владельцем и jti текущего
+refresh-токена; семейства пользователя — в множестве auth:rtu:{user}.
+Обмен (`rotate`) принимается только для текущего jti и атомарно
+(WATCH/MULTI) заменяет его новым. Предъявление уже заменённого токена —
+признак кражи: семейство удаляется целиком, а его access-токены
+отзываются. Исключение — повтор в течение REFRESH_REUSE_GRACE секунд
+после обмена (две вкладки обновили токен одновременно): такой запрос
+просто отклоняется.
+
+Отзыв access-токенов. В Redis — сортированное множество auth:revoked:
+элемент "u:{user}" (все токены пользователя, выданные до момента отзыва)
+или "f:{fam}" (токены одного входа), вес — момент отзыва. Элементы старше
+срока жизни access-токена не нужны и удаляются. Каждый процесс держит
+копию множества в словаре и обновляет её фоновой задачей раз в
+TOKEN_REVOCATION_SYNC_INTERVAL (сначала сверяется счётчик версий, само
+множество читается только после изменения), а отзыв в своём процессе
+применяет сразу. Проверка в get_current_user (`is_revoked`) — два поиска
+в словаре, без обращения к Redis и БД.
+"""
+from __future__ import annotations
+
+import logging
+import secrets
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from redis.exceptions import RedisError, WatchError
+
+from config import settings
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+FAMILY_PREFIX = "auth:rtf:"
+USER_FAMILIES_PREFIX = "auth:rtu:"
+REVOKED_KEY = "auth:revoked"
+REVOKED_VERSION_KEY = "auth:revoked:version"
+
+
+class RefreshTokenError(Exception):
+    """Refresh-токен не может быть обменян."""
+
+
+class RefreshTokenReused(RefreshTokenError):
+    """Предъявлен уже заменённый refresh-токен: семейство отозвано."""
+
+
+@dataclass(frozen=True)
+class RefreshGrant:
+    family: str
+    jti: str
+
+
+def new_id() -> str:
+    return secrets.token_urlsafe(16)
+
+
+def _refresh_ttl() -> int:
+    return settings.REFRESH_TOKEN_EXPIRE_DAYS * 86400
+
+
+def _access_ttl() -> int:
+    return settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+
+async def open_family(user_id: int) -> RefreshGrant:
+    """Новое семейство при входе; jti — первого refresh-токена"""
+    grant = RefreshGrant(family=new_id(), jti=new_id())
+    family_key = f"{FAMILY_PREFIX}{grant.family}"
+    user_key = f"{USER_FAMILIES_PREFIX}{user_id}"
+    async with get_redis().pipeline(transaction=True) as pipe:
+        pipe.hset(family_key, mapping={"user": user_id, "jti": grant.jti})
+        pipe.expire(family_key, _refresh_ttl())
+        pipe.sadd(user_key, grant.family)
+        pipe.expire(user_key, _refresh_ttl())
+        await pipe.execute()
+    return grant
+
+
+async def rotate(user_id: int, family: str, jti: str) -> RefreshGrant:
+    """Обмен refresh-токена на следующий в семействе"""
+    family_key = f"{FAMILY_PREFIX}{family}"
+    new_jti = new_id()
+    async with get_redis().pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(family_key)
+                state = await pipe.hgetall(family_key)
+                if not state or int(state[b"user"]) != user_id:
+                    raise RefreshTokenError("Сессия завершена")
+                if state[b"jti"].decode() != jti:
+                    await pipe.unwatch()
+                    rotated_at = float(state.get(b"rotated_at", 0))
+                    if state.get(b"prev", b"").decode() == jti and time.time() - rotated_at < settings.REFRESH_REUSE_GRACE:
+                        raise RefreshTokenError("Токен уже обновлён")
+                    await revoke_family(user_id, family)
+                    raise RefreshTokenReused("Повторное использование refresh-токена")
+                pipe.multi()
+                pipe.hset(family_key, mapping={"jti": new_jti, "prev": jti, "rotated_at": time.time()})
+                pipe.expire(family_key, _refresh_ttl())
+                await pipe.execute()
+                return RefreshGrant(family=family, jti=new_jti)
+            except WatchError:
+                # Параллельный обмен изменил семейство — перечитываем
+                continue
+
+
+async def revoke_family(user_id: int, family: str) -> None:
+    """Выход из одной сессии: refresh-семейство и его access-токены"""
+    async with get_redis().pipeline(transaction=True) as pipe:
+        pipe.delete(f"{FAMILY_PREFIX}{family}")
+        pipe.srem(f"{USER_FAMILIES_PREFIX}{user_id}", family)
+        await pipe.execute()
+    await _revoke(f"f:{family}")
+
+
+async def revoke_user(user_id: int) -> None:
+    """
+    Все сессии пользователя (деактивация): refresh-семейства и access-токены.
+    Вызывается в фоне после commit; ошибка Redis только логируется —
+    неактивного пользователя не пускает и principal_cache.
+    """
+    redis = get_redis()
+    user_key = f"{USER_FAMILIES_PREFIX}{user_id}"
+    try:
+        families = await redis.smembers(user_key)
+        keys = [f"{FAMILY_PREFIX}{family.decode()}" for family in families]
+        await redis.delete(user_key, *keys)
+        await _revoke(f"u:{user_id}")
+    except RedisError as e:
+        logger.error(f"Не удалось отозвать токены пользователя {user_id}: {e}")
+
+
+# Копия auth:revoked в памяти процесса: элемент -> момент отзыва
+_revoked: dict[str, float] = {}
+_revoked_version: Optional[bytes] = None
+
+
+async def _revoke(member: str) -> None:
+    revoked_at = time.time()
+    _revoked[member] = revoked_at
+    async with get_redis().pipeline(transaction=True) as pipe:
+        pipe.zadd(REVOKED_KEY, {member: revoked_at})
+        pipe.zremrangebyscore(REVOKED_KEY, "-inf", revoked_at - _access_ttl())
+        pipe.incr(REVOKED_VERSION_KEY)
+        await pipe.execute()
+
+
+def is_revoked(user_id: int, family: Optional[str], issued_at: float) -> bool:
+    """Access-токен выдан до отзыва пользователя или своего семейства"""
+    revoked_at = _revoked.get(f"u:{user_id}")
+    if revoked_at is not None and issued_at <= revoked_at:
+        return True
+    if family is not None:
+        revoked_at = _revoked.get(f"f:{family}")
+        if revoked_at is not None and issued_at <= revoked_at:
+            return True
+    return False
+
+
+async def sync_revocations() -> None:
+    """Периодическая задача (scheduler, во всех воркерах): обновление копии auth:revoked"""
+    global _revoked, _revoked_version
+    redis = get_redis()
+    try:
+        version = await redis.get(REVOKED_VERSION_KEY)
+        if version is not None and version == _revoked_version:
+            return
+        cutoff = time.time() - _access_ttl()
+        entries = await redis.zrangebyscore(REVOKED_KEY, cutoff, "+inf", withscores=True)
+    except RedisError as e:
+        logger.warning(f"Не удалось обновить список отозванных токенов: {e}")
+        return
+    _revoked = {member.decode(): revoked_at for member, revoked_at in entries}
+    _revoked_version = version
@@ -107,10 +107,12 @@ echo "⚙️  Создание .env файла..."
 if [ ! -f ".env" ]; then
     DB_PASSWORD="MyDocSecure$(openssl rand -hex 8)"
     JWT_SECRET=$(openssl rand -hex 32)
+    CERT_SIGNING_KEY=$(openssl rand -base64 32)
     
     cat > .env << EOF
 DB_PASSWORD=$DB_PASSWORD
 JWT_SECRET=$JWT_SECRET
+CERT_SIGNING_KEY=$CERT_SIGNING_KEY
 ACCESS_TOKEN_EXPIRE_MINUTES=30
 REFRESH_TOKEN_EXPIRE_DAYS=7
 DOMAIN=$DOMAIN
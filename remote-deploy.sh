@@ -155,6 +155,7 @@ DB_PASSWORD=MyDoc2025SecurePassword!$(openssl rand -hex 8)
 
 # JWT Security
 JWT_SECRET=$(openssl rand -hex 32)
+CERT_SIGNING_KEY=$(openssl rand -base64 32)
 ACCESS_TOKEN_EXPIRE_MINUTES=30
 REFRESH_TOKEN_EXPIRE_DAYS=7
 
@@ -185,9 +186,11 @@ EOF
     # Генерация случайных секретов
     DB_PASSWORD="MyDoc2025SecurePassword!$(openssl rand -hex 8)"
     JWT_SECRET=$(openssl rand -hex 32)
+    CERT_SIGNING_KEY=$(openssl rand -base64 32)
     
     sed -i "s|DB_PASSWORD=.*|DB_PASSWORD=$DB_PASSWORD|g" .env
     sed -i "s|JWT_SECRET=.*|JWT_SECRET=$JWT_SECRET|g" .env
+    sed -i "s|CERT_SIGNING_KEY=.*|CERT_SIGNING_KEY=$CERT_SIGNING_KEY|g" .env
     
     chmod 600 .env
     echo "   ✅ .env файл создан с безопасными паролями"